@@ -1,9 +1,12 @@
-from typing import TYPE_CHECKING, Tuple, Callable, IO
+from typing import TYPE_CHECKING, Tuple, Callable, IO, Optional
+import os
 import selectors
 import secrets
 from flask import Flask, render_template, redirect, abort, current_app, request
 import werkzeug.serving
 from .session import Session
+from .export import ExportJobs, ExportCache
+from . import arrow
 
 
 if TYPE_CHECKING:
@@ -15,17 +18,42 @@ class Application(Flask):
         super().__init__(*args, **kw)
         self.db: dballe.DB = None
         self.db_session: Session = None
+        self.export_jobs: ExportJobs = None
+        self.export_cache: Optional[ExportCache] = None
         self.access_token = secrets.token_urlsafe()
 
-    def set_dballe_url(self, db_url: str):
-        self.db_session = Session(db_url)
+    def set_dballe_url(
+            self, db_url: str, pool_size: int = 4, cache_dir: Optional[str] = None,
+            export_workers: Optional[int] = None, export_buffer_size: Optional[int] = None,
+            export_jobs: int = 2, export_cache_size: int = 0, sqlite_wal: bool = False):
+        self.db_session = Session(
+                db_url, pool_size=pool_size, cache_dir=cache_dir,
+                export_workers=export_workers, export_buffer_size=export_buffer_size, sqlite_wal=sqlite_wal)
+        if cache_dir is not None and export_cache_size:
+            self.export_cache = ExportCache(os.path.join(cache_dir, "exports"), export_cache_size)
+        self.export_jobs = ExportJobs(self.db_session, max_running=export_jobs, cache=self.export_cache)
         self.db = self.db_session.db
 
+    def shutdown(self):
+        """
+        Stop background work, when the server is shutting down
+        """
+        if self.export_jobs is not None:
+            self.export_jobs.shutdown()
+        if self.db_session is not None:
+            self.db_session.shutdown()
+
 
 # See https://flask.palletsprojects.com/en/2.0.x/patterns/appfactories/
-def create_app(db_url: str):
+def create_app(
+        db_url: str, pool_size: int = 4, cache_dir: Optional[str] = None, export_workers: Optional[int] = None,
+        export_buffer_size: Optional[int] = None, export_jobs: int = 2, export_cache_size: int = 0,
+        sqlite_wal: bool = False):
     app = Application(__name__)
-    app.set_dballe_url(db_url)
+    app.set_dballe_url(
+            db_url, pool_size=pool_size, cache_dir=cache_dir,
+            export_workers=export_workers, export_buffer_size=export_buffer_size,
+            export_jobs=export_jobs, export_cache_size=export_cache_size, sqlite_wal=sqlite_wal)
 
     from .webapi import api
     app.register_blueprint(api)
@@ -42,7 +70,7 @@ def create_app(db_url: str):
 
     @app.route("/")
     def index():
-        return render_template("index.html")
+        return render_template("index.html", columnar_export=arrow.is_available())
 
     @app.route("/start/<token>")
     def start(token: str):
@@ -135,3 +163,4 @@ class Server(werkzeug.serving.ThreadedWSGIServer):
             pass
         finally:
             self.server_close()
+            self.app.shutdown()
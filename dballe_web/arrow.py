@@ -0,0 +1,156 @@
+from typing import Any, Dict, List, Optional
+import logging
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ModuleNotFoundError:
+    pyarrow = None
+
+log = logging.getLogger(__name__)
+
+# Mimetypes of the columnar export formats
+MIMETYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+# Number of values in each row group or record batch
+BATCH_SIZE = 65536
+
+
+def is_available() -> bool:
+    """
+    Check if columnar exports can be generated
+    """
+    return pyarrow is not None
+
+
+def _schema():
+    dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return pyarrow.schema([
+        ("ana_id", pyarrow.int32()),
+        ("lat", pyarrow.float64()),
+        ("lon", pyarrow.float64()),
+        ("rep_memo", dictionary),
+        ("level", dictionary),
+        ("trange", dictionary),
+        ("varcode", dictionary),
+        ("datetime", pyarrow.timestamp("s")),
+        # Numeric values, or null for string variables
+        ("value", pyarrow.float64()),
+        # String values, or null for numeric variables
+        ("text", pyarrow.string()),
+    ])
+
+
+def _format_tuple(values) -> Optional[str]:
+    """
+    Format a level or time range as a string usable as a dictionary key
+    """
+    if values is None:
+        return None
+    return ",".join("" if v is None else str(v) for v in values)
+
+
+class OutputFile:
+    """
+    Minimal binary file interface on top of an object with a write method,
+    as needed by pyarrow.PythonFile and zipfile
+    """
+    def __init__(self, out):
+        self.out = out
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.out.write(data)
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Batch:
+    """
+    Accumulate query_data results into columns
+    """
+    def __init__(self):
+        self.columns: Dict[str, List[Any]] = {name: [] for name in _schema().names}
+
+    def __len__(self):
+        return len(self.columns["ana_id"])
+
+    def add(self, rec):
+        var = rec["variable"]
+        value = var.get()
+        columns = self.columns
+        columns["ana_id"].append(rec["ana_id"])
+        columns["lat"].append(rec["lat"])
+        columns["lon"].append(rec["lon"])
+        columns["rep_memo"].append(rec["rep_memo"])
+        columns["level"].append(_format_tuple(rec["level"]))
+        columns["trange"].append(_format_tuple(rec["trange"]))
+        columns["varcode"].append(var.code)
+        columns["datetime"].append(rec["datetime"])
+        if var.info.type == "string":
+            columns["value"].append(None)
+            columns["text"].append(value)
+        else:
+            columns["value"].append(value)
+            columns["text"].append(None)
+
+    def to_record_batch(self, schema):
+        arrays = []
+        for field in schema:
+            values = self.columns[field.name]
+            if pyarrow.types.is_dictionary(field.type):
+                arrays.append(pyarrow.array(values, type=field.type.value_type).dictionary_encode())
+            else:
+                arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export(tr, query: Dict[str, Any], format: str, out, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Export the results of query_data to out as Parquet or as an Arrow IPC
+    stream.
+
+    Values are read and written in batches of batch_size, so that memory use
+    does not depend on the size of the export. Returns the number of values
+    exported
+    """
+    if pyarrow is None:
+        raise RuntimeError(f"{format} export requires pyarrow, which is not installed")
+    if format not in MIMETYPES:
+        raise ValueError(f"unsupported columnar export format {format!r}")
+
+    schema = _schema()
+    sink = pyarrow.PythonFile(OutputFile(out), mode="w")
+    if format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+
+    count = 0
+    with writer:
+        batch = Batch()
+        for rec in tr.query_data(query):
+            batch.add(rec)
+            if len(batch) >= batch_size:
+                writer.write_batch(batch.to_record_batch(schema))
+                count += len(batch)
+                batch = Batch()
+        if len(batch):
+            writer.write_batch(batch.to_record_batch(schema))
+            count += len(batch)
+    return count
@@ -0,0 +1,133 @@
+from typing import Any, Dict, Hashable, List, Optional
+import array
+import datetime
+import numpy
+from .session import Session, EPOCH, _export_datetime, _import_datetime
+
+# Supported bucket durations, in seconds
+STEPS = {
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+}
+
+# Maximum number of time buckets in a matrix
+MAX_BUCKETS = 10000
+
+# Maximum number of cells, as rows by time buckets, in a matrix
+MAX_CELLS = 10000000
+
+
+class Availability:
+    """
+    Accumulate value counts in a matrix of rows by time buckets.
+
+    Rows are identified by any hashable key. Rows for keys not given at
+    construction are added as they are found.
+
+    Values are buffered in typed arrays, and added to the matrix in chunks of
+    chunk_size with numpy
+    """
+    def __init__(
+            self, keys: List[Hashable], datemin: datetime.datetime, datemax: datetime.datetime,
+            step: int, chunk_size: int = 65536):
+        self.step = step
+        # Start buckets at a multiple of step since the epoch, so that days
+        # start at midnight
+        start = (datemin - EPOCH).total_seconds()
+        self.start = start - start % step
+        self.buckets = int(((datemax - EPOCH).total_seconds() - self.start) // step) + 1
+        if self.buckets > MAX_BUCKETS:
+            raise ValueError(f"{self.buckets} time buckets requested, but at most {MAX_BUCKETS} are allowed")
+        self.keys = list(keys)
+        self._check_size()
+        self.positions: Dict[Hashable, int] = {key: pos for pos, key in enumerate(self.keys)}
+        self.counts = numpy.zeros((len(self.keys), self.buckets), dtype=numpy.uint32)
+        self.chunk_size = chunk_size
+        self.pending_rows = array.array("I")
+        self.pending_times = array.array("d")
+
+    def _check_size(self):
+        cells = len(self.keys) * self.buckets
+        if cells > MAX_CELLS:
+            raise ValueError(
+                f"{len(self.keys)} rows by {self.buckets} time buckets requested,"
+                f" but at most {MAX_CELLS} cells are allowed")
+
+    def add(self, key: Hashable, dt: datetime.datetime):
+        pos = self.positions.get(key)
+        if pos is None:
+            pos = self.positions[key] = len(self.keys)
+            self.keys.append(key)
+        self.pending_rows.append(pos)
+        self.pending_times.append((dt - EPOCH).total_seconds())
+        if len(self.pending_rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the pending values to the matrix
+        """
+        if not self.pending_rows:
+            return
+        if len(self.keys) > len(self.counts):
+            self._check_size()
+            self.counts = numpy.vstack((
+                self.counts, numpy.zeros((len(self.keys) - len(self.counts), self.buckets), dtype=numpy.uint32)))
+        rows = numpy.frombuffer(self.pending_rows, dtype=numpy.uint32).astype(numpy.int64)
+        times = numpy.frombuffer(self.pending_times, dtype=float)
+        buckets = numpy.clip(((times - self.start) // self.step).astype(numpy.int64), 0, self.buckets - 1)
+        # Only touch the cells that have values: the indices returned by
+        # unique are distinct, so they can be incremented in one go
+        cells, counts = numpy.unique(rows * self.buckets + buckets, return_counts=True)
+        self.counts.reshape(-1)[cells] += counts.astype(numpy.uint32)
+        self.pending_rows = array.array("I")
+        self.pending_times = array.array("d")
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Encode as a JSON-serializable dict.
+
+        counts only lists the cells with values, as parallel lists of row
+        positions, bucket positions and counts. completeness has, for each
+        row, the fraction of time buckets with at least one value
+        """
+        self.flush()
+        rows, buckets = numpy.nonzero(self.counts)
+        return {
+            "rows": self.keys,
+            "start": _export_datetime(EPOCH + datetime.timedelta(seconds=self.start)),
+            "step": self.step,
+            "buckets": self.buckets,
+            "counts": {
+                "row": rows.tolist(),
+                "bucket": buckets.tolist(),
+                "count": self.counts[rows, buckets].tolist(),
+            },
+            "completeness": (numpy.bincount(rows, minlength=len(self.counts)) / self.buckets).tolist(),
+        }
+
+
+def count_values(session: Session, by: str, step: int) -> Optional[Availability]:
+    """
+    Count the values selected by the current filter by station or by varcode,
+    and by time buckets of step seconds, in one pass over query_data.
+
+    Returns None if no data is selected
+    """
+    etag, explorer = session.explorer_state()
+    stats = explorer.get("stats")
+    if not stats or not stats["count"]:
+        return None
+    if by == "station":
+        keys = [s[1] for s in explorer["stations"]]
+    elif by == "varcode":
+        keys = [code for code, desc in explorer["var"]]
+    else:
+        raise ValueError(f"cannot count values by {by!r}")
+
+    res = Availability(keys, _import_datetime(stats["datetime_min"]), _import_datetime(stats["datetime_max"]), step)
+    with session.read_transaction() as tr:
+        for rec in tr.query_data(session.filter.to_record()):
+            res.add(rec["ana_id"] if by == "station" else rec["variable"].code, rec["datetime"])
+    return res
@@ -0,0 +1,94 @@
+from typing import Any, Dict, Iterator, List, Tuple
+import collections
+
+
+class ChangeSummary:
+    """
+    Values added to the database, aggregated by station, level, time range
+    and variable like the entries of the explorer summary.
+
+    Each entry also keeps the number of values for each day, as a proleptic
+    Gregorian ordinal, for the time histogram
+    """
+    def __init__(self):
+        self.entries: Dict[tuple, Dict[str, Any]] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, rec: Dict[str, Any]):
+        """
+        Add a value, as returned by Session._replace_data
+        """
+        key = (rec["ana_id"], tuple(rec["level"]), tuple(rec["trange"]), rec["var"])
+        dt = rec["datetime"]
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {
+                "ana_id": rec["ana_id"],
+                "rep_memo": rec["rep_memo"],
+                "lat": rec["lat"],
+                "lon": rec["lon"],
+                "ident": rec["ident"],
+                "level": key[1],
+                "trange": key[2],
+                "var": key[3],
+                "count": 0,
+                "datetimemin": dt,
+                "datetimemax": dt,
+                "days": collections.Counter(),
+            }
+        else:
+            entry["datetimemin"] = min(entry["datetimemin"], dt)
+            entry["datetimemax"] = max(entry["datetimemax"], dt)
+        entry["count"] += 1
+        entry["days"][dt.toordinal()] += 1
+
+
+class ExplorerChanges:
+    """
+    Values added to the database after the explorer was built.
+
+    Changes are kept in layers with increasing sequence numbers. Before
+    reading the database to build something that includes the changes so far,
+    call checkpoint() while writes are blocked: changes in layers before the
+    returned sequence number are part of what is read, and the following ones
+    are not.
+    """
+    def __init__(self):
+        self.layers: List[Tuple[int, ChangeSummary]] = [(0, ChangeSummary())]
+
+    def __len__(self):
+        return sum(len(layer) for seq, layer in self.layers)
+
+    def add(self, rec: Dict[str, Any]):
+        self.layers[-1][1].add(rec)
+
+    def checkpoint(self) -> int:
+        """
+        Start a new layer, and return its sequence number
+        """
+        seq, layer = self.layers[-1]
+        if not layer:
+            return seq
+        self.layers.append((seq + 1, ChangeSummary()))
+        return seq + 1
+
+    def since(self, seq: int) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate the summary entries of layers starting from seq
+        """
+        for layer_seq, layer in self.layers:
+            if layer_seq >= seq:
+                yield from layer.entries.values()
+
+    def count_since(self, seq: int) -> int:
+        return sum(len(layer) for layer_seq, layer in self.layers if layer_seq >= seq)
+
+    def discard(self, seq: int):
+        """
+        Drop the layers before seq, once nothing needs them anymore
+        """
+        self.layers = [(layer_seq, layer) for layer_seq, layer in self.layers if layer_seq >= seq]
+        if not self.layers:
+            self.layers.append((seq, ChangeSummary()))
@@ -0,0 +1,192 @@
+from typing import Any, Dict, List
+import array
+import json
+import struct
+import sys
+from .session import _export_datetime, _import_datetime
+
+# Content types for the encodings of data rows
+MIMETYPE_COLUMNS_JSON = "application/vnd.dballe-web.columns+json"
+MIMETYPE_COLUMNS_BINARY = "application/vnd.dballe-web.columns"
+
+# Magic string at the beginning of binary encoded columns
+BINARY_MAGIC = b"DBWC"
+
+
+def _pack(arr: array.array) -> bytes:
+    """
+    Serialize an array as little endian
+    """
+    if sys.byteorder == "big":
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+class DictColumn:
+    """
+    Dictionary-encoded column: each distinct value is stored once, and rows
+    store the index of their value
+    """
+    def __init__(self):
+        self.values: List[Any] = []
+        self.positions: Dict[Any, int] = {}
+        self.rows = array.array("I")
+
+    def add(self, value) -> int:
+        pos = self.positions.get(value)
+        if pos is None:
+            pos = self.positions[value] = len(self.values)
+            self.values.append(value)
+        self.rows.append(pos)
+        return pos
+
+    def to_dict(self, export=None):
+        return {
+            "values": self.values if export is None else [export(v) for v in self.values],
+            "index": self.rows.tolist(),
+        }
+
+    def to_binary(self):
+        """
+        Return the type code and the encoded row indices
+        """
+        if len(self.values) <= 0x10000:
+            return "u16", _pack(array.array("H", self.rows))
+        return "u32", _pack(self.rows)
+
+
+class DataColumns:
+    """
+    Accumulate query_data results in columns.
+
+    Each column has the same name as the keys of the rows returned by
+    Session.get_data. Value type and scale depend only on the variable, and
+    are stored alongside the variable dictionary.
+    """
+    def __init__(self):
+        self.count = 0
+        self.ids = array.array("I")
+        self.stations = array.array("I")
+        self.reports = DictColumn()
+        self.varcodes = DictColumn()
+        self.levels = DictColumn()
+        self.tranges = DictColumn()
+        self.datetimes = DictColumn()
+        self.vartypes: List[str] = []
+        self.varscales: List[int] = []
+        # Values as they come from the database
+        self.values: List[Any] = []
+
+    def add(self, rec):
+        var = rec["variable"]
+        self.count += 1
+        self.ids.append(rec["context_id"])
+        self.stations.append(rec["ana_id"])
+        self.reports.add(rec["rep_memo"])
+        if self.varcodes.add(var.code) == len(self.vartypes):
+            self.vartypes.append(var.info.type)
+            self.varscales.append(var.info.scale if var.info.type in ("integer", "decimal") else None)
+        self.levels.add(tuple(rec["level"]))
+        self.tranges.add(tuple(rec["trange"]))
+        self.datetimes.add(rec["datetime"])
+        self.values.append(var.get())
+
+    def add_row(self, row):
+        """
+        Add a row as returned by Session.get_data
+        """
+        self.count += 1
+        self.ids.append(row["i"])
+        self.stations.append(row["s"])
+        self.reports.add(row["r"])
+        if self.varcodes.add(row["c"]) == len(self.vartypes):
+            self.vartypes.append(row["vt"])
+            self.varscales.append(row.get("vs"))
+        self.levels.add(tuple(row["l"]))
+        self.tranges.add(tuple(row["t"]))
+        self.datetimes.add(_import_datetime(row["d"]))
+        self.values.append(row["v"])
+
+    def to_dict(self):
+        """
+        Encode as a JSON-serializable struct of arrays
+        """
+        return {
+            "n": self.count,
+            "i": self.ids.tolist(),
+            "s": self.stations.tolist(),
+            "r": self.reports.to_dict(),
+            "c": self.varcodes.to_dict(),
+            "l": self.levels.to_dict(),
+            "t": self.tranges.to_dict(),
+            "d": self.datetimes.to_dict(_export_datetime),
+            "vt": self.vartypes,
+            "vs": self.varscales,
+            "v": self.values,
+        }
+
+    def to_binary(self, extra=None) -> bytes:
+        """
+        Encode as a compact binary buffer.
+
+        The buffer starts with BINARY_MAGIC and the length of a JSON header as
+        a little endian 32 bit integer. The header contains dictionaries,
+        string values, and the position of each column in the data that
+        follows it. The data starts at the first multiple of 8 bytes after
+        the header, and columns are little endian typed arrays, each starting
+        at a multiple of 8 bytes from the start of the data. Numeric values
+        are stored as float64, string values are listed in row order in the
+        header.
+
+        extra is an optional JSON-serializable dict stored in the header, to
+        carry information about the response besides the columns
+        """
+        numbers = array.array("d")
+        strings = []
+        for pos, value in zip(self.varcodes.rows, self.values):
+            if self.vartypes[pos] == "string":
+                numbers.append(float("nan"))
+                strings.append(value)
+            else:
+                numbers.append(float("nan") if value is None else value)
+
+        # Columns are padded to 8 bytes, so that all arrays are aligned
+        chunks = [("v", "f64", _pack(numbers)), ("i", "u32", _pack(self.ids)), ("s", "u32", _pack(self.stations))]
+        for name, column in (("r", self.reports), ("c", self.varcodes), ("l", self.levels),
+                             ("t", self.tranges), ("d", self.datetimes)):
+            typecode, data = column.to_binary()
+            chunks.append((name, typecode, data))
+
+        layout = []
+        offset = 0
+        for name, typecode, data in chunks:
+            layout.append((name, typecode, offset))
+            offset += len(data)
+            # Keep the next array aligned
+            offset += -offset % 8
+
+        header = json.dumps({
+            "n": self.count,
+            "dicts": {
+                "r": self.reports.values,
+                "c": self.varcodes.values,
+                "l": self.levels.values,
+                "t": self.tranges.values,
+                "d": [_export_datetime(dt) for dt in self.datetimes.values],
+            },
+            "vt": self.vartypes,
+            "vs": self.varscales,
+            "strings": strings,
+            "arrays": layout,
+            "extra": extra or {},
+        }, separators=(",", ":")).encode()
+
+        res = bytearray(BINARY_MAGIC)
+        res += struct.pack("<I", len(header))
+        res += header
+        res += bytes(-len(res) % 8)
+        for name, typecode, data in chunks:
+            res += data
+            res += bytes(-len(data) % 8)
+        return bytes(res)
@@ -0,0 +1,174 @@
+from typing import Iterable, Iterator, Optional
+import time
+import zlib
+from flask import Request, Response
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+MIN_SIZE = 1024
+
+# Streams are flushed after this many bytes of input, or this many seconds,
+# since the last flush
+FLUSH_SIZE = 65536
+FLUSH_INTERVAL = 0.5
+
+# Content types that are already compressed
+COMPRESSED_MIMETYPES = {
+    "application/vnd.apache.parquet",
+    "application/zip",
+}
+
+
+class GzipCompressor:
+    def __init__(self):
+        # wbits=31 selects the gzip container
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """
+        Return all pending compressed data, keeping the stream open
+        """
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self):
+        # Favour speed: most of our responses are generated on the fly
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+def available_encodings():
+    """
+    Return the supported content encodings and their compressors, in order
+    of preference
+    """
+    res = []
+    if zstandard is not None:
+        res.append(("zstd", ZstdCompressor))
+    if brotli is not None:
+        res.append(("br", BrotliCompressor))
+    res.append(("gzip", GzipCompressor))
+    return res
+
+
+def choose_encoding(request: Request) -> Optional[str]:
+    """
+    Choose a content encoding according to the Accept-Encoding header of the
+    request, or None if the response should not be compressed
+    """
+    return request.accept_encodings.best_match([name for name, cls in available_encodings()])
+
+
+def compress_stream(
+        compressor, chunks: Iterable[bytes],
+        flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL) -> Iterator[bytes]:
+    """
+    Compress a stream of chunks.
+
+    The compressor is flushed after the first chunk, so that the client can
+    start showing data early, and then every flush_size bytes of input or
+    flush_interval seconds. Flushing after every chunk would hurt the
+    compression ratio of streams made of many small chunks, like BUFR exports
+    """
+    try:
+        first = True
+        # Input bytes since the last flush
+        pending = 0
+        last_flush = time.monotonic()
+        for chunk in chunks:
+            # Flask encodes str chunks as utf-8 when they are not compressed
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            now = time.monotonic()
+            if first or pending >= flush_size or now - last_flush >= flush_interval:
+                data += compressor.flush()
+                first = False
+                pending = 0
+                last_flush = now
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        # Propagate closing to the original generator, so it can notice that
+        # the client went away
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(request: Request, response: Response) -> Response:
+    """
+    Compress a response, if the client supports it and it is worth it.
+
+    Streamed responses are compressed incrementally
+    """
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype in COMPRESSED_MIMETYPES:
+        return response
+    # Responses from send_file may be served with Range requests, and need
+    # to be sent as they are
+    if response.direct_passthrough:
+        return response
+
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+    compressor = dict(available_encodings())[encoding]()
+
+    if response.is_streamed:
+        response.response = compress_stream(compressor, response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers["Content-Encoding"] = encoding
+    # The compressed body is a different representation of the same content
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,598 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from .session import Session, Filter, _import_datetime
+from . import arrow
+
+log = logging.getLogger(__name__)
+
+# File extensions and mimetypes of export formats
+EXPORT_FORMATS = {
+    "bufr": "application/octet-stream",
+    "crex": "application/octet-stream",
+    "csv": "text/csv",
+}
+if arrow.is_available():
+    EXPORT_FORMATS.update(arrow.MIMETYPES)
+
+
+# Ways of splitting a partitioned export
+PARTITIONS = ("station", "report", "day", "varcode")
+
+
+class ExportCancelled(Exception):
+    """
+    Raised in an export thread when nobody wants its output anymore
+    """
+
+
+def partition_filters(session: Session, partition: str, flt: Optional[Filter] = None) -> Iterator[Tuple[str, Filter]]:
+    """
+    Split the data selected by flt, or the currently selected data if flt is
+    None, according to partition.
+
+    Generates (name, filter) pairs, one for each part
+    """
+    if partition not in PARTITIONS:
+        raise ValueError(f"unsupported partition {partition!r}")
+    explorer = session.explorer_to_dict()
+    base = flt if flt is not None else session.filter
+
+    if partition == "station":
+        for station in sorted(explorer["stations"], key=lambda s: s[1]):
+            flt = copy.copy(base)
+            flt.ana_id = station[1]
+            yield f"station-{station[1]}", flt
+    elif partition == "report":
+        for rep_memo in explorer["rep_memo"]:
+            flt = copy.copy(base)
+            flt.rep_memo = rep_memo
+            yield rep_memo, flt
+    elif partition == "varcode":
+        for varcode, desc in explorer["var"]:
+            flt = copy.copy(base)
+            flt.var = varcode
+            yield varcode, flt
+    elif partition == "day":
+        stats = explorer.get("stats", {})
+        dtmin = _import_datetime(stats.get("datetime_min"))
+        dtmax = _import_datetime(stats.get("datetime_max"))
+        if dtmin is None or dtmax is None:
+            return
+        # Skip the days without data, which would cost a query each
+        days = session.data_days(base)
+        if days is None:
+            days = [dtmin.date() + datetime.timedelta(days=i) for i in range((dtmax.date() - dtmin.date()).days + 1)]
+        for day in days:
+            flt = copy.copy(base)
+            start = datetime.datetime.combine(day, datetime.time(0, 0, 0))
+            end = datetime.datetime.combine(day, datetime.time(23, 59, 59))
+            flt.datemin = start if base.datemin is None else max(base.datemin, start)
+            flt.datemax = end if base.datemax is None else min(base.datemax, end)
+            yield day.isoformat(), flt
+
+
+class ZipMember:
+    """
+    Write to a member of a zip file, creating it only when the first data
+    arrives, so that empty parts are left out of the archive
+    """
+    def __init__(self, archive: zipfile.ZipFile, name: str):
+        self.archive = archive
+        self.name = name
+        self.out = None
+
+    def write(self, chunk: bytes):
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if self.out is None:
+            info = zipfile.ZipInfo(self.name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # The size is not known in advance
+            self.out = self.archive.open(info, "w", force_zip64=True)
+        self.out.write(chunk)
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+
+
+def export_partitioned(session: Session, format: str, partition: str, out, flt: Optional[Filter] = None) -> int:
+    """
+    Export the data selected by flt, or the currently selected data if flt is
+    None, as a zip archive written to out, with one member for each part of
+    the data split according to partition.
+
+    The archive is generated while it is written, and is never stored in
+    full: out does not need to be seekable. Returns the number of rows
+    exported, or None if it is not known
+    """
+    total = 0
+    # On errors the archive is abandoned without closing it, since closing
+    # would write to out again
+    archive = zipfile.ZipFile(arrow.OutputFile(out), "w")
+    with session.exporter(format) as export:
+        for name, part in partition_filters(session, partition, flt):
+            member = ZipMember(archive, f"{name}.{format}")
+            rows = export(member, part)
+            member.close()
+            if rows is None:
+                total = None
+            elif total is not None:
+                total += rows
+    archive.close()
+    return total
+
+
+def _link_or_copy(src: str, dst: str):
+    """
+    Make dst a hard link to src, or a copy if they are on different file
+    systems
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ExportCacheWriter:
+    """
+    Write an export to a temporary file, to be added to the cache if it
+    completes.
+
+    Writing stops as soon as the export becomes too big to fit in the cache
+    """
+    def __init__(self, cache: "ExportCache", key: str):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        os.makedirs(cache.cache_dir, exist_ok=True)
+        fd, self.tmpname = tempfile.mkstemp(dir=cache.cache_dir, prefix=".export-", suffix=".tmp")
+        self.out = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes):
+        if self.out is None:
+            return
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        self.size += len(chunk)
+        if self.size > self.cache.max_size:
+            # It would be evicted as soon as it is added
+            self.discard()
+            return
+        self.out.write(chunk)
+
+    def commit(self):
+        """
+        Add the written data to the cache
+        """
+        if self.out is None:
+            return
+        self.out.close()
+        self.out = None
+        self.cache._add(self.key, self.tmpname)
+
+    def discard(self):
+        """
+        Throw away what was written
+        """
+        if self.out is None:
+            return
+        self.out.close()
+        self.out = None
+        os.unlink(self.tmpname)
+
+
+class ExportCache:
+    """
+    On-disk cache of export results, keyed by format, filter and database
+    contents.
+
+    When the cache grows beyond max_size bytes, the least recently used
+    results are deleted
+    """
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Size of cached files by key, from the least to the most recently
+        # used
+        self.entries: Dict[str, int] = collections.OrderedDict()
+        self.size = 0
+        # Keys of files in use, which are not evicted
+        self.pinned: Dict[str, int] = collections.Counter()
+        self._scan()
+
+    @staticmethod
+    def key(format: str, flt: Filter, marker: str) -> str:
+        """
+        Compute the cache key for an export.
+
+        format identifies the export format and any variant of it, like
+        partitioning. marker is Session.data_marker() at the time the export
+        starts
+        """
+        data = json.dumps([format, flt.to_record(), marker], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _scan(self):
+        """
+        Load the index of files already in the cache
+        """
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return
+        files = []
+        for name in names:
+            # Skip temporary files
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(self._path(name))
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        with self.lock:
+            for mtime, name, size in files:
+                self.entries[name] = size
+                self.size += size
+            self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the cache fits in max_size.
+
+        Call with the lock held
+        """
+        for key in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if self.pinned[key]:
+                continue
+            self.size -= self.entries.pop(key)
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _add(self, key: str, tmpname: str):
+        """
+        Move a file in the cache
+        """
+        size = os.path.getsize(tmpname)
+        os.replace(tmpname, self._path(key))
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old
+            self.entries[key] = size
+            self.size += size
+            self._evict()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the path to the cached file for key, or None if it is not in
+        the cache
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            # Keep the recently used order across restarts
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                size = self.entries.pop(key, None)
+                if size is not None:
+                    self.size -= size
+            return None
+        return path
+
+    @contextlib.contextmanager
+    def use(self, key: str) -> Iterator[Optional[str]]:
+        """
+        Return the path to the cached file for key, or None if it is not in
+        the cache, keeping the file from being evicted until the context
+        exits
+        """
+        with self.lock:
+            self.pinned[key] += 1
+        try:
+            yield self.get(key)
+        finally:
+            with self.lock:
+                self.pinned[key] -= 1
+                if not self.pinned[key]:
+                    del self.pinned[key]
+                self._evict()
+
+    def writer(self, key: str) -> ExportCacheWriter:
+        """
+        Return an object to write a new cache entry
+        """
+        return ExportCacheWriter(self, key)
+
+    def store(self, key: str, path: str):
+        """
+        Add a copy of an existing file to the cache
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmpname = os.path.join(self.cache_dir, f".export-{secrets.token_hex(8)}.tmp")
+        _link_or_copy(path, tmpname)
+        self._add(key, tmpname)
+
+    def fetch(self, key: str, dest: str) -> bool:
+        """
+        Copy the cached file for key to dest.
+
+        Returns False if key is not in the cache
+        """
+        with self.use(key) as path:
+            if path is None:
+                return False
+            _link_or_copy(path, dest)
+        return True
+
+
+class ExportJob:
+    """
+    Export running in the background to a spool file
+    """
+    def __init__(
+            self, session: Session, job_id: str, format: str, path: str, cache: Optional[ExportCache] = None):
+        self.id = job_id
+        self.format = format
+        self.path = path
+        # Export the data selected when the job was submitted, even if the
+        # filter changes before it runs
+        self.filter = copy.copy(session.filter)
+        self.cache = cache
+        self.cache_key: Optional[str] = None
+        # Set when the result came from the cache
+        self.cached = False
+        if cache is not None:
+            self.cache_key = cache.key(format, self.filter, session.data_marker())
+        # Number of values selected, used to estimate progress. It is not
+        # known until the explorer is built
+        self.expected_rows: Optional[int] = session.explorer_to_dict().get("stats", {}).get("count")
+        self.state = "queued"
+        self.error: Optional[str] = None
+        self.rows = 0
+        # While reading the header of a CSV export, and the first byte of
+        # the line being written, to tell header lines from values
+        self.csv_header = True
+        self.csv_line_start: Optional[bytes] = None
+        self.bytes = 0
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancelled = threading.Event()
+        # Future for the job in the ExportJobs executor
+        self.future: Optional[concurrent.futures.Future] = None
+
+    def write(self, chunk: bytes):
+        """
+        Called by Session.export to write to the spool file
+        """
+        if self.cancelled.is_set():
+            raise ExportCancelled()
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        self.out.write(chunk)
+        self.bytes += len(chunk)
+        # Count the progress in the units of expected_rows: BUFR and CREX are
+        # written one message at a time, CSV one value per line. Columnar
+        # formats only report the count at the end
+        if self.format == "csv":
+            self._count_csv_rows(chunk)
+        elif self.format in ("bufr", "crex"):
+            self.rows += 1
+
+    def _count_csv_rows(self, chunk: bytes):
+        """
+        Count the values in a chunk of CSV output.
+
+        CSV exports start with title lines, which are quoted, followed by the
+        line with column names: these are not counted
+        """
+        if not self.csv_header:
+            self.rows += chunk.count(b"\n")
+            return
+        pos = 0
+        while pos < len(chunk):
+            if self.csv_line_start is None:
+                self.csv_line_start = chunk[pos:pos + 1]
+            end = chunk.find(b"\n", pos)
+            if end == -1:
+                return
+            if self.csv_line_start != b'"':
+                # Column names: the header ends here
+                self.csv_header = False
+                self.rows += chunk.count(b"\n", end + 1)
+                return
+            self.csv_line_start = None
+            pos = end + 1
+
+    def run(self, session: Session):
+        """
+        Run the export, in a worker thread
+        """
+        if self.cancelled.is_set():
+            return
+        self.state = "running"
+        self.started = time.time()
+        tmpname = self.path + ".part"
+        try:
+            if self.cache is not None and self.cache.fetch(self.cache_key, self.path):
+                self.bytes = os.path.getsize(self.path)
+                self.cached = True
+                self.state = "done"
+                return
+            with open(tmpname, "wb") as self.out:
+                rows = session.export(self.format, self, self.filter)
+            if self.format in arrow.MIMETYPES:
+                self.rows = rows
+            os.replace(tmpname, self.path)
+            self.state = "done"
+            if self.cache is not None:
+                try:
+                    self.cache.store(self.cache_key, self.path)
+                except OSError as e:
+                    log.warning("export job %s: cannot add result to the cache: %s", self.id, e)
+        except ExportCancelled:
+            self.state = "cancelled"
+        except Exception as e:
+            log.error("export job %s failed: %s", self.id, e, exc_info=True)
+            self.state = "failed"
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            if self.state != "done" and os.path.exists(tmpname):
+                os.unlink(tmpname)
+            log.info("export job %s %s: %d bytes, %d rows in %.3fs",
+                     self.id, self.state, self.bytes, self.rows, self.finished - self.started)
+
+    def eta(self) -> Optional[float]:
+        """
+        Estimate the number of seconds until the export is done
+        """
+        if self.state != "running" or not self.rows or not self.expected_rows or self.format != "csv":
+            # Only CSV progress is counted in values, like expected_rows
+            return None
+        elapsed = time.time() - self.started
+        return max(0.0, elapsed * (self.expected_rows - self.rows) / self.rows)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "format": self.format,
+            "state": self.state,
+            "error": self.error,
+            "rows": self.rows,
+            "expected_rows": self.expected_rows,
+            "bytes": self.bytes,
+            "created": self.created,
+            "elapsed": None if self.started is None else (self.finished or time.time()) - self.started,
+            "eta": self.eta(),
+            "cached": self.cached,
+        }
+
+
+class ExportJobs:
+    """
+    Run exports in the background, keeping their results in a spool
+    directory until they are downloaded.
+
+    At most max_running jobs run at the same time, so that exports do not
+    take all database connections away from interactive requests
+    """
+    # Number of finished jobs whose results are kept
+    MAX_FINISHED = 16
+
+    def __init__(
+            self, session: Session, max_running: int = 2, spool_dir: Optional[str] = None,
+            cache: Optional[ExportCache] = None):
+        self.session = session
+        self.cache = cache
+        # Parent directory for the spool directory, which is created when
+        # first needed
+        self.spool_parent = spool_dir
+        self.spool_dir: Optional[str] = None
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, ExportJob] = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_running, thread_name_prefix="dballe-web-export-job")
+
+    def _spool_path(self, job_id: str, format: str) -> str:
+        if self.spool_dir is None:
+            self.spool_dir = tempfile.mkdtemp(prefix="dballe-web-export-", dir=self.spool_parent)
+        return os.path.join(self.spool_dir, f"{job_id}.{format}")
+
+    def submit(self, format: str) -> ExportJob:
+        """
+        Start exporting the currently selected data in the background
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"unsupported export format {format!r}")
+        job_id = secrets.token_urlsafe(8)
+        job = ExportJob(self.session, job_id, format, self._spool_path(job_id, format), cache=self.cache)
+        # Set the future before the job can be found by get() and cancel()
+        job.future = self.executor.submit(job.run, self.session)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._expire()
+        return job
+
+    def get(self, job_id: str) -> ExportJob:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"export job {job_id!r} not found")
+        return job
+
+    def list(self) -> List[ExportJob]:
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created)
+
+    def cancel(self, job_id: str) -> ExportJob:
+        """
+        Stop a job, and delete its results
+        """
+        job = self.get(job_id)
+        job.cancelled.set()
+        # Jobs still queued do not need to wait for a free worker to be
+        # cancelled
+        job.future.cancel()
+        with self.lock:
+            if job.state in ("queued", "done", "failed"):
+                job.state = "cancelled"
+            self._remove_file(job)
+        return job
+
+    def _remove_file(self, job: ExportJob):
+        if job.state != "running" and os.path.exists(job.path):
+            os.unlink(job.path)
+
+    def _expire(self):
+        """
+        Forget the oldest finished jobs, deleting their results
+        """
+        finished = sorted(
+                (job for job in self.jobs.values() if job.state not in ("queued", "running")),
+                key=lambda job: job.created)
+        for job in finished[:-self.MAX_FINISHED]:
+            self._remove_file(job)
+            del self.jobs[job.id]
+
+    def shutdown(self):
+        """
+        Cancel all jobs and remove the spool directory.
+
+        Queued jobs are dropped, and running jobs stop at their next write
+        """
+        for job in self.list():
+            job.cancelled.set()
+            if job.future is not None:
+                job.future.cancel()
+        self.executor.shutdown(wait=True)
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
@@ -0,0 +1,147 @@
+from typing import Any, Dict, Hashable, Iterable, List
+import array
+import numpy
+
+# Explorer dimensions for which facets are computed
+DIMENSIONS = ("rep_memo", "level", "trange", "var")
+
+
+class Codes:
+    """
+    Dictionary encoding of the values of a summary column
+    """
+    def __init__(self):
+        self.values: List[Hashable] = []
+        self.positions: Dict[Hashable, int] = {}
+        self.rows = array.array("I")
+
+    def add(self, value: Hashable):
+        pos = self.positions.get(value)
+        if pos is None:
+            pos = self.positions[value] = len(self.values)
+            self.values.append(value)
+        self.rows.append(pos)
+
+
+class FacetIndex:
+    """
+    Columnar copy of the explorer summary, used to compute, for each value of
+    each explorer dimension, the number of values and their datetime range
+    under a filter.
+
+    The index is built in one pass over the summary, and filtering is
+    vectorized with numpy. Summary entries are selected when their datetime
+    range overlaps the filter, as the explorer does, so counts can be higher
+    than the number of values in a datetime range
+    """
+    def __init__(self, explorer):
+        codes = {name: Codes() for name in DIMENSIONS}
+        ana_ids = array.array("q")
+        lats = array.array("d")
+        lons = array.array("d")
+        counts = array.array("q")
+        dtmins = []
+        dtmaxs = []
+        for rec in explorer.query_summary_all({}):
+            ana_ids.append(rec["ana_id"])
+            lats.append(rec["lat"])
+            lons.append(rec["lon"])
+            codes["rep_memo"].add(rec["rep_memo"])
+            codes["level"].add(tuple(rec["level"]))
+            codes["trange"].add(tuple(rec["trange"]))
+            codes["var"].add(rec["var"])
+            counts.append(rec["count"])
+            dtmins.append(rec["datetimemin"])
+            dtmaxs.append(rec["datetimemax"])
+
+        self.values = {name: column.values for name, column in codes.items()}
+        self.positions = {name: column.positions for name, column in codes.items()}
+        self.codes = {name: numpy.frombuffer(column.rows, dtype=numpy.uint32) for name, column in codes.items()}
+        self.ana_id = numpy.frombuffer(ana_ids, dtype=numpy.int64)
+        self.lat = numpy.frombuffer(lats, dtype=float)
+        self.lon = numpy.frombuffer(lons, dtype=float)
+        self.count = numpy.frombuffer(counts, dtype=numpy.int64)
+        self.datetime_min = numpy.array(dtmins, dtype="datetime64[s]")
+        self.datetime_max = numpy.array(dtmaxs, dtype="datetime64[s]")
+
+    def __len__(self):
+        return len(self.count)
+
+    def _mask(self, flt) -> numpy.ndarray:
+        """
+        Select the summary entries matching a session.Filter
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        for name, value in (
+                ("rep_memo", flt.rep_memo),
+                ("level", None if flt.level is None else tuple(flt.level)),
+                ("trange", None if flt.trange is None else tuple(flt.trange)),
+                ("var", flt.var)):
+            if value is None:
+                continue
+            pos = self.positions[name].get(value)
+            if pos is None:
+                mask[:] = False
+                return mask
+            mask &= self.codes[name] == pos
+        if flt.ana_id is not None:
+            mask &= self.ana_id == int(flt.ana_id)
+        if flt.latmin is not None:
+            mask &= self.lat >= float(flt.latmin)
+        if flt.latmax is not None:
+            mask &= self.lat <= float(flt.latmax)
+        if flt.lonmin is not None:
+            mask &= self.lon >= float(flt.lonmin)
+        if flt.lonmax is not None:
+            mask &= self.lon <= float(flt.lonmax)
+        if flt.datemin is not None:
+            mask &= self.datetime_max >= numpy.datetime64(flt.datemin, "s")
+        if flt.datemax is not None:
+            mask &= self.datetime_min <= numpy.datetime64(flt.datemax, "s")
+        return mask
+
+    def facets(self, flt, changes: Iterable[Dict[str, Any]] = ()) -> Dict[str, Dict[Hashable, List[Any]]]:
+        """
+        Return, for each dimension, a dict mapping the values selected by flt
+        to a [count, datetime_min, datetime_max] list.
+
+        changes are summary entries of values added to the database after
+        the explorer was built, as kept by changes.ExplorerChanges
+        """
+        mask = self._mask(flt)
+        count = self.count[mask]
+        dtmin = self.datetime_min[mask]
+        dtmax = self.datetime_max[mask]
+        res = {}
+        for name in DIMENSIONS:
+            codes = self.codes[name][mask]
+            values = self.values[name]
+            if not len(codes):
+                res[name] = {}
+                continue
+            # Sort by code, to aggregate the entries of each code with reduceat
+            order = numpy.argsort(codes, kind="stable")
+            present, starts = numpy.unique(codes[order], return_index=True)
+            counts = numpy.add.reduceat(count[order], starts)
+            mins = numpy.minimum.reduceat(dtmin[order], starts)
+            maxs = numpy.maximum.reduceat(dtmax[order], starts)
+            res[name] = {
+                values[pos]: [int(n), dmin.item(), dmax.item()]
+                for pos, n, dmin, dmax in zip(present.tolist(), counts, mins, maxs)
+            }
+
+        for entry in changes:
+            if not flt.matches_summary(entry):
+                continue
+            for name in DIMENSIONS:
+                value = entry[name]
+                if name in ("level", "trange"):
+                    value = tuple(value)
+                facet = res[name].get(value)
+                if facet is None:
+                    res[name][value] = [entry["count"], entry["datetimemin"], entry["datetimemax"]]
+                else:
+                    facet[0] += entry["count"]
+                    facet[1] = min(facet[1], entry["datetimemin"])
+                    facet[2] = max(facet[2], entry["datetimemax"])
+        return res
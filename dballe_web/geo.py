@@ -0,0 +1,244 @@
+from typing import Dict, Iterable, List, Tuple
+import collections
+import math
+import numpy
+
+# Station tuples are as returned by session.station_to_dict:
+# (report, id, lat, lon, ident)
+Station = Tuple[str, int, float, float, str]
+
+
+def lon_ranges(lonmin: float, lonmax: float) -> List[Tuple[float, float]]:
+    """
+    Normalize a longitude range to one or two ranges within [-180, 180],
+    splitting it if it crosses the antimeridian
+    """
+    width = lonmax - lonmin
+    if width >= 360:
+        return [(-180.0, 180.0)]
+    lonmin = (lonmin + 180) % 360 - 180
+    lonmax = lonmin + width
+    if lonmax <= 180:
+        return [(lonmin, lonmax)]
+    return [(lonmin, 180.0), (-180.0, lonmax - 360)]
+
+
+class StationIndex:
+    """
+    Uniform grid index of station positions, to quickly find the stations
+    inside a bounding box
+    """
+    def __init__(self, stations: Iterable[Station], cell_size: float = 1.0):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], List[Station]] = collections.defaultdict(list)
+        self.count = 0
+        for station in stations:
+            self.cells[self._cell(station[2], station[3])].append(station)
+            self.count += 1
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def query(self, latmin: float, latmax: float, lonmin: float, lonmax: float) -> List[Station]:
+        """
+        Return the stations inside the given bounding box
+        """
+        res: List[Station] = []
+        for lomin, lomax in lon_ranges(lonmin, lonmax):
+            self._query(latmin, latmax, lomin, lomax, res)
+        return res
+
+    def _query(self, latmin: float, latmax: float, lonmin: float, lonmax: float, res: List[Station]):
+        y0, x0 = self._cell(latmin, lonmin)
+        y1, x1 = self._cell(latmax, lonmax)
+
+        def add_cell(y: int, x: int, stations: List[Station]):
+            if y0 < y < y1 and x0 < x < x1:
+                # The cell is entirely inside the box
+                res.extend(stations)
+            else:
+                res.extend(s for s in stations if latmin <= s[2] <= latmax and lonmin <= s[3] <= lonmax)
+
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self.cells):
+            # The box covers more cells than there are populated ones
+            for (y, x), stations in self.cells.items():
+                if y0 <= y <= y1 and x0 <= x <= x1:
+                    add_cell(y, x, stations)
+        else:
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    stations = self.cells.get((y, x))
+                    if stations:
+                        add_cell(y, x, stations)
+
+
+def project(lat, lon):
+    """
+    Project positions to Web Mercator coordinates normalized to [0, 1].
+
+    Works both on scalars and on numpy arrays
+    """
+    x = numpy.asarray(lon, dtype=float) / 360 + 0.5
+    sin = numpy.clip(numpy.sin(numpy.radians(lat)), -0.9999, 0.9999)
+    y = 0.5 - 0.25 * numpy.log((1 + sin) / (1 - sin)) / math.pi
+    return x, numpy.clip(y, 0.0, 1.0)
+
+
+def unproject(x: float, y: float) -> Tuple[float, float]:
+    """
+    Inverse of project
+    """
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return lat, (x - 0.5) * 360
+
+
+class ClusterLevel:
+    """
+    Clusters at one zoom level, as parallel arrays
+    """
+    def __init__(self, x, y, count, station, zoom):
+        # Projected position of the cluster
+        self.x = x
+        self.y = y
+        # Number of stations in the cluster
+        self.count = count
+        # Position of the station in ClusterIndex.stations, or -1 for clusters
+        # of more than one station
+        self.station = station
+        # Zoom level at which the cluster was formed
+        self.zoom = zoom
+
+    def to_dict(self, pos: int, stations: List[Station]):
+        station = int(self.station[pos])
+        if station != -1:
+            s = stations[station]
+            return {
+                "lat": s[2],
+                "lon": s[3],
+                "count": 1,
+                "station": s,
+            }
+        lat, lon = unproject(float(self.x[pos]), float(self.y[pos]))
+        return {
+            "lat": lat,
+            "lon": lon,
+            "count": int(self.count[pos]),
+            # Zoom level at which the cluster breaks up
+            "expansion_zoom": int(self.zoom[pos]) + 1,
+        }
+
+
+class ClusterIndex:
+    """
+    Hierarchical clustering of stations for map display, in the style of
+    supercluster.
+
+    Each zoom level is computed from the one above it, from max_zoom down to
+    min_zoom, merging the clusters that fall in the same grid cell of radius
+    pixels, for tiles of extent pixels
+    """
+    def __init__(
+            self, stations: Iterable[Station], radius: float = 40, extent: float = 256,
+            min_zoom: int = 0, max_zoom: int = 16):
+        self.stations = list(stations)
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.levels: Dict[int, ClusterLevel] = {}
+
+        count = len(self.stations)
+        lat = numpy.fromiter((s[2] for s in self.stations), dtype=float, count=count)
+        lon = numpy.fromiter((s[3] for s in self.stations), dtype=float, count=count)
+        x, y = project(lat, lon)
+        level = ClusterLevel(
+                x, y, numpy.ones(count, dtype=numpy.int64), numpy.arange(count),
+                numpy.full(count, max_zoom + 1))
+        self.levels[max_zoom + 1] = level
+
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            level = self._cluster(level, radius / (extent * 2 ** zoom), zoom)
+            self.levels[zoom] = level
+
+    def _cluster(self, level: ClusterLevel, r: float, zoom: int) -> ClusterLevel:
+        """
+        Merge the clusters of a level that fall in the same cell of size r
+        """
+        if not len(level.x):
+            return level
+        keys = (numpy.floor(level.x / r).astype(numpy.int64) << 32) | numpy.floor(level.y / r).astype(numpy.int64)
+        cells, inverse = numpy.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        weights = level.count.astype(float)
+        count = numpy.bincount(inverse, weights=weights)
+        x = numpy.bincount(inverse, weights=level.x * weights) / count
+        y = numpy.bincount(inverse, weights=level.y * weights) / count
+        # Cells with only one cluster keep it as it is
+        members = numpy.bincount(inverse)
+        first = numpy.empty(len(cells), dtype=numpy.int64)
+        first[inverse[::-1]] = numpy.arange(len(inverse) - 1, -1, -1)
+        single = members == 1
+        return ClusterLevel(
+                numpy.where(single, level.x[first], x),
+                numpy.where(single, level.y[first], y),
+                count.astype(numpy.int64),
+                numpy.where(single, level.station[first], -1),
+                numpy.where(single, level.zoom[first], zoom))
+
+    def query(self, zoom: int, latmin: float, latmax: float, lonmin: float, lonmax: float) -> List[dict]:
+        """
+        Return the clusters inside a bounding box at the given zoom level.
+
+        Zoom levels past max_zoom return all stations unclustered
+        """
+        level = self._level(zoom)
+        mask = numpy.zeros(len(level.x), dtype=bool)
+        for lomin, lomax in lon_ranges(lonmin, lonmax):
+            x0, y0 = project(latmax, lomin)
+            x1, y1 = project(latmin, lomax)
+            mask |= (level.x >= x0) & (level.x <= x1) & (level.y >= y0) & (level.y <= y1)
+        return [level.to_dict(pos, self.stations) for pos in numpy.flatnonzero(mask)]
+
+    def query_tile(self, zoom: int, x: int, y: int) -> List[dict]:
+        """
+        Return the clusters inside a web map tile.
+
+        Tiles do not overlap, so that each cluster is found in only one tile
+        """
+        level = self._level(zoom)
+        size = 1 / 2 ** zoom
+        x0, y0 = x * size, y * size
+        # The last row and column of tiles also contain the edge of the map
+        x1 = x0 + size if x < 2 ** zoom - 1 else math.inf
+        y1 = y0 + size if y < 2 ** zoom - 1 else math.inf
+        mask = (level.x >= x0) & (level.x < x1) & (level.y >= y0) & (level.y < y1)
+        return [level.to_dict(pos, self.stations) for pos in numpy.flatnonzero(mask)]
+
+    def _level(self, zoom: int) -> ClusterLevel:
+        return self.levels[min(max(zoom, self.min_zoom), self.max_zoom + 1)]
+
+
+def cluster_to_feature(cluster: dict, current: bool) -> dict:
+    """
+    Convert a result of ClusterIndex queries to a GeoJSON point feature.
+
+    current tells whether the stations are selected by the current filter
+    """
+    properties = {
+        "count": cluster["count"],
+        "current": current,
+    }
+    station = cluster.get("station")
+    if station is not None:
+        properties["report"] = station[0]
+        properties["id"] = station[1]
+        properties["ident"] = station[4]
+    else:
+        properties["expansion_zoom"] = cluster["expansion_zoom"]
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            # Centimeter precision is more than enough for a map
+            "coordinates": [round(cluster["lon"], 7), round(cluster["lat"], 7)],
+        },
+        "properties": properties,
+    }
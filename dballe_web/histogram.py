@@ -0,0 +1,150 @@
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional
+import array
+import collections
+import datetime
+import numpy
+
+# Number of values read before merging them into the histogram
+CHUNK_SIZE = 65536
+
+
+def _key(rec) -> tuple:
+    return (rec["rep_memo"], tuple(rec["level"]), tuple(rec["trange"]), rec["var"])
+
+
+class TimeHistogram:
+    """
+    Number of values per day, for each combination of report, level, time
+    range and variable.
+
+    Counts are stored sparsely, as parallel arrays of key position, day
+    (as a proleptic Gregorian ordinal) and count, sorted by key and day.
+
+    Station and area filters are not taken into account, since per-station
+    counts would be too large to keep in memory
+    """
+    def __init__(self, keys: List[tuple], key: numpy.ndarray, day: numpy.ndarray, count: numpy.ndarray):
+        self.keys = keys
+        self.key = key
+        self.day = day
+        self.count = count
+
+    @classmethod
+    def build(cls, tr, callback: Optional[Callable[[int], bool]] = None) -> Optional["TimeHistogram"]:
+        """
+        Build the histogram with one pass over all the values in the database.
+
+        If given, callback is called every CHUNK_SIZE values with the number
+        of values read so far. If it returns False, the build stops and
+        returns None
+        """
+        keys: List[tuple] = []
+        positions: Dict[Hashable, int] = {}
+        parts = []
+        pending = array.array("q")
+        read = 0
+
+        def flush():
+            cells, counts = numpy.unique(numpy.frombuffer(pending, dtype=numpy.int64), return_counts=True)
+            parts.append((cells, counts))
+
+        for rec in tr.query_data({}):
+            key = _key(rec)
+            pos = positions.get(key)
+            if pos is None:
+                pos = positions[key] = len(keys)
+                keys.append(key)
+            # Encode key and day in a single integer, to count them with numpy
+            pending.append((pos << 32) | rec["datetime"].toordinal())
+            if len(pending) >= CHUNK_SIZE:
+                flush()
+                pending = array.array("q")
+                read += CHUNK_SIZE
+                if callback is not None and not callback(read):
+                    return None
+        if pending:
+            flush()
+
+        if parts:
+            cells = numpy.concatenate([p[0] for p in parts])
+            counts = numpy.concatenate([p[1] for p in parts])
+            cells, inverse = numpy.unique(cells, return_inverse=True)
+            counts = numpy.bincount(inverse.ravel(), weights=counts).astype(numpy.int64)
+        else:
+            cells = numpy.zeros(0, dtype=numpy.int64)
+            counts = numpy.zeros(0, dtype=numpy.int64)
+        return cls(keys, cells >> 32, cells & 0xffffffff, counts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Encode as a JSON-serializable dict, for snapshots
+        """
+        return {
+            "keys": self.keys,
+            "key": self.key.tolist(),
+            "day": self.day.tolist(),
+            "count": self.count.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TimeHistogram":
+        return cls(
+            [(k[0], tuple(k[1]), tuple(k[2]), k[3]) for k in data["keys"]],
+            numpy.array(data["key"], dtype=numpy.int64),
+            numpy.array(data["day"], dtype=numpy.int64),
+            numpy.array(data["count"], dtype=numpy.int64))
+
+    def _key_mask(self, flt) -> numpy.ndarray:
+        """
+        Select the keys matching the report, level, time range and variable
+        of a session.Filter
+        """
+        level = None if flt.level is None else tuple(flt.level)
+        trange = None if flt.trange is None else tuple(flt.trange)
+        return numpy.fromiter((
+            (flt.rep_memo is None or key[0] == flt.rep_memo)
+            and (level is None or key[1] == level)
+            and (trange is None or key[2] == trange)
+            and (flt.var is None or key[3] == flt.var)
+            for key in self.keys), dtype=bool, count=len(self.keys))
+
+    def query(self, flt, changes: Iterable[Dict[str, Any]] = ()) -> Optional[Dict[str, Any]]:
+        """
+        Return the daily counts of values matching flt, ignoring its datetime
+        range, as a dict with the first day and a list of counts.
+
+        changes are summary entries of values added to the database after
+        the histogram was built, as kept by changes.ExplorerChanges
+
+        Returns None if no values match
+        """
+        if len(self.keys):
+            mask = self._key_mask(flt)[self.key]
+        else:
+            mask = numpy.zeros(0, dtype=bool)
+        day = self.day[mask]
+        count = self.count[mask]
+
+        # Ignore the datetime range of the filter when adding changes
+        extra = collections.Counter()
+        for entry in changes:
+            if self._matches(flt, entry):
+                extra.update(entry["days"])
+        if extra:
+            day = numpy.concatenate((day, numpy.fromiter(extra.keys(), dtype=numpy.int64, count=len(extra))))
+            count = numpy.concatenate((count, numpy.fromiter(extra.values(), dtype=numpy.int64, count=len(extra))))
+        if not len(day):
+            return None
+
+        first = int(day.min())
+        counts = numpy.bincount(day - first, weights=count).astype(numpy.int64)
+        return {
+            "start": datetime.date.fromordinal(first).isoformat(),
+            "counts": counts.tolist(),
+        }
+
+    def _matches(self, flt, rec) -> bool:
+        return ((flt.rep_memo is None or rec["rep_memo"] == flt.rep_memo)
+                and (flt.level is None or tuple(rec["level"]) == tuple(flt.level))
+                and (flt.trange is None or tuple(rec["trange"]) == tuple(flt.trange))
+                and (flt.var is None or rec["var"] == flt.var))
@@ -1,15 +1,41 @@
 # from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+import array
+import base64
+import bisect
+import collections
+import concurrent.futures
 import contextlib
+import hashlib
+import json
+import secrets
 import threading
 import datetime
+import functools
 import logging
+import multiprocessing
+import os
 import shlex
+import sqlite3
+import queue
+import time
+import numpy
 import dballe
 from dballe import dbacsv
+from .snapshot import ExplorerSnapshots, db_change_marker, sqlite_is_wal, sqlite_path
+from . import arrow
+from .changes import ExplorerChanges
+from .facets import FacetIndex
+from .histogram import TimeHistogram
+from .geo import ClusterIndex, StationIndex, cluster_to_feature
 
 log = logging.getLogger(__name__)
 
 
+# Reference for the times of time series
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
 def _export_datetime(dt):
     return dt.strftime("%Y-%m-%d %H:%M:%S") if dt is not None else None
 
@@ -20,6 +46,17 @@ def _import_datetime(val):
     return datetime.datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
 
 
+def _import_value(vt: str, value):
+    """
+    Convert a value coming from the web interface to the type of its variable
+    """
+    if vt == "decimal":
+        return float(value)
+    elif vt == "integer":
+        return int(value)
+    return value
+
+
 def describe_var(code: str) -> str:
     """
     Return a human-readable description for a varcode
@@ -45,8 +82,13 @@ class Filter:
         self.lonmin = None
         self.lonmax = None
 
-    def to_tuple(self, o):
-        return (self.ana_id, self.rep_memo, self.level, self.trange, self.var, self.datemin, self.datemax)
+    def to_tuple(self):
+        return (
+            self.ana_id, self.rep_memo,
+            None if self.level is None else tuple(self.level),
+            None if self.trange is None else tuple(self.trange),
+            self.var, self.datemin, self.datemax,
+            self.latmin, self.latmax, self.lonmin, self.lonmax)
 
     def to_record(self):
         res = {}
@@ -89,6 +131,38 @@ class Filter:
             "lonmax": self.lonmax,
         }
 
+    def matches_summary(self, entry) -> bool:
+        """
+        Check if a summary entry matches the filter.
+
+        entry is a dict with the same keys as explorer summary entries, plus
+        lat and lon. As in the explorer, entries match a datetime range if
+        they overlap it
+        """
+        if self.ana_id is not None and entry["ana_id"] != int(self.ana_id):
+            return False
+        if self.rep_memo is not None and entry["rep_memo"] != self.rep_memo:
+            return False
+        if self.level is not None and tuple(entry["level"]) != tuple(self.level):
+            return False
+        if self.trange is not None and tuple(entry["trange"]) != tuple(self.trange):
+            return False
+        if self.var is not None and entry["var"] != self.var:
+            return False
+        if self.datemin is not None and entry["datetimemax"] < self.datemin:
+            return False
+        if self.datemax is not None and entry["datetimemin"] > self.datemax:
+            return False
+        if self.latmin is not None and entry["lat"] < float(self.latmin):
+            return False
+        if self.latmax is not None and entry["lat"] > float(self.latmax):
+            return False
+        if self.lonmin is not None and entry["lon"] < float(self.lonmin):
+            return False
+        if self.lonmax is not None and entry["lon"] > float(self.lonmax):
+            return False
+        return True
+
     @classmethod
     def from_dict(cls, data):
         res = cls()
@@ -110,135 +184,1410 @@ def station_to_dict(s):
     return (s.report, s.id, s.lat, s.lon, s.ident)
 
 
+def entry_station(entry):
+    """
+    Return the station of a summary entry, in the same format as
+    station_to_dict
+    """
+    return (entry["rep_memo"], entry["ana_id"], entry["lat"], entry["lon"], entry["ident"])
+
+
+def station_data_to_dict(rec):
+    var = rec["variable"]
+    row = {
+        "i": rec["context_id"],
+        "c": var.code,
+        "v": var.get(),
+        "vt": var.info.type,
+    }
+    if var.info.type in ("integer", "decimal"):
+        row["vs"] = var.info.scale
+    return row
+
+
+def facets_to_dict(facets):
+    """
+    Encode the result of FacetIndex.facets as lists of [value, count,
+    datetime_min, datetime_max]
+    """
+    return {
+        name: [[value, count, _export_datetime(dtmin), _export_datetime(dtmax)]
+               for value, (count, dtmin, dtmax) in values.items()]
+        for name, values in facets.items()
+    }
+
+
+def data_to_dict(rec):
+    var = rec["variable"]
+    row = {
+        "i": rec["context_id"],
+        "r": rec["rep_memo"],
+        "s": rec["ana_id"],
+        "c": var.code,
+        "l": tuple(rec["level"]),
+        "t": tuple(rec["trange"]),
+        "d": _export_datetime(rec["datetime"]),
+        "v": var.get(),
+        "vt": var.info.type,
+    }
+    if var.info.type in ("integer", "decimal"):
+        row["vs"] = var.info.scale
+    return row
+
+
+class WaitStats:
+    """
+    Accumulate statistics about time spent waiting for a connection
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.active = 0
+
+    def record(self, elapsed: float):
+        with self.lock:
+            self.count += 1
+            self.total += elapsed
+            if elapsed > self.max:
+                self.max = elapsed
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "wait_total": self.total,
+                "wait_max": self.max,
+                "wait_avg": self.total / self.count if self.count else 0.0,
+                "active": self.active,
+            }
+
+
+# Connections of export worker processes, by database URL
+_worker_dbs: Dict[str, "dballe.DB"] = {}
+
+
+def _worker_db(db_url: str) -> "dballe.DB":
+    db = _worker_dbs.get(db_url)
+    if db is None:
+        db = _worker_dbs[db_url] = dballe.DB.connect(db_url)
+    return db
+
+
+def _encode_messages(db_url: str, format: str, query) -> Tuple[bytes, int]:
+    """
+    Export the messages selected by query as the given dballe.Exporter
+    format, in an export worker process.
+
+    Returns the encoded messages and their number
+    """
+    exporter = dballe.Exporter(format)
+    chunks = []
+    with _worker_db(db_url).transaction() as tr:
+        for row in tr.query_messages(query):
+            chunks.append(exporter.to_binary(row.message))
+    return b"".join(chunks), len(chunks)
+
+
+def enable_wal(db_url: str) -> bool:
+    """
+    Switch a sqlite database to write-ahead logging.
+
+    In WAL mode readers do not block the writer, and the writer does not
+    block readers, so long reads can run alongside commits. The journal mode
+    is stored in the database file, and applies to all its connections.
+
+    Returns True if the database is now in WAL mode
+    """
+    path = sqlite_path(db_url)
+    if path is None or not os.path.exists(path):
+        return False
+    if sqlite_is_wal(path):
+        return True
+    try:
+        with contextlib.closing(sqlite3.connect(path, timeout=30)) as db:
+            mode = db.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    except sqlite3.Error as e:
+        log.warning("%s: cannot enable write-ahead logging: %s", path, e)
+        return False
+    if mode.lower() != "wal":
+        log.warning("%s: cannot enable write-ahead logging: journal mode is still %s", path, mode)
+        return False
+    log.warning("%s: switched to write-ahead logging; the change is stored in the database file", path)
+    return True
+
+
+class ConnectionPool:
+    """
+    Pool of DB-All.e connections.
+
+    Up to ``size`` readers can run queries at the same time, each on its own
+    connection. Writes are serialized on a single dedicated connection.
+
+    Parallel readers on sqlite databases need write-ahead logging, so that
+    readers holding a transaction open, like exports and explorer rebuilds,
+    do not make commits fail with SQLITE_BUSY. Databases are only switched to
+    WAL if ``wal`` is True, since the change is permanent, affects all other
+    programs using the file, and is unsafe on network filesystems. Without
+    WAL, readers are serialized with the writer.
+    """
+    def __init__(self, db_url: str, size: int = 4, wal: bool = False):
+        self.db_url = db_url
+        self.size = max(1, size)
+        self.writer = dballe.DB.connect(db_url)
+        self.write_lock = threading.Lock()
+        # Protects the connection count
+        self.lock = threading.Lock()
+        # Every new connection to an in-memory database opens a different,
+        # empty database: in that case, readers share the writer connection
+        self.shared = ":memory:" in db_url
+        # Without WAL, sqlite readers would make commits fail: share the
+        # writer connection in that case, too
+        path = sqlite_path(db_url)
+        if not self.shared and path is not None:
+            if not (enable_wal(db_url) if wal else sqlite_is_wal(path)):
+                self.shared = True
+        if self.shared:
+            self.size = 1
+        self.read_slots = threading.BoundedSemaphore(self.size)
+        self.idle = queue.LifoQueue()
+        self.connections = 0
+        self.read_stats = WaitStats()
+        self.write_stats = WaitStats()
+
+    def _get_reader(self):
+        """
+        Get an idle read connection, connecting a new one if needed
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        if self.shared:
+            return self.writer
+        with self.lock:
+            self.connections += 1
+            count = self.connections
+        log.debug("Opening read connection %d/%d to %s", count, self.size, self.db_url)
+        return dballe.DB.connect(self.db_url)
+
+    @contextlib.contextmanager
+    def _track(self, stats: WaitStats, start: float):
+        stats.record(time.monotonic() - start)
+        with stats.lock:
+            stats.active += 1
+        try:
+            yield
+        finally:
+            with stats.lock:
+                stats.active -= 1
+
+    @contextlib.contextmanager
+    def reader(self):
+        """
+        Borrow a connection for reading
+        """
+        start = time.monotonic()
+        with self.read_slots:
+            db = self._get_reader()
+            try:
+                if self.shared:
+                    with self.write_lock:
+                        with self._track(self.read_stats, start):
+                            yield db
+                else:
+                    with self._track(self.read_stats, start):
+                        yield db
+            finally:
+                self.idle.put(db)
+
+    @contextlib.contextmanager
+    def write(self):
+        """
+        Borrow the connection used for writing
+        """
+        start = time.monotonic()
+        with self.write_lock:
+            with self._track(self.write_stats, start):
+                yield self.writer
+
+    @contextlib.contextmanager
+    def block_writes(self):
+        """
+        Keep writes from happening, for example while a reader establishes
+        its view of the database.
+
+        Readers of a shared connection already hold the write lock
+        """
+        if self.shared:
+            yield
+        else:
+            with self.write_lock:
+                yield
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "connections": 1 if self.shared else self.connections,
+            "read": self.read_stats.to_dict(),
+            "write": self.write_stats.to_dict(),
+        }
+
+
+class RebuildProgress:
+    """
+    Progress of a background explorer or time histogram rebuild
+    """
+    def __init__(self, last_duration=None):
+        self.started = time.monotonic()
+        self.phase = "starting"
+        self.stations = 0
+        self.rows = None
+        # Number of rows expected, if known
+        self.total = None
+        self.error = None
+        # Duration of the previous rebuild, used to estimate the end time
+        self.last_duration = last_duration
+
+    def to_dict(self):
+        elapsed = time.monotonic() - self.started
+        if self.last_duration is not None:
+            eta = max(0.0, self.last_duration - elapsed)
+        else:
+            eta = None
+        return {
+            "phase": self.phase,
+            "stations": self.stations,
+            "rows": self.rows,
+            "total": self.total,
+            "elapsed": elapsed,
+            "eta": eta,
+            "error": self.error,
+        }
+
+
 class Session:
-    def __init__(self, db_url):
+    # Number of explorer_to_dict results to keep in memory
+    EXPLORER_CACHE_SIZE = 16
+    # Number of summary entries of added values after which the explorer is
+    # rebuilt to include them
+    EXPLORER_CHANGES_LIMIT = 10000
+    # Number of encoded station tiles to keep in memory
+    STATION_TILES_CACHE_SIZE = 1024
+    # Number of pages of data to keep in memory
+    DATA_PAGES_CACHE_SIZE = 32
+
+    # Default memory budget for data waiting to be sent to a client during
+    # exports
+    EXPORT_BUFFER_SIZE = 4 * 1024 * 1024
+
+    def __init__(
+            self, db_url, pool_size=4, cache_dir=None, export_workers=None, export_buffer_size=None,
+            sqlite_wal=False):
         self.db_url = db_url
-        self.db = dballe.DB.connect(self.db_url)
-        self.db_lock = threading.Lock()
+        # Number of processes encoding messages in BUFR and CREX exports
+        self.export_workers = export_workers or 1
+        # Pool of export_workers processes, started when first needed
+        self._export_executor = None
+        self._export_executor_lock = threading.Lock()
+        # Bytes of exported data that can wait to be sent to a client
+        self.export_buffer_size = export_buffer_size or self.EXPORT_BUFFER_SIZE
+        self.pool = ConnectionPool(self.db_url, size=pool_size, wal=sqlite_wal)
+        self.db = self.pool.writer
         self.filter = Filter()
         self.data_limit = 20
+        # Serialize access to the explorer, which is not thread safe
+        self.explorer_lock = threading.RLock()
         self.explorer = dballe.DBExplorer()
         self.initialized = False
+        # Future for the explorer rebuild currently running in the background
+        self.current_future = None
+        self.rebuild_lock = threading.Lock()
+        self.rebuild_progress = None
+        self.last_rebuild_duration = None
+        # Set when the database changed while a rebuild was running
+        self.rebuild_again = False
+        # Values added to the database after the explorer was built
+        self.explorer_changes = ExplorerChanges()
+        # First layer of explorer_changes not included in the explorer
+        self.explorer_changes_seq = 0
+        # Incremented every time the explorer contents change
+        self.generation = 0
+        # Pages of data, as (rows, next cursor) by filter, data limit and
+        # cursor. Edits are written through to them
+        self.data_pages = collections.OrderedDict()
+        # Database change marker when data_pages was last known to be valid
+        self.data_pages_marker = None
+        # Incremented every time data_pages is cleared, so that pages being
+        # read at that time are not cached
+        self.data_pages_epoch = 0
+        self.data_pages_lock = threading.Lock()
+        # Cached explorer_to_dict results, by generation, filter and data limit
+        self.explorer_cache = collections.OrderedDict()
+        # Distinguishes ETags generated by different runs
+        self.etag_salt = secrets.token_hex(8)
+        # Incremented after every write to the database
+        self.data_version = 0
+        # Spatial index of all stations, as (generation, StationIndex)
+        self._station_index = None
+        # IDs of the stations selected by the current filter, as (explorer
+        # ETag, set of IDs)
+        self._enabled_station_ids = None
+        # Clustering indices of the stations selected and not selected by the
+        # current filter, as (explorer ETag, ClusterIndex, ClusterIndex)
+        self._station_clusters = None
+        # Encoded station tiles, as (ETag, GeoJSON) by (explorer ETag, z, x, y)
+        self.station_tiles = collections.OrderedDict()
+        # Columnar copy of the explorer summary, to compute facet counts
+        self.facet_index = None
+        # Daily value counts, built in the background after the explorer
+        self.time_histogram = None
+        # First layer of explorer_changes not included in time_histogram
+        self.histogram_changes_seq = 0
+        # Incremented every time a new time_histogram is published
+        self.histogram_generation = 0
+        # Future, progress and cancellation event of the time histogram build
+        # running in the background
+        self.histogram_future = None
+        self.histogram_progress = None
+        self.histogram_cancel = None
+        self.last_histogram_duration = None
+        # Snapshots of the explorer state, to start up without scanning the
+        # whole database
+        self.snapshots = None
+        if cache_dir is not None and ":memory:" not in db_url:
+            self.snapshots = ExplorerSnapshots(cache_dir, db_url)
+            self._load_snapshot()
 
     @contextlib.contextmanager
     def read_transaction(self):
-        with self.db_lock:
-            with self.db.transaction() as tr:
+        with self.pool.reader() as db:
+            with db.transaction() as tr:
                 yield tr
 
     @contextlib.contextmanager
-    def write_transaction(self):
-        with self.db_lock:
-            with self.db.transaction() as tr:
-                yield tr
+    def write_transaction(self, added: Optional[list] = None):
+        """
+        Run a write transaction.
 
-    def _revalidate(self):
-        try:
-            with self.read_transaction() as tr:
-                with self.explorer.rebuild() as updater:
-                    updater.add_db(tr)
-            self.current_future = None
+        Values appended to ``added`` during the transaction, as returned by
+        _replace_data, are recorded in the explorer after the commit, while
+        writes are still blocked: this way explorer rebuilds know exactly
+        which of them they have read
+        """
+        with self.pool.write() as db:
+            try:
+                with db.transaction() as tr:
+                    yield tr
+                if added:
+                    self._explorer_add_values(added)
+            finally:
+                # Increment while holding the write lock, so that concurrent
+                # writes are all counted
+                self.data_version += 1
+
+    def data_marker(self) -> str:
+        """
+        Return a string that changes when the database contents change.
+
+        Changes made by other processes are only noticed for sqlite databases
+        """
+        marker = db_change_marker(self.db_url)
+        if marker is None:
+            marker = f"{self.etag_salt}:{self.data_version}"
+        return marker
+
+    def _load_snapshot(self):
+        """
+        Initialize the explorer from a snapshot, refreshing it in the
+        background if the database has changed since it was taken
+        """
+        snapshot = self.snapshots.load()
+        if snapshot is None:
+            return
+        log.info("Explorer loaded from %s", self.snapshots.path)
+        self.explorer = snapshot.explorer
+        self.facet_index = FacetIndex(snapshot.explorer)
+        self.time_histogram = snapshot.histogram
+        self.generation += 1
+        self.initialized = True
+        self.last_rebuild_duration = snapshot.duration
+        if not snapshot.is_fresh:
+            log.info("Explorer snapshot may be out of date: refreshing it in the background")
+            self.revalidate()
+        elif snapshot.histogram is None:
+            # The snapshot was saved before its histogram was ready
+            self._start_histogram_build(
+                    snapshot.explorer.all_stats.count,
+                    (snapshot.explorer_json, snapshot.marker, snapshot.duration))
+
+    def _revalidate(self, progress: RebuildProgress):
+        """
+        Build a new explorer from the database contents, and replace the
+        current one with it
+        """
+        # Compute the change marker before reading, so that changes happening
+        # during the rebuild make the snapshot stale
+        marker = db_change_marker(self.db_url)
+        explorer = dballe.DBExplorer()
+        with self.read_transaction() as tr:
+            # Counting stations is cheap, and gives early feedback on the size
+            # of the database
+            progress.phase = "stations"
+            # The first query fixes what the transaction sees: run it with
+            # writes blocked, to know which changes the rebuild includes
+            with self.pool.block_writes():
+                for rec in tr.query_stations({}):
+                    progress.stations += 1
+                with self.explorer_lock:
+                    start_seq = self.explorer_changes.checkpoint()
+            progress.phase = "summary"
+            with explorer.rebuild() as updater:
+                updater.add_db(tr)
+            progress.rows = explorer.all_stats.count
+        progress.phase = "facets"
+        facet_index = FacetIndex(explorer)
+
+        snapshot = None
+        if self.snapshots is not None:
+            # Save before publishing the new explorer, while no other thread
+            # can access it. The snapshot is saved again with the time
+            # histogram once that is ready
+            progress.phase = "saving"
+            snapshot = (explorer.to_json(), marker, time.monotonic() - progress.started)
+            self._save_snapshot(snapshot, None)
+
+        with self.explorer_lock:
+            explorer.set_filter(self.filter.to_record())
+            self.explorer = explorer
+            self.facet_index = facet_index
+            self.explorer_changes_seq = start_seq
+            self._discard_changes()
+            self.generation += 1
             self.initialized = True
-        except Exception:
+        # Pages may have been read with the station list of the previous
+        # explorer, or before changes made by others
+        self._clear_data_pages()
+        progress.phase = "done"
+
+        # The previous histogram, with the changes since it was built, keeps
+        # serving requests until the new one is ready
+        self._start_histogram_build(progress.rows, snapshot)
+
+    def _save_snapshot(self, snapshot, histogram: Optional[TimeHistogram]):
+        """
+        Save the (explorer JSON, change marker, rebuild duration) snapshot
+        tuple, with the given time histogram
+        """
+        explorer_json, marker, duration = snapshot
+        try:
+            self.snapshots.save(explorer_json, histogram, marker, duration)
+        except Exception as e:
+            log.warning("%s: cannot save explorer snapshot: %s", self.snapshots.path, e)
+
+    def _discard_changes(self):
+        """
+        Drop the layers of explorer_changes that are included in both the
+        explorer and the time histogram.
+
+        Call with explorer_lock held
+        """
+        seq = self.explorer_changes_seq
+        if self.time_histogram is not None:
+            seq = min(seq, self.histogram_changes_seq)
+        self.explorer_changes.discard(seq)
+
+    def _build_histogram(self, progress: RebuildProgress, cancel: threading.Event, snapshot):
+        """
+        Build a new time histogram from the database contents, and replace
+        the current one with it, unless cancel is set first
+        """
+        def callback(rows):
+            progress.rows = rows
+            return not cancel.is_set()
+
+        progress.phase = "histogram"
+        progress.rows = 0
+        with self.read_transaction() as tr:
+            # As in _revalidate, fix what the transaction sees with writes
+            # blocked, to know which changes the histogram includes
+            with self.pool.block_writes():
+                for rec in tr.query_stations({}):
+                    progress.stations += 1
+                with self.explorer_lock:
+                    start_seq = self.explorer_changes.checkpoint()
+            histogram = TimeHistogram.build(tr, callback)
+        if histogram is None:
+            progress.phase = "cancelled"
+            return
+
+        with self.rebuild_lock:
+            # Checked with the lock held, so that a cancelled build never
+            # replaces the histogram of a newer one
+            if cancel.is_set():
+                progress.phase = "cancelled"
+                return
+            if snapshot is not None:
+                self._save_snapshot(snapshot, histogram)
+            with self.explorer_lock:
+                self.time_histogram = histogram
+                self.histogram_changes_seq = start_seq
+                self._discard_changes()
+                self.histogram_generation += 1
+        progress.phase = "done"
+
+    def _histogram_thread(
+            self, future: concurrent.futures.Future, progress: RebuildProgress, cancel: threading.Event, snapshot):
+        try:
+            self._build_histogram(progress, cancel, snapshot)
+        except Exception as e:
+            log.exception("Time histogram build failed")
+            progress.error = str(e)
+            future.set_exception(e)
+        else:
+            if progress.phase == "done":
+                self.last_histogram_duration = time.monotonic() - progress.started
+                log.info("Time histogram built in %.1fs", self.last_histogram_duration)
+            future.set_result(None)
+
+    def _start_histogram_build(self, total: Optional[int], snapshot=None) -> concurrent.futures.Future:
+        """
+        Start building the time histogram in the background, cancelling the
+        build already running, if any.
+
+        total is the number of values expected, for progress reports.
+        snapshot, if not None, is the (explorer JSON, change marker, rebuild
+        duration) tuple to save again with the new histogram
+        """
+        with self.rebuild_lock:
+            self._cancel_histogram_build()
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            progress = RebuildProgress(self.last_histogram_duration)
+            progress.total = total
+            cancel = threading.Event()
+            self.histogram_future = future
+            self.histogram_progress = progress
+            self.histogram_cancel = cancel
+            threading.Thread(
+                    target=self._histogram_thread, args=(future, progress, cancel, snapshot),
+                    name="histogram-rebuild", daemon=True).start()
+            return future
+
+    def _cancel_histogram_build(self):
+        """
+        Stop the time histogram build running in the background, if any.
+
+        Call with rebuild_lock held
+        """
+        if self.histogram_cancel is not None:
+            self.histogram_cancel.set()
+            self.histogram_cancel = None
+
+    def _rebuild_thread(self, future: concurrent.futures.Future, progress: RebuildProgress):
+        try:
+            self._revalidate(progress)
+        except Exception as e:
             log.exception("Revalidate failed")
+            progress.error = str(e)
+            future.set_exception(e)
+        else:
+            self.last_rebuild_duration = time.monotonic() - progress.started
+            log.info("Explorer rebuilt in %.1fs", self.last_rebuild_duration)
+            future.set_result(None)
+
+        with self.rebuild_lock:
+            rebuild_again, self.rebuild_again = self.rebuild_again, False
+        if rebuild_again:
+            self.revalidate()
+
+    def revalidate(self) -> concurrent.futures.Future:
+        """
+        Start rebuilding the explorer in the background, if a rebuild is not
+        already running.
+
+        The current explorer keeps serving requests until the new one is
+        ready.
+        """
+        with self.rebuild_lock:
+            if self.current_future is not None and not self.current_future.done():
+                return self.current_future
+            # A new histogram is built after the new explorer: stop
+            # scanning the database for one that would be replaced anyway
+            self._cancel_histogram_build()
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            self.rebuild_progress = RebuildProgress(self.last_rebuild_duration)
+            self.current_future = future
+            # Use a daemon thread, so that quitting does not wait for a long
+            # rebuild to finish
+            threading.Thread(
+                    target=self._rebuild_thread, args=(future, self.rebuild_progress),
+                    name="explorer-rebuild", daemon=True).start()
+            return future
+
+    def invalidate(self):
+        """
+        Rebuild the explorer after the database changed in a way that cannot
+        be applied incrementally
+        """
+        with self.rebuild_lock:
+            if self.current_future is not None and not self.current_future.done():
+                # The running rebuild may have missed the change
+                self.rebuild_again = True
+                return
+        self.revalidate()
+
+    def _explorer_add_values(self, values):
+        """
+        Update the explorer after new values have been added to the
+        database.
+
+        Values are kept aside, aggregated by summary entry, and merged with
+        the explorer contents when queried. When too many summary entries
+        accumulate, the explorer is rebuilt in the background to absorb them.
+        """
+        with self.explorer_lock:
+            for rec in values:
+                self.explorer_changes.add(rec)
+            self.generation += 1
+            pending = self.explorer_changes.count_since(self.explorer_changes_seq)
+        if pending > self.EXPLORER_CHANGES_LIMIT:
+            self.invalidate()
+
+    def _explorer_changes(self):
+        """
+        Return the summary entries of values added after the explorer was
+        built
+        """
+        return self.explorer_changes.since(self.explorer_changes_seq)
+
+    def _histogram_changes(self):
+        """
+        Return the summary entries of values added after the time histogram
+        was built
+        """
+        return self.explorer_changes.since(self.histogram_changes_seq)
+
+    def _explorer_changes_stats(self, stats):
+        """
+        Adjust explorer statistics for values added after the explorer was
+        built.
+
+        Returns the datetime_min, datetime_max, count statistics and the
+        summary entries matching the current filter
+        """
+        dtmin = stats.datetime_min
+        dtmax = stats.datetime_max
+        count = stats.count
+        matching = []
+        for entry in self._explorer_changes():
+            if not self.filter.matches_summary(entry):
+                continue
+            count += entry["count"]
+            if dtmin is None or entry["datetimemin"] < dtmin:
+                dtmin = entry["datetimemin"]
+            if dtmax is None or entry["datetimemax"] > dtmax:
+                dtmax = entry["datetimemax"]
+            matching.append(entry)
+        return dtmin, dtmax, count, matching
+
+    def wait_rebuild(self, timeout=None):
+        """
+        Wait for the current background rebuild, if any, to finish
+        """
+        future = self.current_future
+        if future is not None:
+            concurrent.futures.wait([future], timeout=timeout)
+
+    def wait_histogram(self, timeout=None):
+        """
+        Wait for the current background rebuild, if any, and for the time
+        histogram build following it to finish
+        """
+        self.wait_rebuild(timeout)
+        future = self.histogram_future
+        if future is not None:
+            concurrent.futures.wait([future], timeout=timeout)
+
+    def histogram_status(self):
+        """
+        Return the progress of the background time histogram build, or None
+        if no build is running and the last one was successful
+        """
+        progress = self.histogram_progress
+        if progress is None or (progress.phase in ("done", "cancelled") and progress.error is None):
+            return None
+        return progress.to_dict()
+
+    def rebuild_status(self):
+        """
+        Return the progress of the background rebuild, or None if no rebuild
+        is running and the last one was successful
+        """
+        progress = self.rebuild_progress
+        if progress is None or (progress.phase == "done" and progress.error is None):
+            return None
+        return progress.to_dict()
+
+    def explorer_state(self):
+        """
+        Return the ETag and the contents of explorer_to_dict.
+
+        Results are cached until the explorer changes. The ETag is None if the
+        explorer is not initialized yet.
+        """
+        if not self.initialized:
+            return None, self._explorer_to_dict()
+
+        with self.explorer_lock:
+            key = (self.generation, self.filter.to_tuple(), self.data_limit)
+            cached = self.explorer_cache.get(key)
+            if cached is not None:
+                self.explorer_cache.move_to_end(key)
+                return cached
+
+            etag = hashlib.sha1(f"{self.etag_salt}:{key!r}".encode()).hexdigest()
+            res = (etag, self._explorer_to_dict())
+
+            # Results for older generations can never be used again
+            for old in [k for k in self.explorer_cache if k[0] != self.generation]:
+                del self.explorer_cache[old]
+            self.explorer_cache[key] = res
+            while len(self.explorer_cache) > self.EXPLORER_CACHE_SIZE:
+                self.explorer_cache.popitem(last=False)
+            return res
+
+    def explorer_delta(self, since: Optional[str]):
+        """
+        Return the ETag and the contents of explorer_to_dict, with the station
+        lists replaced by the IDs of stations enabled and disabled since the
+        state with ETag ``since``.
+
+        Full station lists are returned if ``since`` is not known, or if the
+        set of stations has changed since then.
+        """
+        etag, data = self.explorer_state()
+        if etag is None or since is None:
+            return etag, data
+
+        with self.explorer_lock:
+            old = None
+            for key, (old_etag, old_data) in self.explorer_cache.items():
+                if old_etag == since and key[0] == self.generation:
+                    old = old_data
+                    break
+        if old is None:
+            return etag, data
+
+        old_ids = frozenset(s[1] for s in old["stations"])
+        new_ids = frozenset(s[1] for s in data["stations"])
+        res = {k: v for k, v in data.items() if k not in ("stations", "stations_disabled")}
+        res["stations_delta"] = {
+            "since": since,
+            "enabled": sorted(new_ids - old_ids),
+            "disabled": sorted(old_ids - new_ids),
+        }
+        return etag, res
+
+    def get_time_histogram(self):
+        """
+        Return the daily value counts for the current filter, ignoring its
+        datetime range, and the number of values in its datetime range.
+
+        Station and area filters are not applied to the counts
+        """
+        with self.explorer_lock:
+            histogram = self.time_histogram
+            flt = self.filter
+            changes = list(self._histogram_changes())
+        if histogram is None:
+            return None, None
+        res = histogram.query(flt, changes)
+        if res is None:
+            return None, 0
+        first = datetime.date.fromisoformat(res["start"]).toordinal()
+        start = 0 if flt.datemin is None else max(0, flt.datemin.toordinal() - first)
+        end = len(res["counts"]) if flt.datemax is None else max(0, flt.datemax.toordinal() - first + 1)
+        return res, sum(res["counts"][start:end])
+
+    def data_days(self, flt: Filter) -> Optional[List[datetime.date]]:
+        """
+        Return the days that may have data selected by flt, in its datetime
+        range, or None if the time histogram is not available.
+
+        Station and area filters are not applied, so some of the days may
+        still turn out to have no data
+        """
+        with self.explorer_lock:
+            histogram = self.time_histogram
+            changes = list(self._histogram_changes())
+        if histogram is None:
+            return None
+        res = histogram.query(flt, changes)
+        if res is None:
             return []
+        first = datetime.date.fromisoformat(res["start"]).toordinal()
+        days = []
+        for pos, count in enumerate(res["counts"]):
+            day = datetime.date.fromordinal(first + pos)
+            if not count:
+                continue
+            if flt.datemin is not None and day < flt.datemin.date():
+                continue
+            if flt.datemax is not None and day > flt.datemax.date():
+                continue
+            days.append(day)
+        return days
+
+    def station_index(self) -> StationIndex:
+        """
+        Return the spatial index of all stations, rebuilding it when the
+        explorer changes
+        """
+        with self.explorer_lock:
+            if self._station_index is None or self._station_index[0] != self.generation:
+                stations = [station_to_dict(s) for s in self.explorer.all_stations]
+                known = {s[1] for s in stations}
+                for entry in self._explorer_changes():
+                    if entry["ana_id"] not in known:
+                        known.add(entry["ana_id"])
+                        stations.append(entry_station(entry))
+                self._station_index = (self.generation, StationIndex(stations))
+            return self._station_index[1]
+
+    def stations_in_bbox(self, latmin: float, latmax: float, lonmin: float, lonmax: float):
+        """
+        Return the stations inside a bounding box, as two lists of stations
+        selected and not selected by the current filter
+        """
+        index = self.station_index()
+        with self.explorer_lock:
+            etag, explorer = self.explorer_state()
+            if etag is None or self._enabled_station_ids is None or self._enabled_station_ids[0] != etag:
+                self._enabled_station_ids = (etag, {s[1] for s in explorer["stations"]})
+            enabled_ids = self._enabled_station_ids[1]
+        enabled = []
+        disabled = []
+        for station in index.query(latmin, latmax, lonmin, lonmax):
+            if station[1] in enabled_ids:
+                enabled.append(station)
+            else:
+                disabled.append(station)
+        return enabled, disabled
+
+    def _station_cluster_indices(self):
+        """
+        Return the explorer ETag and the clustering indices of the stations
+        selected and not selected by the current filter
+        """
+        with self.explorer_lock:
+            etag, explorer = self.explorer_state()
+            if etag is None or self._station_clusters is None or self._station_clusters[0] != etag:
+                self._station_clusters = (
+                    etag, ClusterIndex(explorer["stations"]), ClusterIndex(explorer["stations_disabled"]))
+            return self._station_clusters
+
+    def station_clusters(self, zoom: int, latmin: float, latmax: float, lonmin: float, lonmax: float):
+        """
+        Return the clusters of stations inside a bounding box at a map zoom
+        level, as two lists for stations selected and not selected by the
+        current filter
+        """
+        etag, current, disabled = self._station_cluster_indices()
+        return (current.query(zoom, latmin, latmax, lonmin, lonmax),
+                disabled.query(zoom, latmin, latmax, lonmin, lonmax))
+
+    def station_tile(self, z: int, x: int, y: int):
+        """
+        Return the ETag and the encoded GeoJSON of a web map tile with the
+        station clusters for zoom level z.
+
+        Tiles are cached until the explorer state changes. The ETag is None if
+        the explorer is not initialized yet.
+        """
+        etag, current, disabled = self._station_cluster_indices()
+        key = (etag, z, x, y)
+        with self.explorer_lock:
+            cached = self.station_tiles.get(key)
+            if cached is not None:
+                self.station_tiles.move_to_end(key)
+                return cached
+
+        features = []
+        for clusters, is_current in ((current, True), (disabled, False)):
+            for cluster in clusters.query_tile(z, x, y):
+                features.append(cluster_to_feature(cluster, is_current))
+        data = json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":")).encode()
+        if etag is None:
+            return None, data
+
+        res = (hashlib.sha1(f"{etag}:{z}/{x}/{y}".encode()).hexdigest(), data)
+        with self.explorer_lock:
+            # Tiles for older explorer states can never be used again
+            if self.station_tiles and next(iter(self.station_tiles))[0] != etag:
+                for old in [k for k in self.station_tiles if k[0] != etag]:
+                    del self.station_tiles[old]
+            self.station_tiles[key] = res
+            while len(self.station_tiles) > self.STATION_TILES_CACHE_SIZE:
+                self.station_tiles.popitem(last=False)
+        return res
 
     def explorer_to_dict(self):
+        """
+        Return a dict describing the explorer state.
+
+        The result is shared with other callers, and must not be modified
+        """
+        return self.explorer_state()[1]
+
+    def _explorer_to_dict(self):
         if not self.initialized:
             return {"stations": [], "rep_memo": [], "level": [], "trange": [], "var": []}
 
         def level_key(l):
-            return tuple((str(x) if x is not None else "") for x in l)
+            return tuple((x is not None, x or 0) for x in l)
 
         def trange_key(t):
-            return tuple((str(x) if x is not None else "") for x in t)
+            return tuple((x is not None, x or 0) for x in t)
 
-        # Dispatch stations between currently selectable and all other stations
-        current_stations_set = frozenset(self.explorer.stations)
-        stations = []
-        stations_disabled = []
-        for station in self.explorer.all_stations:
-            if station in current_stations_set:
-                stations.append(station_to_dict(station))
-            else:
-                stations_disabled.append(station_to_dict(station))
+        with self.explorer_lock:
+            dtmin, dtmax, count, changed = self._explorer_changes_stats(self.explorer.stats)
+            changed_stations = {entry["ana_id"] for entry in changed}
 
-        stats = self.explorer.stats
+            # Dispatch stations between currently selectable and all other stations
+            current_stations_set = frozenset(self.explorer.stations)
+            stations = []
+            stations_disabled = []
+            known_stations = set()
+            for station in self.explorer.all_stations:
+                known_stations.add(station.id)
+                if station in current_stations_set or station.id in changed_stations:
+                    stations.append(station_to_dict(station))
+                else:
+                    stations_disabled.append(station_to_dict(station))
+
+            reports = list(self.explorer.reports)
+            levels = [tuple(x) for x in self.explorer.levels]
+            tranges = [tuple(x) for x in self.explorer.tranges]
+            varcodes = list(self.explorer.varcodes)
+
+            # Add what only appears in values added after the explorer was
+            # built
+            for entry in self._explorer_changes():
+                if entry["ana_id"] not in known_stations:
+                    known_stations.add(entry["ana_id"])
+                    if entry["ana_id"] in changed_stations:
+                        stations.append(entry_station(entry))
+                    else:
+                        stations_disabled.append(entry_station(entry))
+            if changed:
+                reports = sorted(set(reports).union(e["rep_memo"] for e in changed))
+                levels = sorted(set(levels).union(e["level"] for e in changed), key=level_key)
+                tranges = sorted(set(tranges).union(e["trange"] for e in changed), key=trange_key)
+                varcodes = sorted(set(varcodes).union(e["var"] for e in changed))
+
+            facets = None
+            if self.facet_index is not None:
+                facets = self.facet_index.facets(self.filter, self._explorer_changes())
 
         return {
             "filter": self.filter.to_dict(),
             "filter_cmdline": " ".join(shlex.quote("{}={}".format(k, v)) for k, v in self.filter.to_record().items()),
             "stations": stations,
             "stations_disabled": stations_disabled,
-            "rep_memo": self.explorer.reports,
-            "level": [(tuple(x), dballe.describe_level(*x)) for x in self.explorer.levels],
-            "trange": [(tuple(x), dballe.describe_trange(*x)) for x in self.explorer.tranges],
-            "var": [(code, describe_var(code)) for code in self.explorer.varcodes],
+            "rep_memo": reports,
+            "level": [(x, dballe.describe_level(*x)) for x in levels],
+            "trange": [(x, dballe.describe_trange(*x)) for x in tranges],
+            "var": [(code, describe_var(code)) for code in varcodes],
             "stats": {
-                "datetime_min": _export_datetime(stats.datetime_min),
-                "datetime_max": _export_datetime(stats.datetime_max),
-                "count": stats.count,
+                "datetime_min": _export_datetime(dtmin),
+                "datetime_max": _export_datetime(dtmax),
+                "count": count,
             },
+            "facets": None if facets is None else facets_to_dict(facets),
             "initialized": self.initialized,
             "data_limit": self.data_limit,
             "db_url": self.db_url,
         }
 
-    def export(self, format, out):
+    def export(self, format, out, flt: Optional[Filter] = None):
+        """
+        Export the data selected by flt to out. If flt is None, export the
+        currently selected data.
+
+        Returns the number of messages exported, or None if it is not known
+        """
+        if flt is None:
+            flt = self.filter
+        with self.exporter(format) as export:
+            return export(out, flt)
+
+    def export_executor(self) -> Optional[concurrent.futures.Executor]:
+        """
+        Return the pool of export_workers processes encoding BUFR and CREX
+        exports, or None if messages are to be encoded in the calling thread
+        """
+        # Worker processes read with their own connections, which is only
+        # possible if the database can be read by many connections while it
+        # is written
+        if self.export_workers <= 1 or self.pool.shared:
+            return None
+        with self._export_executor_lock:
+            if self._export_executor is None:
+                # Do not fork a process that is running threads
+                self._export_executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.export_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._export_executor
+
+    def shutdown(self):
+        """
+        Stop the export worker processes
+        """
+        with self._export_executor_lock:
+            if self._export_executor is not None:
+                self._export_executor.shutdown(wait=False, cancel_futures=True)
+                self._export_executor = None
+
+    @contextlib.contextmanager
+    def exporter(self, format):
         """
-        Export the currently selected data to out.
+        Context manager yielding a function export(out, flt) that works like
+        export, to export many parts of the data sharing the same read
+        transaction
         """
+        executor = self.export_executor() if format in ("bufr", "crex") else None
+        with self.read_transaction() as tr:
+            yield functools.partial(self._export, tr, format, executor)
+
+    def _export(self, tr, format, executor, out, flt: Filter):
         if format in ("bufr", "crex"):
-            exporter = dballe.Exporter(format.upper())
-            with self.read_transaction() as tr:
-                for row in tr.query_messages(self.filter.to_record()):
-                    out.write(exporter.to_binary(row.message))
+            return self._export_messages(tr, format.upper(), executor, out, flt.to_record())
         elif format == "csv":
-            with self.read_transaction() as tr:
-                dbacsv.export(tr, self.filter.to_record(), out)
+            dbacsv.export(tr, flt.to_record(), out)
+        elif format in ("parquet", "arrow"):
+            return arrow.export(tr, flt.to_record(), format, out)
+
+    def _export_messages(self, tr, format: str, executor, out, query):
+        """
+        Export the data selected by query as messages encoded in the given
+        dballe.Exporter format.
+
+        If executor is not None, the messages of each station are read and
+        encoded by its worker processes, each with its own connection, and
+        written to out in station order. Encoding does not hold the GIL of
+        this process, but the stations are not read in the same transaction.
+        At most twice as many stations as workers are kept in memory at any
+        time.
+
+        Returns the number of messages exported
+        """
+        count = 0
+        stations = []
+        if executor is not None and "ana_id" not in query:
+            stations = [rec["ana_id"] for rec in tr.query_stations(query)]
+        if len(stations) < 2:
+            exporter = dballe.Exporter(format)
+            for row in tr.query_messages(query):
+                out.write(exporter.to_binary(row.message))
+                count += 1
+            return count
+
+        def write(future):
+            nonlocal count
+            data, messages = future.result()
+            if data:
+                out.write(data)
+            count += messages
+
+        max_pending = self.export_workers * 2
+        pending = collections.deque()
+        try:
+            for ana_id in stations:
+                station_query = dict(query)
+                station_query["ana_id"] = ana_id
+                pending.append(executor.submit(_encode_messages, self.db_url, format, station_query))
+                if len(pending) >= max_pending:
+                    write(pending.popleft())
+            while pending:
+                write(pending.popleft())
+        finally:
+            # On errors, do not encode what would not be written anyway
+            for future in pending:
+                future.cancel()
+        return count
 
     def init(self):
         if not self.initialized:
             log.debug("Async setup")
-            self._revalidate()
+            self.revalidate()
         return self.explorer_to_dict()
 
     def set_filter(self, flt):
         log.debug("Session.set_filter")
-        self.filter = Filter.from_dict(flt)
-        self.explorer.set_filter(self.filter.to_record())
+        self._set_filter(flt)
         return self.explorer_to_dict()
 
+    def set_filter_delta(self, flt, since: Optional[str]):
+        """
+        Set the filter, and return the ETag of the new explorer state and
+        explorer_delta(since)
+        """
+        log.debug("Session.set_filter_delta %r", since)
+        self._set_filter(flt)
+        return self.explorer_delta(since)
+
+    def _set_filter(self, flt):
+        flt = Filter.from_dict(flt)
+        with self.explorer_lock:
+            self.filter = flt
+            self.explorer.set_filter(flt.to_record())
+
     def refresh_filter(self):
         log.debug("Session.refresh_filter")
-        self._revalidate()
+        # Changes made by others are not noticed for all databases
+        self._clear_data_pages()
+        self.revalidate()
         return self.explorer_to_dict()
 
-    def get_data(self):
-        log.debug("Session.get_data")
+    def _clear_data_pages(self):
+        """
+        Drop all cached data pages
+        """
+        with self.data_pages_lock:
+            self.data_pages.clear()
+            self.data_pages_epoch += 1
 
+    def _data_query(self):
+        """
+        Return the query for the currently selected data
+        """
         query = self.filter.to_record()
         if self.data_limit is not None:
             query["limit"] = self.data_limit
+        return query
+
+    def get_data(self):
+        log.debug("Session.get_data")
+
+        res = []
+        with self.read_transaction() as tr:
+            for rec in tr.query_data(self._data_query()):
+                res.append(data_to_dict(rec))
+        return res
+
+    def write_data_ndjson(self, out, chunk_size: int = 65536):
+        """
+        Write the currently selected data to out as newline-delimited JSON,
+        one value per line, in the same format as get_data.
+
+        Lines are written in chunks of about chunk_size bytes. The first
+        chunks are smaller, so that clients can start showing values early.
+
+        Returns the number of values written
+        """
+        log.debug("Session.write_data_ndjson")
+        buf = []
+        size = 0
+        count = 0
+        threshold = 1024
+        with self.read_transaction() as tr:
+            for rec in tr.query_data(self._data_query()):
+                count += 1
+                line = json.dumps(data_to_dict(rec), separators=(",", ":")) + "\n"
+                buf.append(line)
+                size += len(line)
+                if size >= threshold:
+                    out.write("".join(buf).encode())
+                    buf = []
+                    size = 0
+                    threshold = min(threshold * 4, chunk_size)
+        if buf:
+            out.write("".join(buf).encode())
+        return count
+
+    def _encode_cursor(self, ana_id: int, dt: datetime.datetime, skip: int) -> str:
+        """
+        Encode a data page cursor.
+
+        The cursor points after the first ``skip`` values of station
+        ``ana_id`` at datetime ``dt``
+        """
+        data = [ana_id, _export_datetime(dt), skip, self._filter_digest()]
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    def _decode_cursor(self, cursor: str):
+        """
+        Decode a data page cursor into (ana_id, datetime, skip), or return None
+        if it does not belong to the current filter
+        """
+        try:
+            ana_id, dt, skip, digest = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValueError("invalid data page cursor")
+        if digest != self._filter_digest():
+            return None
+        return int(ana_id), _import_datetime(dt), int(skip)
+
+    def current_data_cursor(self, cursor: Optional[str]) -> Optional[str]:
+        """
+        Return cursor if it points into the currently selected data, or None
+        if it was made for a different filter, in which case get_data_page
+        serves the first page.
+
+        Raises ValueError if the cursor is not valid
+        """
+        if not cursor or self._decode_cursor(cursor) is None:
+            return None
+        return cursor
+
+    def _filter_digest(self) -> str:
+        return hashlib.sha1(repr(self.filter.to_tuple()).encode()).hexdigest()[:12]
+
+    def get_data_page(self, cursor: Optional[str] = None):
+        """
+        Return a page of data_limit values of the currently selected data,
+        starting at the given cursor.
+
+        Values are sorted by station and datetime. Each page is read with
+        one query per station, starting from the position in the cursor, so
+        reading a page costs the same regardless of its position.
+
+        A cursor made for a different filter gives the first page: use
+        current_data_cursor to tell when that happens.
+
+        Pages are cached, and kept up to date when values are edited.
+
+        Returns the list of values, and the cursor for the next page, or None
+        if this is the last page.
+        """
+        log.debug("Session.get_data_page %r", cursor)
+        key = (self.filter.to_tuple(), self.data_limit, cursor)
+        marker = db_change_marker(self.db_url)
+        with self.data_pages_lock:
+            if marker != self.data_pages_marker:
+                # The database was changed by someone else
+                self.data_pages.clear()
+                self.data_pages_marker = marker
+            cached = self.data_pages.get(key)
+            if cached is not None:
+                self.data_pages.move_to_end(key)
+                return list(cached[0]), cached[1]
+            version = (self.data_version, self.data_pages_epoch)
+
+        rows, next_cursor = self._read_data_page(cursor)
+
+        with self.data_pages_lock:
+            # Pages read while the database was being changed, or while the
+            # cache was being cleared, may be stale
+            if (self.data_version, self.data_pages_epoch) == version:
+                self.data_pages[key] = (rows, next_cursor)
+                while len(self.data_pages) > self.DATA_PAGES_CACHE_SIZE:
+                    self.data_pages.popitem(last=False)
+        return list(rows), next_cursor
+
+    def _read_data_page(self, cursor: Optional[str]):
+        page_size = self.data_limit or 20
+        start = self._decode_cursor(cursor) if cursor else None
+
         res = []
+        count = 0
+        # Position of the last value in the page, as station, datetime and
+        # number of values seen at that station and datetime
+        last = start
+        with self.read_transaction() as tr:
+            if self.initialized:
+                # The explorer knows which stations have data for the current
+                # filter
+                station_ids = sorted(s[1] for s in self.explorer_to_dict()["stations"])
+            else:
+                # Until the explorer is first built, ask the database
+                station_ids = sorted(rec["ana_id"] for rec in tr.query_stations(self.filter.to_record()))
+            if start is not None:
+                station_ids = station_ids[bisect.bisect_left(station_ids, start[0]):]
+
+            for ana_id in station_ids:
+                query = self.filter.to_record()
+                query["ana_id"] = ana_id
+                skip = 0
+                if start is not None and ana_id == start[0]:
+                    # Resume from the cursor position
+                    query["datetimemin"] = start[1]
+                    skip = start[2]
+                # Fetch one more value, to know if there is a next page
+                query["limit"] = page_size - count + skip + 1
+                for rec in tr.query_data(query):
+                    dt = rec["datetime"]
+                    if skip and dt == start[1]:
+                        skip -= 1
+                        continue
+                    if count == page_size:
+                        return res, self._encode_cursor(*last)
+                    if last is not None and last[0] == ana_id and last[1] == dt:
+                        last = (ana_id, dt, last[2] + 1)
+                    else:
+                        last = (ana_id, dt, 1)
+                    res.append(data_to_dict(rec))
+                    count += 1
+        return res, None
+
+    def _write_through_data_pages(self, rows, added: bool):
+        """
+        Update the cached data pages after values have been edited.
+
+        rows are the edited values. If added is True, some of them are new,
+        and since pages would shift, all cached pages are dropped
+        """
+        changed = {row["i"]: row for row in rows}
+        with self.data_pages_lock:
+            if added:
+                self.data_pages.clear()
+            else:
+                for page, next_cursor in self.data_pages.values():
+                    for pos, row in enumerate(page):
+                        new = changed.get(row["i"])
+                        if new is not None:
+                            page[pos] = new
+            # The cached pages include our own changes
+            self.data_pages_marker = db_change_marker(self.db_url)
+
+    def get_data_columns(self, columns):
+        """
+        Add the currently selected data to a columns.DataColumns accumulator,
+        and return it
+        """
+        log.debug("Session.get_data_columns")
+        with self.read_transaction() as tr:
+            for rec in tr.query_data(self._data_query()):
+                columns.add(rec)
+        return columns
+
+    def get_timeseries(self, ana_id: int, varcode: str, level, trange, datemin=None, datemax=None):
+        """
+        Return times, as seconds since the epoch, and values of a variable of a
+        station, as sorted numpy arrays
+        """
+        query = {"ana_id": ana_id, "var": varcode, "level": level, "trange": trange}
+        if datemin is not None:
+            query["datetimemin"] = datemin
+        if datemax is not None:
+            query["datetimemax"] = datemax
+        times = array.array("d")
+        values = array.array("d")
         with self.read_transaction() as tr:
             for rec in tr.query_data(query):
                 var = rec["variable"]
-                row = {
-                    "i": rec["context_id"],
-                    "r": rec["rep_memo"],
-                    "s": rec["ana_id"],
-                    "c": var.code,
-                    "l": tuple(rec["level"]),
-                    "t": tuple(rec["trange"]),
-                    "d": _export_datetime(rec["datetime"]),
-                    "v": var.get(),
-                    "vt": var.info.type,
-                }
-                if var.info.type in ("integer", "decimal"):
-                    row["vs"] = var.info.scale
-                res.append(row)
-        return res
+                if var.info.type == "string":
+                    raise ValueError(f"{varcode} has string values, and cannot be plotted")
+                times.append((rec["datetime"] - EPOCH).total_seconds())
+                values.append(var.get())
+        t = numpy.frombuffer(times, dtype=float)
+        v = numpy.frombuffer(values, dtype=float)
+        if len(t) > 1 and (numpy.diff(t) < 0).any():
+            order = numpy.argsort(t, kind="stable")
+            t, v = t[order], v[order]
+        return t, v
 
     def get_station_data(self, id_station):
         query = {"ana_id": id_station}
@@ -255,16 +1604,7 @@ class Session:
                 }
 
             for rec in tr.query_station_data(query):
-                var = rec["variable"]
-                row = {
-                    "i": rec["context_id"],
-                    "c": var.code,
-                    "v": var.get(),
-                    "vt": var.info.type,
-                }
-                if var.info.type in ("integer", "decimal"):
-                    row["vs"] = var.info.scale
-                res.append(row)
+                res.append(station_data_to_dict(rec))
             return station, res
 
     def get_station_data_attrs(self, id):
@@ -297,63 +1637,149 @@ class Session:
             res.append(row)
         return res
 
-    def replace_station_data(self, rec):
-        log.debug("Session.replace_station_data %r", rec)
+    # Station values and attributes are not part of the explorer summary, so
+    # changing them needs no explorer update
+
+    def _replace_station_data(self, tr, rec):
         r = {"ana_id": int(rec["ana_id"])}
-        if rec["vt"] == "decimal":
-            r[rec["varcode"]] = float(rec["value"])
-        elif rec["vt"] == "integer":
-            r[rec["varcode"]] = int(rec["value"])
-        else:
-            r[rec["varcode"]] = rec["value"]
-        with self.write_transaction() as tr:
-            tr.insert_station_data(r, can_replace=True, can_add_stations=False)
-        return self.get_station_data(rec["ana_id"])
+        r[rec["varcode"]] = _import_value(rec["vt"], rec["value"])
+        tr.insert_station_data(r, can_replace=True, can_add_stations=False)
 
-    def replace_data(self, rec):
-        log.debug("Session.replace_data %r", rec)
+    def _replace_data(self, tr, rec):
+        """
+        Replace or add a value.
+
+        Returns the value as needed by _explorer_add_values if it was added,
+        or None if it replaced an existing value
+        """
         r = {}
         r["ana_id"] = int(rec["ana_id"])
         r["level"] = tuple(rec["level"])
         r["trange"] = tuple(rec["trange"])
         r["datetime"] = _import_datetime(rec["datetime"])
-        if rec["vt"] == "decimal":
-            r[rec["varcode"]] = float(rec["value"])
-        elif rec["vt"] == "integer":
-            r[rec["varcode"]] = int(rec["value"])
-        else:
-            r[rec["varcode"]] = rec["value"]
+        r[rec["varcode"]] = _import_value(rec["vt"], rec["value"])
+        dt = r["datetime"]
+        # Replacing an existing value does not change the explorer summary
+        existing = tr.query_data({
+            "ana_id": r["ana_id"], "level": r["level"], "trange": r["trange"], "var": rec["varcode"],
+            "datetimemin": dt, "datetimemax": dt, "limit": 1})
+        is_new = not any(True for row in existing)
+        tr.insert_data(r, can_replace=True, can_add_stations=False)
+        if not is_new:
+            return None
+        for station in tr.query_stations({"ana_id": r["ana_id"]}):
+            return {
+                "ana_id": r["ana_id"],
+                "rep_memo": station["rep_memo"],
+                "lat": float(station["lat"]),
+                "lon": float(station["lon"]),
+                "ident": station["ident"],
+                "level": r["level"],
+                "trange": r["trange"],
+                "var": rec["varcode"],
+                "datetime": dt,
+            }
+        return None
+
+    def replace_station_data(self, rec):
+        log.debug("Session.replace_station_data %r", rec)
         with self.write_transaction() as tr:
-            tr.insert_data(r, can_replace=True, can_add_stations=False)
-        return self.get_data()
+            self._replace_station_data(tr, rec)
+        return self.get_station_data(rec["ana_id"])
+
+    def _edited_data(self, tr, rec):
+        """
+        Return the rows of the values changed by an edit
+        """
+        return [data_to_dict(row) for row in tr.query_data({
+            "ana_id": int(rec["ana_id"]), "level": tuple(rec["level"]), "trange": tuple(rec["trange"]),
+            "var": rec["varcode"], "datetime": _import_datetime(rec["datetime"])})]
+
+    def replace_data(self, rec):
+        """
+        Replace or add a value, and return the rows of the changed values
+        """
+        log.debug("Session.replace_data %r", rec)
+        added = []
+        with self.write_transaction(added) as tr:
+            value = self._replace_data(tr, rec)
+            if value is not None:
+                added.append(value)
+            rows = self._edited_data(tr, rec)
+        self._write_through_data_pages(rows, bool(added))
+        return rows
 
     def replace_station_data_attr(self, var_data, rec):
         log.debug("Session.replace_station_data_attr %r %r", var_data, rec)
-        r = {}
-        if rec["vt"] == "decimal":
-            r[rec["c"]] = float(rec["v"])
-        elif rec["vt"] == "integer":
-            r[rec["c"]] = int(rec["v"])
-        else:
-            r[rec["c"]] = rec["v"]
         with self.write_transaction() as tr:
-            tr.attr_insert_station(var_data["i"], r)
+            tr.attr_insert_station(var_data["i"], {rec["c"]: _import_value(rec["vt"], rec["v"])})
         return self.get_station_data_attrs(var_data["i"])
 
     def replace_data_attr(self, var_data, rec):
         log.debug("Session.replace_data_attr %r %r", var_data, rec)
-        r = {}
-        if rec["vt"] == "decimal":
-            r[rec["c"]] = float(rec["v"])
-        elif var_data["vt"] == "integer":
-            r[rec["c"]] = int(rec["v"])
-        else:
-            r[rec["c"]] = rec["v"]
         with self.write_transaction() as tr:
-            tr.attr_insert_data(var_data["i"], r)
+            tr.attr_insert_data(var_data["i"], {rec["c"]: _import_value(rec["vt"], rec["v"])})
         return self.get_data_attrs(var_data["i"])
 
+    def apply_edits(self, edits):
+        """
+        Apply a list of edits in a single transaction, and return the rows
+        they changed.
+
+        Each edit is a dict with the arguments of the corresponding replace_*
+        method, and a ``type`` key: data, station_data, data_attr or
+        station_data_attr. If an edit fails, none of them is applied.
+
+        The result has a list of changed rows for each type of edit: data rows
+        are as returned by get_data, station data rows are as returned by
+        get_station_data with the station ID in ``s``, and attribute rows have
+        the ID of the value they refer to in ``i``
+        """
+        log.debug("Session.apply_edits %d edits", len(edits))
+        res = {"data": [], "station_data": [], "data_attr": [], "station_data_attr": []}
+        added = []
+        with self.write_transaction(added) as tr:
+            for pos, edit in enumerate(edits):
+                try:
+                    kind = edit["type"]
+                    if kind == "data":
+                        rec = edit["rec"]
+                        value = self._replace_data(tr, rec)
+                        if value is not None:
+                            added.append(value)
+                        res["data"].extend(self._edited_data(tr, rec))
+                    elif kind == "station_data":
+                        rec = edit["rec"]
+                        self._replace_station_data(tr, rec)
+                        for row in tr.query_station_data({"ana_id": int(rec["ana_id"]), "var": rec["varcode"]}):
+                            res["station_data"].append(dict(station_data_to_dict(row), s=int(rec["ana_id"])))
+                    elif kind in ("data_attr", "station_data_attr"):
+                        var_data, rec = edit["var_data"], edit["rec"]
+                        value = _import_value(rec["vt"], rec["v"])
+                        if kind == "data_attr":
+                            tr.attr_insert_data(var_data["i"], {rec["c"]: value})
+                        else:
+                            tr.attr_insert_station(var_data["i"], {rec["c"]: value})
+                        res[kind].append({"i": var_data["i"], "c": rec["c"], "v": value, "vt": rec["vt"]})
+                    else:
+                        raise ValueError(f"unknown edit type {kind!r}")
+                except Exception as e:
+                    raise ValueError(f"edit {pos}: {e}") from e
+        if res["data"]:
+            self._write_through_data_pages(res["data"], bool(added))
+        return res
+
     def set_data_limit(self, limit):
+        """
+        Set the number of values shown per page, or None to show all values.
+
+        Returns the first page of values and the cursor to the next one, or
+        None, None if there is no limit
+        """
         log.debug("Session.set_data_limit %r", limit)
         self.data_limit = int(limit) if limit else None
-        return self.get_data()
+        if self.data_limit is None:
+            # The full list of values can be large: let the client stream it
+            # with write_data_ndjson instead
+            return None, None
+        return self.get_data_page()
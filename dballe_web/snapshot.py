@@ -0,0 +1,182 @@
+from typing import Optional
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import dballe
+from .histogram import TimeHistogram
+
+log = logging.getLogger(__name__)
+
+# Version of the snapshot file format
+SNAPSHOT_VERSION = 3
+
+
+def default_cache_dir() -> str:
+    """
+    Return the default directory for dballe-web caches
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "dballe-web")
+
+
+def sqlite_path(db_url: str) -> Optional[str]:
+    """
+    Return the pathname of the database file for a sqlite URL, or None if the
+    database is not a sqlite file
+    """
+    if not db_url.startswith("sqlite:"):
+        return None
+    path = db_url[7:]
+    if path.startswith("//"):
+        path = path[2:]
+    path = path.split("?", 1)[0]
+    if not path or path == ":memory:":
+        return None
+    return path
+
+
+def sqlite_is_wal(path: str) -> bool:
+    """
+    Check if a sqlite database file is in write-ahead logging mode, reading
+    the file format versions in its header
+    """
+    try:
+        with open(path, "rb") as fd:
+            header = fd.read(20)
+    except OSError:
+        return False
+    return header[:16] == b"SQLite format 3\0" and header[18:20] == b"\x02\x02"
+
+
+def db_change_marker(db_url: str) -> Optional[str]:
+    """
+    Return a string that changes when the database changes, or None if it
+    cannot be computed cheaply for this kind of database
+    """
+    path = sqlite_path(db_url)
+    if path is None:
+        return None
+    if sqlite_is_wal(path):
+        # Commits may only be in the write-ahead log, whose timestamp is not
+        # usable: sqlite deletes it on the last close and creates it again on
+        # the next open, even without writes. Copy the log to the database
+        # file first, and give up if that cannot be done completely
+        try:
+            with contextlib.closing(sqlite3.connect(path, timeout=1)) as db:
+                busy, logged, checkpointed = db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        except sqlite3.Error as e:
+            log.debug("%s: cannot checkpoint the write-ahead log: %s", path, e)
+            return None
+        if busy or logged != checkpointed:
+            return None
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+class Snapshot:
+    """
+    Explorer state loaded from a snapshot file
+    """
+    def __init__(
+            self, explorer: dballe.DBExplorer, explorer_json, histogram: Optional[TimeHistogram],
+            marker: Optional[str], current_marker: Optional[str], duration: Optional[float]):
+        self.explorer = explorer
+        # Serialized explorer contents, to save them again with a histogram
+        self.explorer_json = explorer_json
+        # None if the snapshot was saved before the histogram was built
+        self.histogram = histogram
+        # Database change marker when the snapshot was taken
+        self.marker = marker
+        # Database change marker now
+        self.current_marker = current_marker
+        # How long the rebuild took when the snapshot was saved
+        self.duration = duration
+
+    @property
+    def is_fresh(self) -> bool:
+        """
+        Check if the database did not change since the snapshot was taken
+        """
+        return self.marker is not None and self.marker == self.current_marker
+
+
+class ExplorerSnapshots:
+    """
+    Persist explorer contents to disk, to skip scanning the database at
+    startup
+    """
+    def __init__(self, cache_dir: str, db_url: str):
+        self.cache_dir = cache_dir
+        self.db_url = db_url
+        digest = hashlib.sha256(db_url.encode()).hexdigest()[:32]
+        self.path = os.path.join(cache_dir, f"explorer-{digest}.json")
+
+    def load(self) -> Optional[Snapshot]:
+        """
+        Load the snapshot for this database, if present and valid
+        """
+        try:
+            with open(self.path, "rt") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("%s: cannot read explorer snapshot: %s", self.path, e)
+            return None
+
+        if data.get("version") != SNAPSHOT_VERSION or data.get("db_url") != self.db_url:
+            return None
+
+        explorer = dballe.DBExplorer()
+        try:
+            with explorer.rebuild() as updater:
+                updater.add_json(data["explorer"])
+            histogram = None
+            if data["histogram"] is not None:
+                histogram = TimeHistogram.from_dict(data["histogram"])
+        except Exception as e:
+            log.warning("%s: cannot load explorer snapshot: %s", self.path, e)
+            return None
+
+        return Snapshot(
+                explorer, data["explorer"], histogram, data.get("marker"), db_change_marker(self.db_url),
+                data.get("duration"))
+
+    def save(
+            self, explorer_json, histogram: Optional[TimeHistogram], marker: Optional[str],
+            duration: Optional[float]):
+        """
+        Save the explorer contents, as returned by DBExplorer.to_json(), and
+        the time histogram, which can be None if it is still being built.
+
+        marker is the database change marker computed before the explorer was
+        built
+        """
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "db_url": self.db_url,
+            "marker": marker,
+            "created": time.time(),
+            "duration": duration,
+            "explorer": explorer_json,
+            "histogram": histogram.to_dict() if histogram is not None else None,
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write atomically, so that a concurrent startup never sees a partial
+        # file
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, prefix=".explorer-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wt") as out:
+                json.dump(data, out)
+            os.replace(tmpname, self.path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
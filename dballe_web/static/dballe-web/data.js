@@ -124,6 +124,81 @@ class DataEditor extends Editor
     }
 }
 
+/**
+ * Turn columns as sent by get_data into a list of rows
+ *
+ * columns has the same structure as the JSON columnar encoding
+ */
+function columns_to_rows(columns)
+{
+    let rows = [];
+    for (let k = 0; k < columns.n; ++k)
+    {
+        const c = columns.c.index[k];
+        let row = {
+            i: columns.i[k],
+            r: columns.r.values[columns.r.index[k]],
+            s: columns.s[k],
+            c: columns.c.values[c],
+            l: columns.l.values[columns.l.index[k]],
+            t: columns.t.values[columns.t.index[k]],
+            d: columns.d.values[columns.d.index[k]],
+            v: columns.v[k],
+            vt: columns.vt[c],
+        };
+        if (row.vt == "integer" || row.vt == "decimal")
+            row.vs = columns.vs[c];
+        rows.push(row);
+    }
+    return rows;
+}
+
+/**
+ * Decode the binary columnar encoding of get_data results.
+ *
+ * Returns an object with the list of rows in `rows`, and the other
+ * information sent with them
+ */
+function decode_binary_columns(buffer)
+{
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic != "DBWC")
+        throw new Error("invalid binary data");
+    const header_len = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, header_len)));
+    const base = Math.ceil((8 + header_len) / 8) * 8;
+    const array_types = {f64: Float64Array, u32: Uint32Array, u16: Uint16Array};
+
+    let arrays = {};
+    for (const [name, type, offset] of header.arrays)
+        arrays[name] = new array_types[type](buffer, base + offset, header.n);
+
+    // Merge string values back into the value column
+    let values = Array.from(arrays.v);
+    let next_string = 0;
+    for (let k = 0; k < header.n; ++k)
+        if (header.vt[arrays.c[k]] == "string")
+            values[k] = header.strings[next_string++];
+
+    let column = name => { return {values: header.dicts[name], index: arrays[name]}; };
+    let res = Object.assign({}, header.extra);
+    res.rows = columns_to_rows({
+        n: header.n,
+        i: arrays.i,
+        s: arrays.s,
+        r: column("r"),
+        c: column("c"),
+        l: column("l"),
+        t: column("t"),
+        d: column("d"),
+        v: values,
+        vt: header.vt,
+        vs: header.vs,
+    });
+    return res;
+}
+
 class Data
 {
     constructor(dballeweb)
@@ -147,6 +222,29 @@ class Data
             limit = limit == "unlimited" ? null : parseInt(limit);
             this.dballeweb.set_data_limit(limit).then();
         });
+
+        // Paging: the server gives us the cursor to the next page, and we
+        // remember the cursors of the previous ones
+        this.page_prev = $("#data-page-prev");
+        this.page_next = $("#data-page-next");
+        this.page_history = [];
+        this.page_cursor = null;
+        this.page_next_cursor = null;
+        this.page_next.click(evt => {
+            this.page_history.push(this.page_cursor);
+            this.dballeweb.show_data_page(this.page_next_cursor).then();
+        });
+        this.page_prev.click(evt => {
+            this.dballeweb.show_data_page(this.page_history.pop()).then();
+        });
+    }
+
+    /**
+     * Check if data is shown one page at a time
+     */
+    is_paged()
+    {
+        return this.data_limit.val() != "unlimited";
     }
 
     trigger_data_selected(data)
@@ -159,21 +257,71 @@ class Data
 
     update(data)
     {
+        this.update_pager(data);
         this.tbody.empty();
+        this.append_rows(data.rows);
+    }
 
-        for (var i = 0; i < data.rows.length; ++i)
+    /**
+     * Start showing values that will arrive with append_rows
+     */
+    clear()
+    {
+        this.update_pager({});
+        this.tbody.empty();
+    }
+
+    update_pager(data)
+    {
+        if (data.next !== undefined)
         {
-            var row = data.rows[i];
-            var tr = $("<tr class='d-flex'>").data("dballe_data", row);
-            tr.append($("<td class='col-2'>").text(row.r));
-            tr.append($("<td class='col-1'>").text(row.s));
-            tr.append($("<td class='col-1'>").text(row.c));
-            tr.append($("<td class='col-2'>").text(row.l));
-            tr.append($("<td class='col-2'>").text(row.t));
-            tr.append($("<td class='col-2'>").text(row.d));
-            tr.append($("<td class='col-2'>").text(row.v));
-            this.tbody.append(tr);
+            if (!data.cursor)
+                this.page_history = [];
+            this.page_cursor = data.cursor;
+            this.page_next_cursor = data.next;
         }
+        const paged = data.next !== undefined && this.is_paged();
+        this.page_prev.attr("disabled", !paged || !this.page_history.length);
+        this.page_next.attr("disabled", !paged || !data.next);
+    }
+
+    _make_row(row)
+    {
+        var tr = $("<tr class='d-flex'>").data("dballe_data", row);
+        tr.append($("<td class='col-2'>").text(row.r));
+        tr.append($("<td class='col-1'>").text(row.s));
+        tr.append($("<td class='col-1'>").text(row.c));
+        tr.append($("<td class='col-2'>").text(row.l));
+        tr.append($("<td class='col-2'>").text(row.t));
+        tr.append($("<td class='col-2'>").text(row.d));
+        tr.append($("<td class='col-2'>").text(row.v));
+        return tr;
+    }
+
+    append_rows(rows)
+    {
+        for (var i = 0; i < rows.length; ++i)
+            this.tbody.append(this._make_row(rows[i]));
+    }
+
+    /**
+     * Replace the rows with the same context IDs as the given ones.
+     *
+     * Returns true if all rows were found in the table
+     */
+    patch_rows(rows)
+    {
+        let changed = new Map();
+        for (const row of rows)
+            changed.set(row.i, row);
+        this.tbody.children("tr").each((idx, el) => {
+            const tr = $(el);
+            const row = changed.get(tr.data("dballe_data").i);
+            if (row === undefined) return;
+            tr.replaceWith(this._make_row(row));
+            changed.delete(row.i);
+        });
+        return changed.size == 0;
     }
 
     update_explorer(explorer)
@@ -218,6 +366,8 @@ class Attrs
 }
 
 window.dballeweb = $.extend(window.dballeweb || {}, {
+    columns_to_rows: columns_to_rows,
+    decode_binary_columns: decode_binary_columns,
     Data: Data,
     Attrs: Attrs,
     Editor: Editor,
@@ -50,6 +50,31 @@ class Server
         });
     }
 
+    /**
+     * GET data using the binary columnar encoding.
+     *
+     * signal is an optional AbortSignal to cancel the request
+     */
+    async _get_binary_columns(name, args, signal) {
+        const url = "/api/1.0/" + name + "?" + $.param(args);
+        const response = await fetch(url, {
+            headers: {"Accept": "application/vnd.dballe-web.columns, application/json;q=0.5"},
+            signal: signal,
+        });
+        if (!response.ok)
+        {
+            console.warn("API GET ERROR", name, args, "→", response.status, response.statusText);
+            throw new Error(response.statusText);
+        }
+        let data;
+        if (response.headers.get("Content-Type") == "application/vnd.dballe-web.columns")
+            data = window.dballeweb.decode_binary_columns(await response.arrayBuffer());
+        else
+            data = await response.json();
+        console.debug("API GET", name, args, "→", data);
+        return data;
+    }
+
     async ping() {
         return await this._get("ping", {});
     }
@@ -62,8 +87,48 @@ class Server
         return await this._get("init", {});
     }
 
-    async get_data() {
-        return await this._get("get_data", {});
+    /**
+     * Stream all the currently selected data, calling on_rows with each
+     * group of rows as they arrive.
+     *
+     * Aborting signal stops the stream, and the export on the server
+     */
+    async stream_data(on_rows, signal) {
+        const response = await fetch("/api/1.0/get_data", {
+            headers: {"Accept": "application/x-ndjson"},
+            signal: signal,
+        });
+        if (!response.ok)
+        {
+            console.warn("API GET ERROR", "get_data", "→", response.status, response.statusText);
+            throw new Error(response.statusText);
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let pending = "";
+        while (true)
+        {
+            const {done, value} = await reader.read();
+            if (done)
+                break;
+            pending += decoder.decode(value, {stream: true});
+            const end = pending.lastIndexOf("\n");
+            if (end == -1)
+                continue;
+            const lines = pending.substring(0, end).split("\n");
+            pending = pending.substring(end + 1);
+            on_rows(lines.map(line => JSON.parse(line)));
+        }
+        pending += decoder.decode();
+        if (pending.trim())
+            on_rows([JSON.parse(pending)]);
+    }
+
+    async get_data_page(cursor, signal) {
+        let args = {};
+        if (cursor)
+            args.cursor = cursor;
+        return await this._get_binary_columns("get_data_page", args, signal);
     }
 
     async get_station_data(id_station) {
@@ -78,8 +143,34 @@ class Server
         return await this._get("get_data_attrs", {id: id});
     }
 
-    async set_filter(filter) {
-        return await this._post("set_filter", {filter: filter});
+    async stations_in_bbox(bounds, limit) {
+        let args = {
+            latmin: bounds.getSouth(),
+            latmax: bounds.getNorth(),
+            lonmin: bounds.getWest(),
+            lonmax: bounds.getEast(),
+        };
+        if (limit !== undefined)
+            args.limit = limit;
+        return await this._get("stations_in_bbox", args);
+    }
+
+    async time_histogram() {
+        return await this._get("time_histogram");
+    }
+
+    async station_clusters(zoom, bounds) {
+        return await this._get("station_clusters", {
+            zoom: zoom,
+            latmin: bounds.getSouth(),
+            latmax: bounds.getNorth(),
+            lonmin: bounds.getWest(),
+            lonmax: bounds.getEast(),
+        });
+    }
+
+    async set_filter(filter, since) {
+        return await this._post("set_filter", {filter: filter, delta: true, since: since});
     }
 
     async replace_station_data(rec) {
@@ -90,10 +181,26 @@ class Server
         return await this._post("replace_data", {rec: rec});
     }
 
+    async apply_edits(edits) {
+        return await this._post("apply_edits", {edits: edits});
+    }
+
     async set_data_limit(limit) {
         return await this._post("set_data_limit", {limit: limit});
     }
 
+    async export_job_submit(format) {
+        return await this._post("export_job_submit", {format: format});
+    }
+
+    async export_jobs() {
+        return await this._get("export_jobs", {});
+    }
+
+    async export_job_cancel(id) {
+        return await this._post("export_job_cancel", {id: id});
+    }
+
     async replace_station_data_attr(var_data, rec) {
         return await this._post("replace_station_data_attr", {var_data: var_data, rec: rec});
     }
@@ -109,11 +216,16 @@ class DballeWeb
     {
         this.options = options;
         this.server = new window.dballeweb.Server();
-        this.map = new window.dballeweb.ExplorerMap("map", options);
+        this.map = new window.dballeweb.ExplorerMap("map", options, this.server);
         this.filters = new window.dballeweb.Filters(this);
         this.data = new window.dballeweb.Data(this);
         this.tab_station = new window.dballeweb.StationTab(this, options);
         this.tab_value = new window.dballeweb.ValueTab(this, options);
+        this.tab_export = new window.dballeweb.ExportTab(this, options);
+        // ETag of the last explorer state received from set_filter
+        this.explorer_state = null;
+        // Controller to abort the request currently filling the data table
+        this.data_request = null;
 
         document.addEventListener("data_selected", evt => {
             const data = evt.detail.data;
@@ -141,13 +253,51 @@ class DballeWeb
     async init()
     {
         var res = await this.server.init();
+        // The explorer is built in the background: poll until it is ready
+        while (res.initializing)
+        {
+            this.update_progress(res.progress);
+            if (res.progress && res.progress.error)
+                return;
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            res = await this.server.init();
+        }
+        this.update_progress(res.progress);
         this.update_explorer(res.explorer);
         await this.update_data();
     }
 
+    /**
+     * Show the progress of the explorer rebuild
+     */
+    update_progress(progress)
+    {
+        const el = $("#explorer-progress");
+        if (!progress)
+        {
+            el.text("");
+            return;
+        }
+
+        if (progress.error)
+        {
+            el.text(`Error scanning the database: ${progress.error}`);
+            return;
+        }
+
+        let text = `Scanning the database: ${progress.stations} stations`;
+        if (progress.rows != null)
+            text += `, ${progress.rows} values`;
+        if (progress.eta != null)
+            text += `, about ${Math.ceil(progress.eta)}s left`;
+        el.text(text);
+    }
+
     async set_filter(filter)
     {
-        var res = await this.server.set_filter(filter);
+        // Send the state we have, to only receive changes to station lists
+        var res = await this.server.set_filter(filter, this.explorer_state);
+        this.explorer_state = res.state;
         this.update_explorer(res.explorer);
         await this.update_data();
     }
@@ -163,8 +313,51 @@ class DballeWeb
 
     async update_data()
     {
-        var data = await this.server.get_data();
-        this.data.update(data);
+        if (this.data.is_paged())
+            await this.show_data_page(null);
+        else
+        {
+            const signal = this._start_data_request();
+            this.data.clear();
+            try {
+                await this.server.stream_data(rows => {
+                    // Rows from a stream that was superseded may still be
+                    // decoded after it was aborted
+                    if (!signal.aborted)
+                        this.data.append_rows(rows);
+                }, signal);
+            } catch (e) {
+                if (!signal.aborted)
+                    throw e;
+            }
+        }
+    }
+
+    async show_data_page(cursor)
+    {
+        const signal = this._start_data_request();
+        let data;
+        try {
+            data = await this.server.get_data_page(cursor, signal);
+        } catch (e) {
+            if (!signal.aborted)
+                throw e;
+            return;
+        }
+        if (!signal.aborted)
+            this.data.update(data);
+    }
+
+    /**
+     * Abort the request currently filling the data table, and return the
+     * AbortSignal for a new one
+     */
+    _start_data_request()
+    {
+        if (this.data_request)
+            this.data_request.abort();
+        this.data_request = new AbortController();
+        return this.data_request.signal;
     }
 
     async replace_station_data(rec)
@@ -178,14 +371,20 @@ class DballeWeb
     {
         console.debug("replace_data", rec);
         var data = await this.server.replace_data(rec);
-        this.data.update(data);
+        // New values are not in the table yet: reload it to show them in
+        // their place
+        if (!this.data.patch_rows(data.rows))
+            await this.update_data();
     }
 
     async set_data_limit(limit)
     {
         console.debug("set_data_limit", limit);
         var data = await this.server.set_data_limit(limit);
-        this.data.update(data);
+        if (data.rows === null)
+            await this.update_data();
+        else
+            this.data.update(data);
     }
 
     /**
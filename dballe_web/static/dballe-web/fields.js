@@ -24,6 +24,10 @@ class FilterFieldStation extends FilterField
     {
         super(filters, "station");
         this.field_value = this.container.find(".dballeweb-value");
+        // State of the station count preview during box selection
+        this.pending_bounds = null;
+        this.preview_running = false;
+        this.preview_seq = 0;
         document.addEventListener("map_select_station", evt => {
             this.select_station(evt.detail.info);
         });
@@ -80,11 +84,51 @@ class FilterFieldStation extends FilterField
         ];
         if (finished)
         {
+            // Discard previews still in flight
+            this.pending_bounds = null;
+            ++this.preview_seq;
             this._set_value(filters);
             this.filters.update_filter().then();
         }
         else
+        {
             this.field_value.html(`<i>${this._filters_to_text(filters)}</i>`);
+            this.preview_station_bounds(bounds).then();
+        }
+    }
+
+    /**
+     * Show how many stations are inside the box being selected
+     */
+    async preview_station_bounds(bounds)
+    {
+        // Only keep one request in flight, and use the latest bounds when it
+        // is done
+        this.pending_bounds = bounds;
+        if (this.preview_running)
+            return;
+        this.preview_running = true;
+        try {
+            while (this.pending_bounds)
+            {
+                const bounds = this.pending_bounds;
+                this.pending_bounds = null;
+                const seq = this.preview_seq;
+                const res = await this.filters.dballeweb.server.stations_in_bbox(bounds, 0);
+                // Skip outdated results
+                if (this.pending_bounds || seq != this.preview_seq)
+                    continue;
+                const filters = [
+                    ["latmin", bounds._southWest.lat.toFixed(5)],
+                    ["latmax", bounds._northEast.lat.toFixed(5)],
+                    ["lonmin", bounds._southWest.lng.toFixed(5)],
+                    ["lonmax", bounds._northEast.lng.toFixed(5)],
+                ];
+                this.field_value.html(`<i>${this._filters_to_text(filters)}: ${res.count} stations</i>`);
+            }
+        } finally {
+            this.preview_running = false;
+        }
     }
 
     update_explorer(explorer)
@@ -151,11 +195,17 @@ class FilterFieldChoices extends FilterField
         this.field.hide();
     }
 
-    _set_multi(options)
+    _set_multi(options, facets)
     {
         // Multiple available options
         this.value = {};
 
+        // Index value counts by value
+        let counts = new Map();
+        if (facets)
+            for (const [value, count, dtmin, dtmax] of facets)
+                counts.set(JSON.stringify(value), {count: count, dtmin: dtmin, dtmax: dtmax});
+
         // Fill the <option> list in the <select> field
         this.field.empty();
         this.field.append("<option value='' selected>-------</option>");
@@ -163,6 +213,12 @@ class FilterFieldChoices extends FilterField
         {
             var o = this._get_option(options[i]);
             var opt = $("<option>").attr("value", o[0]).text(o[1]).data("dballe_value", o[0]);
+            const facet = counts.get(JSON.stringify(o[0]));
+            if (facet)
+            {
+                opt.text(`${o[1]} (${facet.count.toLocaleString()})`);
+                opt.attr("title", `${facet.dtmin} – ${facet.dtmax}`);
+            }
             this.field.append(opt);
         }
 
@@ -192,7 +248,7 @@ class FilterFieldChoices extends FilterField
             if (options.length == 1)
                 this._set_forced(options[0]);
             else
-                this._set_multi(options);
+                this._set_multi(options, explorer.facets ? explorer.facets[this.name] : null);
         } else {
             this._set_chosen(current);
         }
@@ -212,6 +268,78 @@ class FilterFieldDateTime extends FilterField
         this.field_max = $("#filter-field-datetime-max");
         this.field_min.change(evt => { this.on_change(evt); });
         this.field_max.change(evt => { this.on_change(evt); });
+        this.canvas = $("#filter-field-datetime-histogram");
+        this.field_count = $("#filter-field-datetime-count");
+        // Daily value counts, as returned by the time_histogram API
+        this.histogram = null;
+        // Timer to fetch the histogram again while it is being built
+        this.histogram_timer = null;
+        // Preview the number of values while typing
+        this.field_min.on("input", evt => { this.show_preview(); });
+        this.field_max.on("input", evt => { this.show_preview(); });
+    }
+
+    async update_histogram()
+    {
+        clearTimeout(this.histogram_timer);
+        this.histogram_timer = null;
+        const res = await this.filters.dballeweb.server.time_histogram();
+        this.histogram = res.histogram;
+        this.show_preview();
+        // The histogram is built in the background after the explorer: check
+        // again until it is ready
+        if (res.histogram_progress && !res.histogram_progress.error)
+            this.histogram_timer = setTimeout(() => { this.update_histogram().then(); }, 2000);
+    }
+
+    /**
+     * Return the position in the histogram of the day of a datetime string
+     */
+    _histogram_day(val)
+    {
+        const start = Date.parse(this.histogram.start + "T00:00:00Z");
+        return Math.floor((Date.parse(val.substr(0, 10) + "T00:00:00Z") - start) / 86400000);
+    }
+
+    show_preview()
+    {
+        if (!this.histogram)
+        {
+            this.field_count.text("");
+            this.canvas.hide();
+            return;
+        }
+        const counts = this.histogram.counts;
+        const datemin = this.complete_value_min(this.field_min.val());
+        const datemax = this.complete_value_max(this.field_max.val());
+        const first = datemin ? Math.max(0, this._histogram_day(datemin)) : 0;
+        const last = datemax ? Math.min(counts.length - 1, this._histogram_day(datemax)) : counts.length - 1;
+
+        let total = 0;
+        for (let i = first; i <= last; ++i)
+            total += counts[i];
+        this.field_count.text(`about ${total.toLocaleString()} values`);
+
+        // Draw one bar per pixel column, highlighting the selected range
+        const canvas = this.canvas[0];
+        this.canvas.show();
+        canvas.width = canvas.clientWidth;
+        const ctx = canvas.getContext("2d");
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+        const px_per_day = canvas.width / counts.length;
+        let columns = new Array(canvas.width).fill(0);
+        for (let i = 0; i < counts.length; ++i)
+            columns[Math.floor(i * px_per_day)] += counts[i];
+        const max = Math.max(...columns, 1);
+        const bar_width = Math.max(1, Math.floor(px_per_day));
+        for (let x = 0; x < columns.length; ++x)
+        {
+            if (!columns[x]) continue;
+            const day = Math.floor(x / px_per_day);
+            ctx.fillStyle = day >= first && day <= last ? "#007bff" : "#adb5bd";
+            const h = Math.ceil(columns[x] / max * canvas.height);
+            ctx.fillRect(x, canvas.height - h, bar_width, h);
+        }
     }
 
     unset()
@@ -296,6 +424,8 @@ class FilterFieldDateTime extends FilterField
             this.remove.show();
         else
             this.remove.hide();
+
+        this.update_histogram().then();
     }
 }
 
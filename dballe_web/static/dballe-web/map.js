@@ -12,11 +12,21 @@ class Stations
 
 class ExplorerStations extends Stations
 {
+    constructor()
+    {
+        super();
+        // Index stations by ID, to apply station deltas
+        this.by_id = new Map();
+    }
+
     /**
      * Update the station list with data from an explorer
      */
     update_explorer(explorer)
     {
+        if (explorer.stations_delta)
+            return this.update_delta(explorer.stations_delta);
+
         let updated = [];
         let created = [];
 
@@ -44,6 +54,7 @@ class ExplorerStations extends Stations
                 else
                     s.title = `${s.lat.toFixed(2)},${s.lon.toFixed(2)} (${s.report})`;
                 this.stations.set(key, s);
+                this.by_id.set(s.id, s);
                 created.push(s);
             }
         };
@@ -59,6 +70,35 @@ class ExplorerStations extends Stations
             created: created,
         };
     }
+
+    /**
+     * Update the station list with the IDs of stations enabled and disabled
+     * since the last update
+     */
+    update_delta(delta)
+    {
+        let updated = [];
+
+        let set_current = (ids, current) => {
+            for (const id of ids)
+            {
+                let s = this.by_id.get(id);
+                if (s && s.current != current)
+                {
+                    s.current = current;
+                    updated.push(s);
+                }
+            }
+        };
+
+        set_current(delta.enabled, true);
+        set_current(delta.disabled, false);
+
+        return {
+            updated: updated,
+            created: [],
+        };
+    }
 }
 
 
@@ -79,6 +119,14 @@ class CurrentStations extends Stations
         let updated = [];
         let created = [];
 
+        // Station deltas do not change the set of stations, and the current
+        // station is tracked separately
+        if (explorer.stations_delta)
+            return {
+                updated: updated,
+                created: created,
+            };
+
         var update_station = (station, current) => {
             let key = station.join(":");
             let s = this.stations.get(key);
@@ -319,12 +367,22 @@ class StationMap extends BaseMap
  */
 class ExplorerMap extends BaseMap
 {
-    constructor(id, options)
+    constructor(id, options, server)
     {
         super(id, options);
+        this.server = server;
 
-        // Station storage
+        // Station storage, used to compute the map extent. Markers are
+        // clustered by the server, since there can be too many stations for
+        // the browser to handle
         this.stations = new ExplorerStations();
+        // Sequence number of the last cluster request, to ignore stale
+        // responses
+        this.clusters_seq = 0;
+
+        this.map.on("moveend", evt => {
+            this.update_clusters().then();
+        });
 
         // Add the rectangle selection facility
         var selectfeature = this.map.boxSelect.enable();
@@ -336,6 +394,83 @@ class ExplorerMap extends BaseMap
         });
     }
 
+    update_explorer(explorer)
+    {
+        this.stations.update_explorer(explorer);
+
+        if (this.needs_zoom_to_fit)
+            this.zoom_to_fit();
+        this.update_clusters().then();
+    }
+
+    /**
+     * Load the station clusters for the visible part of the map
+     */
+    async update_clusters()
+    {
+        if (!this.map._loaded)
+            return;
+        const seq = ++this.clusters_seq;
+        let zoom = this.map.getZoom();
+        // Show all stations at the deepest zoom level, even if they are
+        // close enough to be clustered
+        if (zoom >= this.map.getMaxZoom())
+            zoom = 99;
+        const res = await this.server.station_clusters(zoom, this.map.getBounds());
+        if (seq != this.clusters_seq)
+            return;
+
+        let layer = L.layerGroup();
+        for (const cluster of res.disabled)
+            layer.addLayer(this._make_cluster_marker(cluster, false));
+        for (const cluster of res.current)
+            layer.addLayer(this._make_cluster_marker(cluster, true));
+
+        if (this.markers_layer != null)
+            this.map.removeLayer(this.markers_layer);
+        this.markers_layer = layer;
+        this.map.addLayer(layer);
+    }
+
+    _make_cluster_marker(cluster, current)
+    {
+        const position = new L.LatLng(cluster.lat, cluster.lon);
+        if (cluster.station)
+        {
+            const s = {
+                report: cluster.station[0],
+                id: cluster.station[1],
+                lat: cluster.station[2],
+                lon: cluster.station[3],
+                ident: cluster.station[4],
+                current: current,
+            };
+            if (s.ident)
+                s.title = `${s.ident} (${s.report})`;
+            else
+                s.title = `${s.lat.toFixed(2)},${s.lon.toFixed(2)} (${s.report})`;
+            let marker = L.marker(position, { title: s.title, id: s });
+            if (current)
+                marker.setIcon(new this.IconSelected());
+            marker.on("click", evt => {
+                this.trigger_select_station(evt.target.options.id);
+            });
+            return marker;
+        }
+
+        let marker = L.marker(position, {
+            icon: new L.DivIcon({
+                html: '<div><span>' + cluster.count + '</span></div>',
+                className: 'marker-cluster' + (current ? ' marker-cluster-current' : ' marker-cluster-normal'),
+                iconSize: new L.Point(40, 40)
+            }),
+        });
+        marker.on("click", evt => {
+            this.map.setView(position, cluster.expansion_zoom);
+        });
+        return marker;
+    }
+
     trigger_select_station_bounds(bounds, finished)
     {
         let new_evt = new CustomEvent("map_select_station_bounds", {detail: {
@@ -0,0 +1,116 @@
+(function($) {
+// https://developer.mozilla.org/en-US/docs/Web/JavaScript/Reference/Strict_mode
+"use strict";
+
+function format_bytes(size)
+{
+    const units = ["B", "KiB", "MiB", "GiB", "TiB"];
+    let unit = 0;
+    while (size >= 1024 && unit < units.length - 1)
+    {
+        size /= 1024;
+        ++unit;
+    }
+    return (unit == 0 ? size : size.toFixed(1)) + " " + units[unit];
+}
+
+class ExportTab
+{
+    constructor(dballeweb, options)
+    {
+        this.dballeweb = dballeweb;
+        this.tbody = $("#export-jobs tbody");
+        this.poll_timeout = null;
+
+        $(".dballeweb-export-job").click(evt => {
+            this.submit($(evt.target).data("format")).then();
+        });
+
+        this.tbody.on("click", ".dballeweb-export-job-cancel", evt => {
+            this.cancel($(evt.target).data("job")).then();
+        });
+
+        // Add the partition to direct download links
+        $(".dballeweb-export-link").each((idx, el) => {
+            $(el).data("base-href", $(el).attr("href"));
+        });
+        $("#export-partition").change(evt => {
+            const partition = $(evt.target).val();
+            $(".dballeweb-export-link").each((idx, el) => {
+                let href = $(el).data("base-href");
+                if (partition)
+                    href += "?" + $.param({partition: partition});
+                $(el).attr("href", href);
+            });
+        });
+
+        $("#tab-header-export").on("shown.bs.tab", evt => {
+            this.update().then();
+        });
+    }
+
+    async submit(format)
+    {
+        await this.dballeweb.server.export_job_submit(format);
+        await this.update();
+    }
+
+    async cancel(id)
+    {
+        await this.dballeweb.server.export_job_cancel(id);
+        await this.update();
+    }
+
+    /**
+     * Show the state of export jobs, polling until all of them are finished
+     */
+    async update()
+    {
+        if (this.poll_timeout !== null)
+        {
+            clearTimeout(this.poll_timeout);
+            this.poll_timeout = null;
+        }
+
+        const res = await this.dballeweb.server.export_jobs();
+        let active = false;
+        this.tbody.empty();
+        for (const job of res.jobs)
+        {
+            if (job.state == "queued" || job.state == "running")
+                active = true;
+
+            let progress = format_bytes(job.bytes);
+            if (job.rows)
+                progress += ", " + job.rows + (job.format == "csv" && job.expected_rows ? "/" + job.expected_rows : "") + " rows";
+            if (job.eta !== null)
+                progress += ", " + Math.ceil(job.eta) + "s left";
+
+            let actions = $("<td>");
+            if (job.state == "done")
+                actions.append($("<a>").attr("href", "/api/1.0/export_job/" + job.id + "/download").text("Download"));
+            if (job.state != "cancelled")
+                actions.append($("<button type='button' class='btn btn-sm btn-outline-secondary ml-2 dballeweb-export-job-cancel'>")
+                    .data("job", job.id)
+                    .text(job.state == "queued" || job.state == "running" ? "Cancel" : "Delete"));
+
+            let tr = $("<tr>");
+            tr.append($("<td>").text(new Date(job.created * 1000).toLocaleString()));
+            tr.append($("<td>").text(job.format));
+            tr.append($("<td>").text(job.error ? job.state + ": " + job.error : job.state));
+            tr.append($("<td>").text(progress));
+            tr.append(actions);
+            this.tbody.append(tr);
+        }
+
+        if (active)
+            this.poll_timeout = setTimeout(() => { this.update().then(); }, 1000);
+    }
+}
+
+
+window.dballeweb = $.extend(window.dballeweb || {}, {
+    ExportTab: ExportTab,
+});
+
+})(jQuery);
@@ -0,0 +1,84 @@
+from typing import Dict, List
+import numpy
+
+# Supported downsampling methods
+METHODS = ("minmax", "lttb")
+
+
+def minmax(t: numpy.ndarray, v: numpy.ndarray, width: int) -> Dict[str, numpy.ndarray]:
+    """
+    Split the time span of a series in width buckets of the same duration,
+    and compute minimum, maximum, mean and number of values of each bucket.
+
+    t must be sorted. Empty buckets are not returned, and the time of each
+    bucket is the time of its start
+    """
+    if not len(t):
+        return {"t": t, "min": v, "max": v, "mean": v, "count": numpy.zeros(0, dtype=numpy.int64)}
+    tmin = t[0]
+    span = t[-1] - tmin
+    if span > 0:
+        idx = numpy.minimum(((t - tmin) * (width / span)).astype(numpy.int64), width - 1)
+    else:
+        idx = numpy.zeros(len(t), dtype=numpy.int64)
+    buckets, starts, counts = numpy.unique(idx, return_index=True, return_counts=True)
+    return {
+        "t": tmin + buckets * (span / width),
+        "min": numpy.minimum.reduceat(v, starts),
+        "max": numpy.maximum.reduceat(v, starts),
+        "mean": numpy.add.reduceat(v, starts) / counts,
+        "count": counts,
+    }
+
+
+def lttb(t: numpy.ndarray, v: numpy.ndarray, threshold: int) -> Dict[str, numpy.ndarray]:
+    """
+    Select threshold points of a series with the Largest-Triangle-Three-Buckets
+    algorithm, which preserves the visual shape of the series.
+
+    t must be sorted
+    """
+    n = len(t)
+    if threshold >= n or threshold < 3:
+        return {"t": t, "v": v}
+
+    # Bucket i spans bounds[i]:bounds[i + 1]; the first and last points are
+    # always selected, and are not part of any bucket
+    bounds = (numpy.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(numpy.int64) + 1
+    bounds[-1] = n - 1
+    sizes = numpy.diff(bounds)
+    # Leave out the last point, or reduceat would add it to the last bucket
+    avg_t = numpy.add.reduceat(t[:n - 1], bounds[:-1]) / sizes
+    avg_v = numpy.add.reduceat(v[:n - 1], bounds[:-1]) / sizes
+    # The point following the last bucket is the last point
+    avg_t = numpy.append(avg_t[1:], t[-1])
+    avg_v = numpy.append(avg_v[1:], v[-1])
+
+    selected = numpy.empty(threshold, dtype=numpy.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        ta, va = t[a], v[a]
+        # Twice the area of the triangles between the point selected in the
+        # previous bucket, each point of this bucket, and the average of the
+        # next bucket
+        area = numpy.abs((ta - avg_t[i]) * (v[start:end] - va) - (ta - t[start:end]) * (avg_v[i] - va))
+        a = start + int(numpy.argmax(area))
+        selected[i + 1] = a
+    return {"t": t[selected], "v": v[selected]}
+
+
+def downsample(t: numpy.ndarray, v: numpy.ndarray, width: int, method: str = "minmax") -> Dict[str, List]:
+    """
+    Downsample a series for plotting on width pixels, returning a
+    JSON-serializable dict of columns
+    """
+    if method == "minmax":
+        res = minmax(t, v, width)
+    elif method == "lttb":
+        res = lttb(t, v, width)
+    else:
+        raise ValueError(f"unsupported downsampling method {method!r}")
+    return {name: column.tolist() for name, column in res.items()}
@@ -25,7 +25,14 @@ class DballeWeb:
             self.log_level = logging.WARN
 
     def start_flask(self):
-        app = create_app(self.args.db)
+        app = create_app(
+                self.args.db, pool_size=self.args.db_connections,
+                export_workers=self.args.export_workers,
+                export_buffer_size=self.args.export_buffer * 1024 * 1024,
+                export_jobs=self.args.export_jobs,
+                export_cache_size=self.args.export_cache_size * 1024 * 1024,
+                cache_dir=None if self.args.no_cache else self.args.cache_dir,
+                sqlite_wal=self.args.sqlite_wal)
 
         server = Server(
                 host='127.0.0.1',
@@ -13,5 +13,6 @@ class DballeWebMixin:
         self.app = self.create_app()
 
     def tearDown(self):
+        self.app.shutdown()
         self.app = None
         super().tearDown()
@@ -1,86 +1,307 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import collections
+import copy
+import hashlib
 import threading
 import datetime
-import queue
 import time
-from flask import Blueprint, jsonify, make_response, request, current_app, Response
+from flask import Blueprint, jsonify, make_response, request, current_app, Response, send_file, abort
 from flask.views import MethodView
+from .columns import DataColumns, MIMETYPE_COLUMNS_JSON, MIMETYPE_COLUMNS_BINARY
+from . import availability, compression, timeseries
+from .session import Filter, _import_datetime
+from .export import ExportCancelled, ExportCacheWriter, EXPORT_FORMATS, PARTITIONS, export_partitioned
 
 api = Blueprint('api10', __name__, url_prefix='/api/1.0/')
 
 
-class Exporter:
+@api.after_request
+def compress(response):
+    return compression.compress_response(request, response)
+
+
+# Content type for newline-delimited JSON
+MIMETYPE_NDJSON = "application/x-ndjson"
+
+
+class Streamer:
     """
-    Turn a function writing to files to a generator as expected by Flask
+    Turn a function writing to files to a generator as expected by Flask.
+
+    Subclasses implement produce() to write their output to self, and
+    optionally return the number of rows written.
+
+    At most buffer_size bytes are kept waiting for the client: after that,
+    write() blocks until the client reads more. If the generator is closed
+    before the end, for example because the client disconnected, write()
+    raises ExportCancelled to stop the producer
     """
-    def __init__(self, fmt: str):
-        self.format = fmt
+    def __init__(self, buffer_size: Optional[int] = None):
         self.db_session = current_app.db_session
-        self.write_queue = queue.Queue(maxsize=64)
-        self.thread = threading.Thread(target=self.write_loop)
+        self.logger = current_app.logger
+        self.buffer_size = buffer_size or self.db_session.export_buffer_size
+        self.cond = threading.Condition()
+        self.chunks = collections.deque()
+        # Size of the chunks waiting to be sent
+        self.buffered = 0
+        self.done = False
+        self.cancelled = False
+        # Statistics for logging
+        self.bytes_written = 0
+        self.rows_written = None
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.write_loop, name=f"dballe-web-{self.__class__.__name__}")
         self.thread.start()
 
+    def produce(self) -> Optional[int]:
+        """
+        Executed in the subthread to write the output
+        """
+        raise NotImplementedError(f"{self.__class__.__name__}.produce is not implemented")
+
     def write_loop(self):
         """
         Executed in the subthread to export data to the write queue
         """
         try:
-            self.db_session.export(self.format, self)
+            self.rows_written = self.produce()
+        except ExportCancelled:
+            pass
         finally:
-            self.write_queue.put(None)
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.logger.info(
+                    "%s %s: %d bytes, %s rows in %.3fs", self.__class__.__name__,
+                    "cancelled" if self.cancelled else "completed",
+                    self.bytes_written, "?" if self.rows_written is None else self.rows_written,
+                    time.monotonic() - self.started)
 
     def write(self, chunk: bytes):
         """
         Executed in subthread when it writes to its output file
         """
-        self.write_queue.put(chunk)
+        size = len(chunk)
+        with self.cond:
+            # A chunk is always accepted if nothing is buffered, even if it is
+            # bigger than the budget
+            while not self.cancelled and self.buffered and self.buffered + size > self.buffer_size:
+                self.cond.wait()
+            if self.cancelled:
+                raise ExportCancelled()
+            self.chunks.append(chunk)
+            self.buffered += size
+            self.bytes_written += size
+            self.cond.notify_all()
 
     def generate(self):
         """
         Executed in the main thread to generate output in the response
         """
-        while True:
-            chunk = self.write_queue.get()
-            if chunk is None:
-                self.thread.join()
-                break
-            else:
+        try:
+            while True:
+                with self.cond:
+                    while not self.chunks and not self.done:
+                        self.cond.wait()
+                    if not self.chunks:
+                        break
+                    chunk = self.chunks.popleft()
+                    self.buffered -= len(chunk)
+                    self.cond.notify_all()
                 yield chunk
+        finally:
+            with self.cond:
+                if not self.done:
+                    # The response was closed before the end: stop the
+                    # producer at its next write
+                    self.cancelled = True
+                self.chunks.clear()
+                self.buffered = 0
+                self.cond.notify_all()
+            if not self.cancelled:
+                self.thread.join()
+
+
+class Exporter(Streamer):
+    """
+    Stream the currently selected data exported in the given format.
+
+    flt is the filter selecting the data, captured when the request arrived.
+
+    If partition is given, the data is split into a zip archive with one file
+    for each part.
+
+    If cache_writer is given, the exported data is also written to it, and
+    added to the cache if the export completes
+    """
+    def __init__(
+            self, fmt: str, flt: Filter, cache_writer: Optional[ExportCacheWriter] = None,
+            partition: Optional[str] = None):
+        self.format = fmt
+        self.filter = flt
+        self.cache_writer = cache_writer
+        self.partition = partition
+        super().__init__()
+
+    def export(self):
+        if self.partition is None:
+            return self.db_session.export(self.format, self, self.filter)
+        return export_partitioned(self.db_session, self.format, self.partition, self, self.filter)
+
+    def produce(self):
+        if self.cache_writer is None:
+            return self.export()
+        try:
+            rows = self.export()
+        except BaseException:
+            self.cache_writer.discard()
+            raise
+        self.cache_writer.commit()
+        return rows
+
+    def write(self, chunk: bytes):
+        if self.cache_writer is not None:
+            self.cache_writer.write(chunk)
+        super().write(chunk)
+
+
+class DataStreamer(Streamer):
+    """
+    Stream the currently selected data as newline-delimited JSON
+    """
+    def produce(self):
+        return self.db_session.write_data_ndjson(self)
 
 
 @api.route(r"/export/<format>")
 def export(format):
     """
-    Download data selected in the current section
+    Download data selected in the current section.
+
+    With a ``partition`` query argument, download a zip archive with the data
+    split by station, report, day or varcode
     """
     fname = datetime.datetime.now().strftime("%Y%m%d-%H%M")
-    if format == "csv":
-        mimetype = "text/csv"
-    else:
-        mimetype = "application/octet-stream"
-
-    exporter = Exporter(format)
+    mimetype = EXPORT_FORMATS.get(format, "application/octet-stream")
+    ext = format
+    variant = format
+
+    partition = request.args.get("partition") or None
+    if partition is not None:
+        if partition not in PARTITIONS:
+            abort(400)
+        fname += f"-by-{partition}"
+        mimetype = "application/zip"
+        ext = f"{format}.zip"
+        variant = f"{format}:{partition}"
+
+    db_session = current_app.db_session
+    # Use the same filter for the cache key and the export, even if it changes
+    # in the meantime
+    flt = copy.copy(db_session.filter)
+    cache = current_app.export_cache
+    cache_writer = None
+    if cache is not None and format in EXPORT_FORMATS:
+        key = cache.key(variant, flt, db_session.data_marker())
+        # send_file opens the file before returning, after which eviction
+        # does not affect the download
+        with cache.use(key) as path:
+            if path is not None:
+                return send_file(
+                        path, mimetype=mimetype, as_attachment=True,
+                        download_name=f"{fname}.{ext}", conditional=True, max_age=0)
+        cache_writer = cache.writer(key)
+
+    exporter = Exporter(format, flt, cache_writer, partition)
 
     res = Response(exporter.generate(), mimetype=mimetype, headers=[
-        ("Content-Disposition", 'attachment; filename="{}.{}"'.format(fname, format)),
+        ("Content-Disposition", 'attachment; filename="{}.{}"'.format(fname, ext)),
     ])
     # writer = WriteToHandler(self)
     # yield to_tornado_future(asyncio.ensure_future(self.application.session.export(format, writer)))
     return res
 
 
+@api.route(r"/export_job/<job_id>/download")
+def export_job_download(job_id):
+    """
+    Download the result of an export job.
+
+    Downloads can be resumed using Range requests
+    """
+    try:
+        job = current_app.export_jobs.get(job_id)
+    except KeyError:
+        abort(404)
+    if job.state != "done":
+        abort(409)
+    fname = datetime.datetime.fromtimestamp(job.created).strftime("%Y%m%d-%H%M")
+    return send_file(
+            job.path, mimetype=EXPORT_FORMATS[job.format], as_attachment=True,
+            download_name=f"{fname}.{job.format}", conditional=True, max_age=0)
+
+
+# Content type for GeoJSON
+MIMETYPE_GEOJSON = "application/geo+json"
+
+# Deepest zoom level for which station tiles are served
+MAX_TILE_ZOOM = 24
+
+
+@api.route(r"/station_tiles/<int:z>/<int:x>/<int:y>.geojson")
+def station_tile(z, x, y):
+    """
+    Station clusters in a web map tile, as GeoJSON.
+
+    Tiles change with the current filter, and carry an ETag so that clients
+    and proxies can revalidate them cheaply
+    """
+    if z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    etag, data = current_app.db_session.station_tile(z, x, y)
+    # Compressed responses carry a weak version of the ETag
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        res = make_response("", 304)
+        res.set_etag(etag)
+        return res
+    res = Response(data, mimetype=MIMETYPE_GEOJSON)
+    if etag is not None:
+        res.set_etag(etag)
+        # Allow caching, but always check with the server
+        res.headers["Cache-Control"] = "no-cache"
+    return res
+
+
 class APIView(MethodView):
     """
     Base code for all Web API views
     """
+    def __init__(self):
+        super().__init__()
+        # ETag of the result, set by api() if the result can be cached
+        self.etag = None
+
     def call_api(self, kwargs: Dict[str, Any]):
         try:
             result = self.api(**kwargs)
+            if isinstance(result, Response):
+                return result
+            res = self.not_modified()
+            if res is not None:
+                return res
             current_app.logger.debug("API call %s %r result %r", self.__class__.__name__, kwargs, result)
             if not self.db_session.initialized:
                 result["initializing"] = True
+            progress = self.db_session.rebuild_status()
+            if progress is not None:
+                result["progress"] = progress
             result["time"] = time.time()
-            return jsonify(result)
+            res = jsonify(result)
+            if self.etag is not None:
+                res.set_etag(self.etag)
+                # Allow caching, but always check with the server
+                res.headers["Cache-Control"] = "no-cache"
+            return res
         except Exception as e:
             current_app.logger.error("API call error %s", e, exc_info=True)
             code = 500
@@ -90,6 +311,18 @@ class APIView(MethodView):
                 "message": str(e)
             }), code)
 
+    def not_modified(self) -> Optional[Response]:
+        """
+        Return a 304 response if the client already has the result for the
+        current ETag, or None if the result needs to be sent
+        """
+        # Compressed responses carry a weak version of the ETag
+        if self.etag is not None and request.if_none_match.contains_weak(self.etag):
+            res = make_response("", 304)
+            res.set_etag(self.etag)
+            return res
+        return None
+
     @property
     def db_session(self):
         return current_app.db_session
@@ -128,17 +361,191 @@ class APIViewPOST(APIView):
 
 @register("init")
 class APIInit(APIViewGET):
+    def api(self):
+        self.db_session.init()
+        etag, explorer = self.db_session.explorer_state()
+        # Responses are only cacheable when they carry no rebuild progress
+        if self.db_session.rebuild_status() is None:
+            self.etag = etag
+        return {
+            "explorer": explorer,
+        }
+
+
+@register("stats")
+class APIStats(APIViewGET):
     def api(self):
         return {
-            "explorer": self.db_session.init(),
+            "pool": self.db_session.pool.stats(),
         }
 
 
+def data_response_encoding() -> str:
+    """
+    Choose the encoding for data rows according to the Accept header
+    """
+    return request.accept_mimetypes.best_match(
+            ["application/json", MIMETYPE_COLUMNS_JSON, MIMETYPE_COLUMNS_BINARY, MIMETYPE_NDJSON],
+            default="application/json")
+
+
+def columns_response(encoding: str, columns: DataColumns, extra: Dict[str, Any]) -> Response:
+    """
+    Build a response with data encoded as columns.
+
+    extra contains other information to send with the rows
+    """
+    if encoding == MIMETYPE_COLUMNS_JSON:
+        res = jsonify({"rows": columns.to_dict(), "time": time.time(), **extra})
+        res.mimetype = MIMETYPE_COLUMNS_JSON
+    else:
+        res = Response(columns.to_binary(extra), mimetype=MIMETYPE_COLUMNS_BINARY)
+    res.vary.add("Accept")
+    return res
+
+
 @register("get_data")
 class APIGetData(APIViewGET):
+    """
+    Return the currently selected data.
+
+    Besides the default list of rows, data can be sent as columns, encoded as
+    JSON or binary, or streamed as newline-delimited JSON, one row per line,
+    according to the Accept header
+    """
     def api(self):
+        encoding = data_response_encoding()
+        if encoding == "application/json":
+            return {
+                "rows": self.db_session.get_data(),
+            }
+
+        if encoding == MIMETYPE_NDJSON:
+            res = Response(DataStreamer().generate(), mimetype=MIMETYPE_NDJSON)
+            res.vary.add("Accept")
+            return res
+
+        columns = self.db_session.get_data_columns(DataColumns())
+        return columns_response(encoding, columns, {})
+
+
+@register("get_data_page")
+class APIGetDataPage(APIViewGET):
+    """
+    Return a page of the currently selected data, and the cursor to the next
+    page. Encodings are negotiated as in get_data, except for streaming.
+
+    If the cursor was made for a different filter, the first page is returned,
+    and cursor is None in the result
+    """
+    def api(self, cursor=None):
+        encoding = data_response_encoding()
+        cursor = self.db_session.current_data_cursor(cursor)
+        if encoding in ("application/json", MIMETYPE_NDJSON):
+            rows, next_cursor = self.db_session.get_data_page(cursor)
+            return {
+                "rows": rows,
+                "cursor": cursor,
+                "next": next_cursor,
+            }
+
+        rows, next_cursor = self.db_session.get_data_page(cursor)
+        columns = DataColumns()
+        for row in rows:
+            columns.add_row(row)
+        return columns_response(encoding, columns, {"cursor": cursor, "next": next_cursor})
+
+
+def parse_tuple(value: str):
+    """
+    Parse a level or time range given as comma-separated integers, with empty
+    strings for missing values
+    """
+    return tuple(int(v) if v else None for v in value.split(","))
+
+
+@register("timeseries")
+class APITimeseries(APIViewGET):
+    """
+    Return the values of a variable of a station over time, downsampled for
+    plotting on width pixels.
+
+    level and trange are comma-separated, and method can be minmax or lttb.
+    Times in the result are seconds since the epoch
+    """
+    def api(self, ana_id, varcode, level, trange, width=1000, method="minmax", datemin=None, datemax=None):
+        if method not in timeseries.METHODS:
+            raise ValueError(f"unsupported downsampling method {method!r}")
+        width = int(width)
+        if width < 1:
+            raise ValueError("width must be positive")
+        key = (ana_id, varcode, level, trange, width, method, datemin, datemax)
+        self.etag = hashlib.sha1(f"{self.db_session.data_marker()}:{key!r}".encode()).hexdigest()
+        res = self.not_modified()
+        if res is not None:
+            return res
+
+        t, v = self.db_session.get_timeseries(
+                int(ana_id), varcode, parse_tuple(level), parse_tuple(trange),
+                _import_datetime(datemin), _import_datetime(datemax))
         return {
-            "rows": self.db_session.get_data(),
+            "count": len(t),
+            "method": method,
+            "series": timeseries.downsample(t, v, width, method),
+        }
+
+
+@register("time_histogram")
+class APITimeHistogram(APIViewGET):
+    """
+    Return the number of values per day selected by the current filter,
+    ignoring its datetime range, and the number of values inside its datetime
+    range.
+
+    Station and area filters are not applied. histogram is None when the
+    histogram is still being built: in that case, and while a newer histogram
+    is being built, histogram_progress reports the progress of the build
+    """
+    def api(self):
+        etag, explorer = self.db_session.explorer_state()
+        progress = self.db_session.histogram_status()
+        # Responses are only cacheable when they carry no build progress
+        if etag is not None and progress is None:
+            self.etag = f"{etag}-{self.db_session.histogram_generation}"
+            res = self.not_modified()
+            if res is not None:
+                return res
+        histogram, count = self.db_session.get_time_histogram()
+        res = {
+            "histogram": histogram,
+            "count": count,
+        }
+        if progress is not None:
+            res["histogram_progress"] = progress
+        return res
+
+
+@register("availability")
+class APIAvailability(APIViewGET):
+    """
+    Count the values selected by the current filter in a matrix of stations or
+    varcodes by time buckets, to show gaps in the data.
+
+    by can be station or varcode, and step can be hour, day or week
+    """
+    def api(self, by="station", step="day"):
+        if step not in availability.STEPS:
+            raise ValueError(f"unsupported time step {step!r}")
+        key = (self.db_session.filter.to_tuple(), by, step)
+        self.etag = hashlib.sha1(f"{self.db_session.data_marker()}:{key!r}".encode()).hexdigest()
+        res = self.not_modified()
+        if res is not None:
+            return res
+
+        counts = availability.count_values(self.db_session, by, availability.STEPS[step])
+        return {
+            "by": by,
+            "availability": counts.to_dict() if counts is not None else None,
         }
 
 
@@ -168,11 +575,64 @@ class APIGetDataAttrs(APIViewGET):
         }
 
 
+@register("stations_in_bbox")
+class APIStationsInBBox(APIViewGET):
+    """
+    Return the stations inside a bounding box, split into those selected and
+    not selected by the current filter.
+
+    If limit is given, at most limit stations are returned in each list, and
+    count has the total number of stations found
+    """
+    def api(self, latmin, latmax, lonmin, lonmax, limit=None):
+        stations, stations_disabled = self.db_session.stations_in_bbox(
+                float(latmin), float(latmax), float(lonmin), float(lonmax))
+        count = len(stations) + len(stations_disabled)
+        if limit is not None:
+            limit = int(limit)
+            stations = stations[:limit]
+            stations_disabled = stations_disabled[:limit]
+        return {
+            "stations": stations,
+            "stations_disabled": stations_disabled,
+            "count": count,
+        }
+
+
+@register("station_clusters")
+class APIStationClusters(APIViewGET):
+    """
+    Return the stations inside a bounding box clustered for display on a map
+    at the given zoom level, split into those selected and not selected by the
+    current filter.
+
+    Each entry has lat, lon and count. Single stations have the station
+    tuple in station, clusters have the zoom level at which they split up in
+    expansion_zoom
+    """
+    def api(self, zoom, latmin, latmax, lonmin, lonmax):
+        current, disabled = self.db_session.station_clusters(
+                int(zoom), float(latmin), float(latmax), float(lonmin), float(lonmax))
+        return {
+            "current": current,
+            "disabled": disabled,
+        }
+
+
 @register("set_filter")
 class APISetFilter(APIViewPOST):
-    def api(self, filter):
+    def api(self, filter, delta=False, since=None):
+        if not delta:
+            return {
+                "explorer": self.db_session.set_filter(filter),
+            }
+
+        # Delta mode: only send the changes to station lists since the state
+        # that the client already has
+        state, explorer = self.db_session.set_filter_delta(filter, since)
         return {
-            "explorer": self.db_session.set_filter(filter),
+            "explorer": explorer,
+            "state": state,
         }
 
 
@@ -188,6 +648,9 @@ class ApiReplaceStationData(APIViewPOST):
 
 @register("replace_data")
 class ApiReplaceData(APIViewPOST):
+    """
+    Replace or add a value, returning the rows of the changed values
+    """
     def api(self, rec):
         return {
             "rows": self.db_session.replace_data(rec),
@@ -210,9 +673,54 @@ class APIReplaceDataAttr(APIViewPOST):
         }
 
 
+@register("apply_edits")
+class APIApplyEdits(APIViewPOST):
+    """
+    Apply many edits in a single transaction, returning only the rows they
+    changed
+    """
+    def api(self, edits):
+        return {
+            "changed": self.db_session.apply_edits(edits),
+        }
+
+
+@register("export_job_submit")
+class APIExportJobSubmit(APIViewPOST):
+    """
+    Start exporting the currently selected data in the background
+    """
+    def api(self, format):
+        return {
+            "job": current_app.export_jobs.submit(format).to_dict(),
+        }
+
+
+@register("export_jobs")
+class APIExportJobs(APIViewGET):
+    """
+    Return the status of all export jobs
+    """
+    def api(self):
+        return {
+            "jobs": [job.to_dict() for job in current_app.export_jobs.list()],
+        }
+
+
+@register("export_job_cancel")
+class APIExportJobCancel(APIViewPOST):
+    def api(self, id):
+        return {
+            "job": current_app.export_jobs.cancel(id).to_dict(),
+        }
+
+
 @register("set_data_limit")
 class APISetDataLimit(APIViewPOST):
     def api(self, limit):
+        rows, next_cursor = self.db_session.set_data_limit(limit)
         return {
-            "rows": self.db_session.set_data_limit(limit),
+            "rows": rows,
+            "cursor": None,
+            "next": next_cursor,
         }
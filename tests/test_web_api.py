@@ -1,9 +1,36 @@
-from unittest import mock, TestCase
+from unittest import mock, skipUnless, TestCase
+import concurrent.futures
 import contextlib
 import datetime
+import gzip
+import io
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zipfile
 import flask
+import numpy
 from flask import url_for
+from dballe_web.columns import MIMETYPE_COLUMNS_JSON, MIMETYPE_COLUMNS_BINARY
+from dballe_web.session import ConnectionPool, Session, enable_wal
 from dballe_web.unittest import DballeWebMixin
+from dballe_web.webapi import Streamer
+from dballe_web.export import ExportCache
+from dballe_web import arrow, compression, export, timeseries
+from dballe_web import session as session_module
+from dballe_web.geo import ClusterIndex, StationIndex
+from dballe_web.histogram import TimeHistogram
+from dballe_web.snapshot import db_change_marker, sqlite_is_wal
+
+
+class EndlessStreamer(Streamer):
+    def produce(self):
+        while True:
+            self.write(b"x" * 1024)
 
 
 class WebAPIMixin(DballeWebMixin):
@@ -21,19 +48,34 @@ class WebAPIMixin(DballeWebMixin):
 
                 yield client
 
+    def init_session(self):
+        """
+        Initialize the session, waiting for the explorer and the time
+        histogram to be built
+        """
+        self.app.db_session.init()
+        self.app.db_session.wait_histogram()
+
     def api_export(self, fmt: str, time: int = 100, **kwargs):
         with self.app.app_context():
             url = url_for("api10.export", format=fmt)
 
         with self.client(time=time) as client:
-            return client.get(url, data=kwargs)
+            return client.get(url, query_string=kwargs)
+
+    def api_station_tile(self, z: int, x: int, y: int, time: int = 100, **kwargs):
+        with self.app.app_context():
+            url = url_for("api10.station_tile", z=z, x=x, y=y)
+
+        with self.client(time=time) as client:
+            return client.get(url, **kwargs)
 
-    def api_get(self, name: str, time: int = 100, **kwargs):
+    def api_get(self, name: str, time: int = 100, headers=None, **kwargs):
         with self.app.app_context():
             url = url_for(f"api10.{name}")
 
         with self.client(time=time) as client:
-            return client.get(url, data=kwargs)
+            return client.get(url, query_string=kwargs, headers=headers)
 
     def api_post(self, name: str, time: int = 100, **kwargs):
         with self.app.app_context():
@@ -45,12 +87,23 @@ class WebAPIMixin(DballeWebMixin):
 
 class TestEmpty(WebAPIMixin, TestCase):
     def test_get_data(self):
-        self.app.db_session.init()
+        self.init_session()
         res = self.api_get("get_data")
         self.assertEqual(res.get_json(), {"time": 100, "rows": []})
 
+    def test_stream_cancel(self):
+        with self.app.app_context():
+            streamer = EndlessStreamer(buffer_size=4096)
+        gen = streamer.generate()
+        self.assertEqual(next(gen), b"x" * 1024)
+        # Closing the response stops the producer
+        gen.close()
+        streamer.thread.join(timeout=5)
+        self.assertFalse(streamer.thread.is_alive())
+        self.assertTrue(streamer.cancelled)
+
     def test_export(self):
-        self.app.db_session.init()
+        self.init_session()
         res = self.api_export("bufr")
         self.assertEqual(res.get_data(), b"")
         res = self.api_export("csv")
@@ -59,6 +112,9 @@ class TestEmpty(WebAPIMixin, TestCase):
 
 class TestInit(WebAPIMixin, TestCase):
     def test_not_initialized(self):
+        res = self.api_get("init")
+        self.assertIn("explorer", res.get_json())
+        self.app.db_session.wait_rebuild()
         res = self.api_get("init")
         self.assertEqual(res.get_json(), {
                 "time": 100,
@@ -91,6 +147,7 @@ class TestInit(WebAPIMixin, TestCase):
                         'datetime_max': None,
                         'count': 0
                     },
+                    'facets': {'rep_memo': [], 'level': [], 'trange': [], 'var': []},
                 },
             }
         )
@@ -121,6 +178,8 @@ class TestBasic(WebAPIMixin, TestCase):
             t.insert_data(self.data, False, True)
 
     def test_init(self):
+        self.api_get("init")
+        self.app.db_session.wait_rebuild()
         res = self.api_get("init")
         self.maxDiff = None
         self.assertEqual(res.get_json(), {
@@ -159,11 +218,23 @@ class TestBasic(WebAPIMixin, TestCase):
                     'datetime_min': '1945-04-25 08:00:00',
                     'datetime_max': '1945-04-25 08:00:00',
                 },
+                'facets': {
+                    'rep_memo': [
+                        ['synop', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                        ['temp', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                    ],
+                    'level': [[[10, 11, 15, 22], 4, '1945-04-25 08:00:00', '1945-04-25 08:00:00']],
+                    'trange': [[[20, 111, 222], 4, '1945-04-25 08:00:00', '1945-04-25 08:00:00']],
+                    'var': [
+                        ['B01011', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                        ['B01012', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                    ],
+                },
             },
         })
 
     def test_get_data(self):
-        self.app.db_session.init()
+        self.init_session()
         res = self.api_get("get_data")
         self.maxDiff = None
         self.assertEqual(res.get_json(), {
@@ -213,9 +284,111 @@ class TestBasic(WebAPIMixin, TestCase):
             }],
         })
 
+    def test_get_data_columns(self):
+        self.init_session()
+        with self.app.app_context():
+            url = url_for("api10.get_data")
+
+        with self.client() as client:
+            res = client.get(url, headers={"Accept": MIMETYPE_COLUMNS_JSON})
+        self.assertEqual(res.mimetype, MIMETYPE_COLUMNS_JSON)
+        rows = res.get_json()["rows"]
+        self.assertEqual(rows["n"], 4)
+        self.assertEqual(rows["i"], [1, 2, 3, 4])
+        self.assertEqual(rows["r"], {"values": ["synop", "temp"], "index": [0, 0, 1, 1]})
+        self.assertEqual(rows["c"], {"values": ["B01011", "B01012"], "index": [0, 1, 0, 1]})
+        self.assertEqual(rows["l"], {"values": [[10, 11, 15, 22]], "index": [0, 0, 0, 0]})
+        self.assertEqual(rows["vt"], ["string", "integer"])
+        self.assertEqual(rows["vs"], [None, 0])
+        self.assertEqual(rows["v"], ["Hey Hey!!", 500, "Hey Hey!!", 500])
+
+        with self.client() as client:
+            res = client.get(url, headers={"Accept": MIMETYPE_COLUMNS_BINARY})
+        self.assertEqual(res.mimetype, MIMETYPE_COLUMNS_BINARY)
+        data = res.get_data()
+        self.assertEqual(data[:4], b"DBWC")
+        header_len = struct.unpack("<I", data[4:8])[0]
+        header = json.loads(data[8:8 + header_len])
+        self.assertEqual(header["n"], 4)
+        self.assertEqual(header["strings"], ["Hey Hey!!", "Hey Hey!!"])
+        # The data and each column start at a multiple of 8 bytes
+        base = 8 + header_len + (-(8 + header_len) % 8)
+        self.assertEqual([(base + offset) % 8 for name, typecode, offset in header["arrays"]], [0] * 8)
+        offsets = {name: offset for name, typecode, offset in header["arrays"]}
+        self.assertEqual(struct.unpack_from("<4d", data, base + offsets["v"])[1::2], (500, 500))
+        self.assertEqual(struct.unpack_from("<4I", data, base + offsets["i"]), (1, 2, 3, 4))
+
+    def test_get_data_page(self):
+        self.init_session()
+        res = self.api_post("set_data_limit", limit=3).get_json()
+        self.assertEqual([r["i"] for r in res["rows"]], [1, 2, 3])
+        self.assertIsNone(res["cursor"])
+        self.assertIsNotNone(res["next"])
+
+        next_cursor = res["next"]
+        res = self.api_get("get_data_page", cursor=next_cursor).get_json()
+        self.assertEqual([r["i"] for r in res["rows"]], [4])
+        self.assertIsNone(res["next"])
+
+        # A cursor for a different filter gives the first page
+        self.api_post("set_filter", filter={"var": "B01012"})
+        res = self.api_get("get_data_page", cursor=next_cursor).get_json()
+        self.assertEqual([r["i"] for r in res["rows"]], [2, 4])
+        self.assertIsNone(res["cursor"])
+
+        res = self.api_post("set_data_limit", limit=None).get_json()
+        self.assertIsNone(res["rows"])
+        self.assertIsNone(res["next"])
+
+    def test_get_data_page_not_initialized(self):
+        # Pages can be read before the explorer is built
+        rows, next_cursor = self.app.db_session.get_data_page()
+        self.assertEqual([r["i"] for r in rows], [1, 2, 3, 4])
+        self.assertIsNone(next_cursor)
+
+    def test_get_data_page_external_changes(self):
+        session = self.app.db_session
+        self.init_session()
+        rows, next_cursor = session.get_data_page()
+        self.assertEqual([r["i"] for r in rows], [1, 2, 3, 4])
+
+        # Changes made without going through the session are not noticed
+        # for in-memory databases, until the explorer is rebuilt
+        with session.db.transaction() as t:
+            t.insert_data(dict(
+                ana_id=1, datetime=datetime.datetime(1945, 4, 27, 12, 0, 0),
+                level=(10, 11, 15, 22), trange=(20, 111, 222), B12101=280.15), False, False)
+        rows, next_cursor = session.get_data_page()
+        self.assertEqual(len(rows), 4)
+        session.revalidate()
+        session.wait_rebuild()
+        rows, next_cursor = session.get_data_page()
+        self.assertEqual(len(rows), 5)
+
+        # Refreshing also drops cached pages
+        session.get_data_page()
+        self.assertTrue(session.data_pages)
+        session.refresh_filter()
+        self.assertFalse(session.data_pages)
+        session.wait_histogram()
+
+    def test_get_data_stream(self):
+        self.init_session()
+        with self.app.app_context():
+            url = url_for("api10.get_data")
+
+        with self.client() as client:
+            res = client.get(url, headers={"Accept": "application/x-ndjson"})
+            self.assertEqual(res.mimetype, "application/x-ndjson")
+            lines = res.get_data().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([r["i"] for r in rows], [1, 2, 3, 4])
+        self.assertEqual(rows[0]["v"], "Hey Hey!!")
+        self.assertEqual(rows[1]["vs"], 0)
+
     def test_export(self):
         self.maxDiff = None
-        self.app.db_session.init()
+        self.init_session()
 
         res = self.api_export("bufr")
         self.assertEqual(res.headers["Content-Type"], "application/octet-stream")
@@ -234,9 +407,132 @@ class TestBasic(WebAPIMixin, TestCase):
             "2,12.34560,76.54320,temp,B01012,500",
         ])
 
+    def test_export_parallel(self):
+        session = self.app.db_session
+        self.init_session()
+        serial = self.api_export("bufr").get_data()
+
+        # Worker processes cannot open an in-memory database: run the workers
+        # as threads sharing the session connection
+        session.export_workers = 4
+        self.assertIsNone(session.export_executor())
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            with mock.patch.object(session, "export_executor", return_value=executor):
+                with mock.patch("dballe_web.session._worker_db", return_value=session.db):
+                    with mock.patch(
+                            "dballe_web.session._encode_messages", wraps=session_module._encode_messages) as encode:
+                        self.assertEqual(self.api_export("bufr").get_data(), serial)
+        # One task for each station
+        self.assertEqual([c.args[2]["ana_id"] for c in encode.call_args_list], [1, 2])
+
+    def test_export_job(self):
+        self.init_session()
+        expected = self.api_export("csv").get_data()
+
+        job = self.api_post("export_job_submit", format="csv").get_json()["job"]
+        self.assertIn(job["state"], ("queued", "running", "done"))
+        self.assertEqual(job["expected_rows"], 4)
+        self.app.export_jobs.get(job["id"]).future.result()
+        jobs = self.api_get("export_jobs").get_json()["jobs"]
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]["state"], "done")
+        self.assertEqual(jobs[0]["bytes"], len(expected))
+        # Header lines are not counted as values
+        self.assertEqual(jobs[0]["rows"], 4)
+
+        with self.app.app_context():
+            url = url_for("api10.export_job_download", job_id=job["id"])
+        with self.client() as client:
+            res = client.get(url)
+            self.assertEqual(res.get_data(), expected)
+            res = client.get(url, headers={"Range": "bytes=10-"})
+            self.assertEqual(res.status_code, 206)
+            self.assertEqual(res.get_data(), expected[10:])
+
+        job = self.api_post("export_job_cancel", id=job["id"]).get_json()["job"]
+        self.assertEqual(job["state"], "cancelled")
+        with self.client() as client:
+            self.assertEqual(client.get(url).status_code, 409)
+
+    def test_export_job_not_initialized(self):
+        # Jobs can be submitted while the explorer is first built
+        job = self.api_post("export_job_submit", format="csv").get_json()["job"]
+        self.assertIsNone(job["expected_rows"])
+        self.app.export_jobs.get(job["id"]).future.result()
+        self.assertEqual(self.app.export_jobs.get(job["id"]).rows, 4)
+
+    @skipUnless(arrow.is_available(), "pyarrow is not installed")
+    def test_export_parquet(self):
+        import pyarrow.parquet
+        self.init_session()
+        res = self.api_export("parquet")
+        self.assertEqual(res.mimetype, "application/vnd.apache.parquet")
+        with tempfile.NamedTemporaryFile(suffix=".parquet") as fd:
+            fd.write(res.get_data())
+            fd.flush()
+            table = pyarrow.parquet.read_table(fd.name)
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(table.column("varcode").to_pylist(), ["B01011", "B01012", "B01011", "B01012"])
+        self.assertEqual(table.column("value").to_pylist(), [None, 500, None, 500])
+        self.assertEqual(table.column("text").to_pylist(), ["Hey Hey!!", None, "Hey Hey!!", None])
+
+    def test_export_partitioned(self):
+        self.init_session()
+        res = self.api_export("csv", partition="station")
+        self.assertEqual(res.mimetype, "application/zip")
+        self.assertRegex(res.headers["Content-Disposition"], r'filename="\d{8}-\d{4}-by-station.csv.zip"')
+        with zipfile.ZipFile(io.BytesIO(res.get_data())) as archive:
+            self.assertEqual(archive.namelist(), ["station-1.csv", "station-2.csv"])
+            self.assertEqual(archive.read("station-2.csv").decode().splitlines()[2:], [
+                "2,12.34560,76.54320,temp,B01011,Hey Hey!!",
+                "2,12.34560,76.54320,temp,B01012,500",
+            ])
+
+        res = self.api_export("bufr", partition="day")
+        with zipfile.ZipFile(io.BytesIO(res.get_data())) as archive:
+            self.assertEqual(archive.namelist(), ["1945-04-25.bufr"])
+
+        self.assertEqual(self.api_export("csv", partition="nonsense").status_code, 400)
+
+    def test_export_partitioned_skips_empty_days(self):
+        with self.app.db.transaction() as t:
+            t.insert_data(dict(
+                ana_id=1, datetime=datetime.datetime(1945, 4, 27, 12, 0, 0),
+                level=(10, 11, 15, 22), trange=(20, 111, 222), B12101=280.15), False, False)
+        self.init_session()
+
+        parts = [name for name, flt in export.partition_filters(self.app.db_session, "day")]
+        self.assertEqual(parts, ["1945-04-25", "1945-04-27"])
+
+        res = self.api_export("csv", partition="day")
+        with zipfile.ZipFile(io.BytesIO(res.get_data())) as archive:
+            self.assertEqual(archive.namelist(), ["1945-04-25.csv", "1945-04-27.csv"])
+
+    def test_export_compressed(self):
+        self.init_session()
+        with self.app.app_context():
+            url = url_for("api10.export", format="csv")
+
+        with self.client() as client:
+            plain = client.get(url).get_data()
+            res = client.get(url, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(res.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", res.headers["Vary"])
+            self.assertEqual(gzip.decompress(res.get_data()), plain)
+
+    def test_compression_threshold(self):
+        self.init_session()
+        with self.app.app_context():
+            url = url_for("api10.stats")
+
+        with self.client() as client:
+            res = client.get(url, headers={"Accept-Encoding": "gzip"})
+        # Too small to be worth compressing
+        self.assertNotIn("Content-Encoding", res.headers)
+
     def test_set_filter(self):
         self.maxDiff = None
-        self.app.db_session.init()
+        self.init_session()
 
         res = self.api_post("set_filter", filter={"datemin": "1945-04-25 00:00:00", "datemax": "1945-04-25 12:00:00"})
         self.assertEqual(res.get_json(), {
@@ -275,5 +571,568 @@ class TestBasic(WebAPIMixin, TestCase):
                     'datetime_min': '1945-04-25 08:00:00',
                     'datetime_max': '1945-04-25 08:00:00',
                 },
+                'facets': {
+                    'rep_memo': [
+                        ['synop', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                        ['temp', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                    ],
+                    'level': [[[10, 11, 15, 22], 4, '1945-04-25 08:00:00', '1945-04-25 08:00:00']],
+                    'trange': [[[20, 111, 222], 4, '1945-04-25 08:00:00', '1945-04-25 08:00:00']],
+                    'var': [
+                        ['B01011', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                        ['B01012', 2, '1945-04-25 08:00:00', '1945-04-25 08:00:00'],
+                    ],
+                },
             },
         })
+
+    def test_init_etag(self):
+        self.init_session()
+        res = self.api_get("init")
+        etag = res.headers["ETag"]
+        self.assertEqual(res.headers["Cache-Control"], "no-cache")
+
+        with self.app.app_context():
+            url = url_for("api10.init")
+        with self.client() as client:
+            res = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+
+        # Changing the filter changes the ETag
+        self.api_post("set_filter", filter={"rep_memo": "synop"})
+        with self.client() as client:
+            res = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_set_filter_delta(self):
+        self.init_session()
+        res = self.api_post("set_filter", filter={}, delta=True, since=None).get_json()
+        self.assertEqual(len(res["explorer"]["stations"]), 2)
+        state = res["state"]
+
+        res = self.api_post("set_filter", filter={"rep_memo": "synop"}, delta=True, since=state).get_json()
+        self.assertNotIn("stations", res["explorer"])
+        self.assertNotIn("stations_disabled", res["explorer"])
+        self.assertEqual(res["explorer"]["stations_delta"], {"since": state, "enabled": [], "disabled": [2]})
+        self.assertNotEqual(res["state"], state)
+
+        # Unknown states get full station lists
+        res = self.api_post("set_filter", filter={}, delta=True, since="unknown").get_json()
+        self.assertEqual(len(res["explorer"]["stations"]), 2)
+
+    def test_replace_data_explorer(self):
+        self.init_session()
+        session = self.app.db_session
+        rec = {
+            "ana_id": 1, "varcode": "B01012", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+            "datetime": "1945-04-25 08:00:00", "vt": "integer", "value": 400,
+        }
+
+        # Replacing a value leaves the explorer as it is
+        self.api_post("replace_data", rec=rec)
+        self.assertIsNone(session.rebuild_status())
+        self.assertEqual(session.explorer_to_dict()["stats"]["count"], 4)
+
+        # Adding a value to a known summary entry updates the explorer in place
+        rec["datetime"] = "1945-04-26 08:00:00"
+        self.api_post("replace_data", rec=rec)
+        self.assertIsNone(session.rebuild_status())
+        stats = session.explorer_to_dict()["stats"]
+        self.assertEqual(stats["count"], 5)
+        self.assertEqual(stats["datetime_max"], "1945-04-26 08:00:00")
+        facets = session.explorer_to_dict()["facets"]
+        self.assertEqual(facets["rep_memo"][0], ["synop", 3, "1945-04-25 08:00:00", "1945-04-26 08:00:00"])
+        self.assertEqual(facets["var"][1], ["B01012", 3, "1945-04-25 08:00:00", "1945-04-26 08:00:00"])
+
+        # Adding a value with a new variable also updates the explorer in place
+        self.api_post("replace_data", rec={
+            "ana_id": 2, "varcode": "B12101", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+            "datetime": "1945-04-27 08:00:00", "vt": "decimal", "value": 280.15,
+        })
+        self.assertIsNone(session.rebuild_status())
+        explorer = session.explorer_to_dict()
+        self.assertEqual(explorer["stats"]["count"], 6)
+        self.assertEqual([v[0] for v in explorer["var"]], ["B01011", "B01012", "B12101"])
+
+        self.api_post("set_filter", filter={"var": "B12101"})
+        explorer = session.explorer_to_dict()
+        self.assertEqual(explorer["stats"]["count"], 1)
+        self.assertEqual([s[1] for s in explorer["stations"]], [2])
+        self.assertEqual(explorer["rep_memo"], ["temp"])
+
+        # A rebuild absorbs the changes
+        session.revalidate()
+        session.wait_histogram()
+        self.assertEqual(len(session.explorer_changes), 0)
+        self.assertEqual(session.explorer_to_dict()["stats"]["count"], 1)
+
+    def test_replace_data_page_cache(self):
+        self.init_session()
+        session = self.app.db_session
+        rows, next_cursor = session.get_data_page()
+        self.assertEqual(len(rows), 4)
+        rec = {
+            "ana_id": 1, "varcode": "B01012", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+            "datetime": "1945-04-25 08:00:00", "vt": "integer", "value": 400,
+        }
+
+        # Only the changed row is returned
+        changed = self.api_post("replace_data", rec=rec).get_json()["rows"]
+        self.assertEqual([(row["s"], row["c"], row["v"]) for row in changed], [(1, "B01012", 400)])
+
+        # The cached page is updated without reading it again
+        with mock.patch.object(session, "_read_data_page") as read:
+            rows, next_cursor = session.get_data_page()
+        read.assert_not_called()
+        self.assertIn((changed[0]["i"], 400), [(row["i"], row["v"]) for row in rows])
+        self.assertEqual(len(rows), 4)
+
+        # Adding values drops the cached pages
+        rec["datetime"] = "1945-04-26 08:00:00"
+        self.api_post("replace_data", rec=rec)
+        rows, next_cursor = session.get_data_page()
+        self.assertEqual(len(rows), 5)
+
+    def test_apply_edits(self):
+        self.init_session()
+        session = self.app.db_session
+        with self.app.db.transaction() as t:
+            t.insert_station_data(dict(ana_id=1, B07030=100.0), False, False)
+        station, rows = session.get_station_data(1)
+        station_var = rows[0]
+
+        res = self.api_post("apply_edits", edits=[
+            {"type": "data", "rec": {
+                "ana_id": 1, "varcode": "B01012", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+                "datetime": "1945-04-25 08:00:00", "vt": "integer", "value": 400}},
+            {"type": "data", "rec": {
+                "ana_id": 1, "varcode": "B01012", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+                "datetime": "1945-04-26 08:00:00", "vt": "integer", "value": 300}},
+            {"type": "station_data", "rec": {"ana_id": 1, "varcode": "B07030", "vt": "decimal", "value": "150.5"}},
+            {"type": "data_attr", "var_data": {"i": 2}, "rec": {"c": "B33007", "vt": "integer", "v": "50"}},
+            {"type": "station_data_attr", "var_data": station_var, "rec": {"c": "B33007", "vt": "integer", "v": 70}},
+        ]).get_json()["changed"]
+        self.assertEqual([(row["s"], row["d"], row["v"]) for row in res["data"]], [
+            (1, "1945-04-25 08:00:00", 400),
+            (1, "1945-04-26 08:00:00", 300),
+        ])
+        self.assertEqual([(row["s"], row["c"], row["v"]) for row in res["station_data"]], [(1, "B07030", 150.5)])
+        self.assertEqual(res["data_attr"], [{"i": 2, "c": "B33007", "v": 50, "vt": "integer"}])
+        self.assertEqual(res["station_data_attr"], [{"i": station_var["i"], "c": "B33007", "v": 70, "vt": "integer"}])
+        self.assertEqual([a["v"] for a in session.get_data_attrs(2)], [50])
+        # The added value updates the explorer in place
+        self.assertEqual(session.explorer_to_dict()["stats"]["count"], 5)
+
+        # Errors tell which edit failed
+        res = self.api_post("apply_edits", edits=[
+            {"type": "station_data", "rec": {"ana_id": 1, "varcode": "B07030", "vt": "decimal", "value": "1"}},
+            {"type": "station_data", "rec": {"ana_id": 1, "varcode": "B07030", "vt": "decimal", "value": "x"}},
+        ])
+        self.assertEqual(res.status_code, 500)
+        self.assertIn("edit 1", res.get_json()["message"])
+
+    def test_export_cache(self):
+        self.init_session()
+        with tempfile.TemporaryDirectory() as workdir:
+            cache = self.app.export_cache = ExportCache(workdir, 1024 * 1024)
+            expected = self.api_export("csv").get_data()
+            self.assertEqual(len(cache.entries), 1)
+
+            # The second export is served from the cache
+            res = self.api_export("csv")
+            self.assertEqual(res.headers["Accept-Ranges"], "bytes")
+            self.assertEqual(res.get_data(), expected)
+            res.close()
+
+            # Changing the database changes the cache key
+            self.api_post("replace_data", rec={
+                "ana_id": 1, "varcode": "B01012", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+                "datetime": "1945-04-25 08:00:00", "vt": "integer", "value": 400,
+            })
+            res = self.api_export("csv")
+            self.assertNotIn("Accept-Ranges", res.headers)
+            self.assertNotEqual(res.get_data(), expected)
+            self.assertEqual(len(cache.entries), 2)
+
+            # Least recently used entries are evicted
+            cache.max_size = len(expected)
+            cache._evict()
+            self.assertEqual(len(cache.entries), 1)
+
+            # Entries in use are only evicted when they are released
+            cache.max_size = 1
+            with cache.use(next(iter(cache.entries))) as path:
+                cache._evict()
+                self.assertTrue(os.path.exists(path))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(len(cache.entries), 0)
+
+            # Exports too big for the cache are not written to it
+            cache.max_size = 10
+            self.api_post("set_filter", filter={"rep_memo": "synop"})
+            self.assertEqual(len(self.api_export("csv").get_data().splitlines()), 4)
+            self.assertEqual(len(cache.entries), 0)
+            self.assertEqual([name for name in os.listdir(workdir) if name.startswith(".")], [])
+            writer = cache.writer("test")
+            writer.write(b"x" * 20)
+            self.assertFalse(os.path.exists(writer.tmpname))
+            writer.commit()
+            self.assertIsNone(cache.get("test"))
+
+    def test_stations_in_bbox(self):
+        self.init_session()
+        res = self.api_get("stations_in_bbox", latmin=10, latmax=15, lonmin=70, lonmax=80).get_json()
+        self.assertEqual(res["count"], 2)
+        self.assertEqual([s[1] for s in res["stations"]], [1, 2])
+        self.assertEqual(res["stations_disabled"], [])
+
+        self.api_post("set_filter", filter={"rep_memo": "synop"})
+        res = self.api_get("stations_in_bbox", latmin=10, latmax=15, lonmin=70, lonmax=80, limit=0).get_json()
+        self.assertEqual(res["count"], 2)
+        self.assertEqual(res["stations"], [])
+
+        res = self.api_get("stations_in_bbox", latmin=10, latmax=15, lonmin=80, lonmax=90).get_json()
+        self.assertEqual(res["count"], 0)
+
+    def test_station_clusters(self):
+        self.init_session()
+        res = self.api_get("station_clusters", zoom=0, latmin=-90, latmax=90, lonmin=-180, lonmax=180).get_json()
+        self.assertEqual(sum(c["count"] for c in res["current"]), 2)
+        self.assertEqual(res["disabled"], [])
+
+        # Stations in the same place are only separate past the last zoom level
+        res = self.api_get("station_clusters", zoom=17, latmin=10, latmax=15, lonmin=70, lonmax=80).get_json()
+        self.assertEqual(sorted(c["station"][1] for c in res["current"]), [1, 2])
+
+    def test_station_tiles(self):
+        self.init_session()
+        # The test stations are in the north eastern tile at zoom level 1
+        res = self.api_station_tile(1, 1, 0)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/geo+json")
+        features = res.get_json()["features"]
+        self.assertEqual(sum(f["properties"]["count"] for f in features), 2)
+        self.assertTrue(all(f["properties"]["current"] for f in features))
+        etag = res.headers["ETag"]
+
+        res = self.api_station_tile(1, 0, 1)
+        self.assertEqual(res.get_json()["features"], [])
+
+        res = self.api_station_tile(1, 1, 0, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+
+        # Changing the filter changes the tiles
+        self.api_post("set_filter", filter={"rep_memo": "synop"})
+        res = self.api_station_tile(1, 1, 0, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+        res = self.api_station_tile(1, 2, 0)
+        self.assertEqual(res.status_code, 404)
+
+    def test_timeseries(self):
+        with self.app.db.transaction() as t:
+            for hour in range(9, 21):
+                t.insert_data(dict(
+                    ana_id=1, datetime=datetime.datetime(1945, 4, 25, hour, 0, 0),
+                    level=(10, 11, 15, 22), trange=(20, 111, 222), B01012=hour), False, False)
+        self.init_session()
+
+        args = dict(ana_id=1, varcode="B01012", level="10,11,15,22", trange="20,111,222")
+        res = self.api_get("timeseries", width=4, **args)
+        data = res.get_json()
+        self.assertEqual(data["count"], 13)
+        series = data["series"]
+        self.assertEqual(len(series["t"]), 4)
+        self.assertEqual(series["min"][0], 9)
+        self.assertEqual(series["max"], [500, 13, 16, 20])
+        self.assertEqual(sum(series["count"]), 13)
+        epoch = datetime.datetime(1970, 1, 1)
+        self.assertEqual(series["t"][0], (datetime.datetime(1945, 4, 25, 8) - epoch).total_seconds())
+
+        res = self.api_get("timeseries", headers={"If-None-Match": res.headers["ETag"]}, width=4, **args)
+        self.assertEqual(res.status_code, 304)
+
+        data = self.api_get("timeseries", width=5, method="lttb", datemin="1945-04-25 12:00:00", **args).get_json()
+        self.assertEqual(data["count"], 9)
+        self.assertEqual(data["series"]["v"][0], 12)
+        self.assertEqual(data["series"]["v"][-1], 20)
+        self.assertEqual(len(data["series"]["v"]), 5)
+
+    def test_time_histogram(self):
+        with self.app.db.transaction() as t:
+            t.insert_data(dict(
+                ana_id=1, datetime=datetime.datetime(1945, 4, 27, 12, 0, 0),
+                level=(10, 11, 15, 22), trange=(20, 111, 222), B12101=280.15), False, False)
+        self.init_session()
+
+        res = self.api_get("time_histogram")
+        data = res.get_json()
+        self.assertEqual(data["histogram"], {"start": "1945-04-25", "counts": [4, 0, 1]})
+        self.assertEqual(data["count"], 5)
+
+        res = self.api_get("time_histogram", headers={"If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res.status_code, 304)
+
+        # The datetime range of the filter only affects the count
+        self.api_post("set_filter", filter={"datemin": "1945-04-26 00:00:00"})
+        data = self.api_get("time_histogram").get_json()
+        self.assertEqual(data["histogram"], {"start": "1945-04-25", "counts": [4, 0, 1]})
+        self.assertEqual(data["count"], 1)
+
+        self.api_post("set_filter", filter={"var": "B01012"})
+        data = self.api_get("time_histogram").get_json()
+        self.assertEqual(data["histogram"], {"start": "1945-04-25", "counts": [2]})
+
+        # Values added to known summary entries are counted
+        self.api_post("replace_data", rec={
+            "ana_id": 1, "varcode": "B01012", "level": [10, 11, 15, 22], "trange": [20, 111, 222],
+            "datetime": "1945-04-26 08:00:00", "vt": "integer", "value": 400,
+        })
+        data = self.api_get("time_histogram").get_json()
+        self.assertEqual(data["histogram"], {"start": "1945-04-25", "counts": [2, 1]})
+
+    def test_time_histogram_background(self):
+        session = self.app.db_session
+        self.init_session()
+
+        # The explorer is published before the histogram is built, and the
+        # previous histogram is used until the new one is ready
+        started = threading.Event()
+        release = threading.Event()
+        build = TimeHistogram.build
+
+        def slow_build(tr, callback=None):
+            started.set()
+            release.wait()
+            return build(tr, callback)
+
+        with mock.patch("dballe_web.session.TimeHistogram.build", slow_build):
+            session.revalidate()
+            session.wait_rebuild()
+            started.wait()
+            self.assertIsNone(session.rebuild_status())
+            data = self.api_get("time_histogram").get_json()
+            self.assertEqual(data["histogram"], {"start": "1945-04-25", "counts": [4]})
+            self.assertEqual(data["histogram_progress"]["phase"], "histogram")
+            self.assertEqual(data["histogram_progress"]["total"], 4)
+
+            # A new rebuild cancels the histogram build
+            previous, previous_progress = session.histogram_future, session.histogram_progress
+            session.revalidate()
+            release.set()
+            session.wait_histogram()
+        previous.result()
+        self.assertEqual(previous_progress.phase, "cancelled")
+        self.assertIsNone(session.histogram_status())
+        data = self.api_get("time_histogram").get_json()
+        self.assertEqual(data["histogram"], {"start": "1945-04-25", "counts": [4]})
+        self.assertNotIn("histogram_progress", data)
+
+    def test_availability(self):
+        with self.app.db.transaction() as t:
+            t.insert_data(dict(
+                ana_id=1, datetime=datetime.datetime(1945, 4, 27, 12, 0, 0),
+                level=(10, 11, 15, 22), trange=(20, 111, 222), B12101=280.15), False, False)
+        self.init_session()
+
+        res = self.api_get("availability", by="station", step="day")
+        data = res.get_json()["availability"]
+        self.assertEqual(data["rows"], [1, 2])
+        self.assertEqual(data["start"], "1945-04-25 00:00:00")
+        self.assertEqual(data["step"], 86400)
+        self.assertEqual(data["counts"], {"row": [0, 0, 1], "bucket": [0, 2, 0], "count": [2, 1, 2]})
+        self.assertEqual(data["completeness"], [2 / 3, 1 / 3])
+
+        res = self.api_get("availability", headers={"If-None-Match": res.headers["ETag"]}, by="station", step="day")
+        self.assertEqual(res.status_code, 304)
+
+        data = self.api_get("availability", by="varcode", step="week").get_json()["availability"]
+        self.assertCountEqual(data["rows"], ["B01011", "B01012", "B12101"])
+        self.assertEqual(sum(data["counts"]["count"]), 5)
+
+        with mock.patch("dballe_web.availability.MAX_CELLS", 5):
+            self.assertEqual(self.api_get("availability", by="station", step="day").status_code, 500)
+
+    def test_stats(self):
+        self.init_session()
+        self.api_get("get_data")
+        res = self.api_get("stats").get_json()
+        pool = res["pool"]
+        self.assertEqual(pool["size"], 1)
+        self.assertGreaterEqual(pool["read"]["count"], 2)
+        self.assertEqual(pool["read"]["active"], 0)
+        self.assertEqual(pool["write"]["active"], 0)
+
+
+class TestSnapshot(TestCase):
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            db_url = "sqlite://" + os.path.join(workdir, "test.sqlite")
+            cache_dir = os.path.join(workdir, "cache")
+
+            session = Session(db_url, cache_dir=cache_dir)
+            session.db.reset()
+            with session.db.transaction() as t:
+                t.insert_data(dict(
+                    lat=12.34560, lon=76.54320,
+                    datetime=datetime.datetime(1945, 4, 25, 8, 0, 0),
+                    level=(10, 11, 15, 22),
+                    trange=(20, 111, 222),
+                    rep_memo="synop",
+                    B01012=500), False, True)
+            self.assertFalse(session.initialized)
+            session.init()
+            session.wait_histogram()
+            self.assertTrue(os.path.exists(session.snapshots.path))
+
+            # A new session starts up from the snapshot
+            session = Session(db_url, cache_dir=cache_dir)
+            self.assertTrue(session.initialized)
+            self.assertEqual(session.explorer_to_dict()["stats"]["count"], 1)
+            self.assertEqual(session.get_time_histogram(), ({"start": "1945-04-25", "counts": [1]}, 1))
+            session.wait_histogram()
+
+            # A snapshot saved before the histogram was ready is completed in
+            # the background
+            session.snapshots.save(session.explorer.to_json(), None, db_change_marker(db_url), None)
+            session = Session(db_url, cache_dir=cache_dir)
+            self.assertTrue(session.initialized)
+            session.wait_histogram()
+            self.assertEqual(session.get_time_histogram(), ({"start": "1945-04-25", "counts": [1]}, 1))
+            self.assertIsNotNone(session.snapshots.load().histogram)
+
+    def test_snapshot_wal(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test.sqlite")
+            db_url = "sqlite://" + path
+            cache_dir = os.path.join(workdir, "cache")
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("PRAGMA journal_mode=WAL")
+            other.execute("CREATE TABLE test (a INTEGER)")
+
+            session = Session(db_url, cache_dir=cache_dir)
+            session.db.reset()
+            with session.db.transaction() as t:
+                t.insert_data(dict(
+                    lat=12.34560, lon=76.54320,
+                    datetime=datetime.datetime(1945, 4, 25, 8, 0, 0),
+                    level=(10, 11, 15, 22),
+                    trange=(20, 111, 222),
+                    rep_memo="synop",
+                    B01012=500), False, True)
+            session.init()
+            session.wait_histogram()
+
+            # Closing the last connection deletes the write-ahead log, and
+            # opening the database creates it again: the snapshot is still
+            # fresh
+            other.close()
+            time.sleep(0.01)
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("SELECT * FROM test").fetchall()
+            session = Session(db_url, cache_dir=cache_dir)
+            self.assertTrue(session.initialized)
+            self.assertIsNone(session.current_future)
+
+            # Commits still in the write-ahead log make it stale
+            other.execute("INSERT INTO test VALUES (1)")
+            session = Session(db_url, cache_dir=cache_dir)
+            self.assertIsNotNone(session.current_future)
+            session.wait_histogram()
+            other.close()
+
+
+class TestCompressStream(TestCase):
+    def test_flush_threshold(self):
+        chunks = [b"BUFR%04d7777" % i for i in range(1000)]
+        out = list(compression.compress_stream(
+            compression.GzipCompressor(), iter(chunks), flush_size=4096, flush_interval=3600))
+        self.assertEqual(gzip.decompress(b"".join(out)), b"".join(chunks))
+        # The first chunk is flushed right away, then only every flush_size
+        # bytes
+        self.assertEqual(len(out), 4)
+
+
+class TestLTTB(TestCase):
+    def test_last_point_not_averaged(self):
+        # The average of the last bucket, used to select the point of the
+        # first one, must not include the last point
+        t = numpy.arange(8, dtype=float)
+        v = numpy.array([0, 1, -0.9, 0, 0, 0, 0, 1000])
+        res = timeseries.lttb(t, v, 4)
+        self.assertEqual(res["t"].tolist(), [0, 1, 6, 7])
+
+
+class TestEnableWAL(TestCase):
+    def test_enable_wal(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test.sqlite")
+            self.assertFalse(enable_wal("sqlite://" + path))
+            self.assertFalse(enable_wal("sqlite://:memory:"))
+            with contextlib.closing(sqlite3.connect(path)) as db:
+                db.execute("CREATE TABLE test (a INTEGER)")
+            self.assertTrue(enable_wal("sqlite://" + path))
+            with contextlib.closing(sqlite3.connect(path)) as db:
+                self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_pool_wal_opt_in(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test.sqlite")
+            db_url = "sqlite://" + path
+            with contextlib.closing(sqlite3.connect(path)) as db:
+                db.execute("CREATE TABLE test (a INTEGER)")
+            # Without the option, the database is left alone and readers
+            # share the writer connection
+            pool = ConnectionPool(db_url)
+            self.assertTrue(pool.shared)
+            self.assertFalse(sqlite_is_wal(path))
+
+            pool = ConnectionPool(db_url, wal=True)
+            self.assertFalse(pool.shared)
+            self.assertTrue(sqlite_is_wal(path))
+
+            # Databases already in WAL mode are used in parallel
+            pool = ConnectionPool(db_url)
+            self.assertFalse(pool.shared)
+
+
+class TestStationIndex(TestCase):
+    def test_query(self):
+        stations = [
+            ("synop", 1, 44.5, 11.3, None),
+            ("synop", 2, 45.1, 12.0, None),
+            ("synop", 3, -10.0, 179.5, None),
+            ("synop", 4, -10.0, -179.5, None),
+        ]
+        index = StationIndex(stations)
+        self.assertEqual(index.query(44, 46, 11, 12), stations[:2])
+        self.assertEqual(index.query(44, 45, 11, 12), stations[:1])
+        self.assertCountEqual(index.query(-90, 90, -180, 180), stations)
+        # Boxes crossing the antimeridian
+        self.assertCountEqual(index.query(-11, -9, 179, 181), stations[2:])
+        self.assertCountEqual(index.query(-11, -9, -181, -179), stations[2:])
+
+
+class TestClusterIndex(TestCase):
+    def test_query(self):
+        stations = [("synop", i, 44.0 + i * 0.001, 11.0, None) for i in range(10)]
+        stations.append(("synop", 10, -10.0, 179.5, None))
+        index = ClusterIndex(stations)
+
+        # At low zoom, nearby stations are merged in a single cluster
+        res = index.query(2, -90, 90, -180, 180)
+        self.assertEqual(len(res), 2)
+        self.assertCountEqual([c["count"] for c in res], [10, 1])
+        cluster = [c for c in res if c["count"] == 10][0]
+        self.assertAlmostEqual(cluster["lat"], 44.0045, places=3)
+        self.assertGreater(cluster["expansion_zoom"], 2)
+
+        # At the highest zoom levels, all stations are separate
+        res = index.query(20, 43, 45, 10, 12)
+        self.assertEqual(sorted(c["station"][1] for c in res), list(range(10)))
+
+        # Boxes crossing the antimeridian
+        res = index.query(5, -11, -9, 179, 181)
+        self.assertEqual([c["station"] for c in res], [stations[10]])